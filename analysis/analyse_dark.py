@@ -83,7 +83,7 @@ def perform_analysis(options):
         adcs = histogram.Histogram(filename=options.output_directory + options.histo_filename)
         # Fit the baseline and sigma_e of all pixels
         adcs.fit(fit_dark_adc.fit_func, fit_dark_adc.p0_func, fit_dark_adc.slice_func, fit_dark_adc.bounds_func, \
-                 labels_func=fit_dark_adc.labels_func)  # , limited_indices=tuple(options.pixel_list))
+                 labels_func=fit_dark_adc.labels_func, n_jobs=options.n_jobs if hasattr(options, 'n_jobs') else 1)  # , limited_indices=tuple(options.pixel_list))
         # adcs.fit(fit_2_gaussian.fit_func, fit_2_gaussian.p0_func, fit_2_gaussian.slice_func, fit_2_gaussian.bounds_func, \
         #         labels_func=fit_2_gaussian.label_func)#, limited_indices=tuple(options.pixel_list))
 
@@ -56,37 +56,38 @@ def create_histo(options):
     # Define the histograms
     mpes = histogram.Histogram(filename = options.output_directory + options.mpes_histo_filename)
 
-    mpes_full = histogram.Histogram(data=np.zeros(mpes.data[0].shape),bin_centers=mpes.bin_centers, xlabel='ADC',
+    mpes_full = histogram.Histogram(data=np.zeros(mpes.data_shape[1:] + mpes.bin_centers.shape),bin_centers=mpes.bin_centers, xlabel='ADC',
                           ylabel='$\mathrm{N_{trigger}}$', label='Summed MPE')
 
     # Add an Histogram corresponding to the sum of all other only if the mu is above a certain threshold
 
-    pbar = tqdm(total=mpes.data.shape[0]*mpes.data.shape[1])
+    pbar = tqdm(total=mpes.data_shape[0]*mpes.data_shape[1])
     #print(pbar.total)
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
 
     log.info('\t-|> Summing the MPEs:')
-    for i in range(mpes.data.shape[0]):
-        for j in range(mpes.data.shape[1]):
+    for i in range(mpes.data_shape[0]):
+        for j in range(mpes.data_shape[1]):
 
             if pbar.total<=1000:
                 pbar.update(1)
             else:
-                if (i*mpes.data.shape[1]+j) %int(pbar.total/1000)==0: pbar.update(pbar.total/1000)
+                if (i*mpes.data_shape[1]+j) %int(pbar.total/1000)==0: pbar.update(pbar.total/1000)
             # put the slice or remove empty bins
+            # the histogram of the level and pixel only (the MPE histogram may be stored with a bin window)
+            mpe_tmp = mpes.get_data((i, j))
 
             if not options.mc and (prev_fit_result is not None):
-                if np.where(mpes.data[i,j] != 0)[0].shape[0]==0 : continue
-                s = [np.where(mpes.data[i,j] != 0)[0][0], np.where(mpes.data[i,j] != 0)[0][-1]]
+                if np.where(mpe_tmp != 0)[0].shape[0]==0 : continue
+                s = [np.where(mpe_tmp != 0)[0][0], np.where(mpe_tmp != 0)[0][-1]]
                 if s[0]==s[1]:continue
-                mpe_tmp = mpes.data[i,j]
                 mean = np.average(mpes.bin_centers[np.nonzero(mpe_tmp)],
                                   weights=mpe_tmp[np.nonzero(mpe_tmp)]) -prev_fit_result[j,1,0]
                 if mean < options.mean_range_for_mpe[0] or mean > options.mean_range_for_mpe[1] : continue
-                mpes_full.data[j]=mpes_full.data[j]+mpes.data[i,j]
+                mpes_full.data[j]=mpes_full.data[j]+mpe_tmp
             else:
 
-                mpes_full.data[j]=mpes_full.data[j]+mpes.data[i,j]
+                mpes_full.data[j]=mpes_full.data[j]+mpe_tmp
 
 
     mpes_full._compute_errors()
@@ -108,6 +109,7 @@ def perform_analysis(options):
         - 'output_directory' : the directory in which the histogram will be saved (str)
         - 'histo_filename'   : the name of the file containing the histogram
                                                  whose fit contains the gain,sigmas etc...(str)
+        - 'batch_fit'        : (optional) fit all the pixels together              (bool)
 
     :return:
     """
@@ -140,8 +142,12 @@ def perform_analysis(options):
     reduced_bounds = lambda *args,config=None, **kwargs: fit_full_mpe.bounds_func(*args,n_peaks = n_peak, config=config, **kwargs)
     reduced_p0 = lambda *args,config=None, **kwargs: fit_full_mpe.p0_func(*args,n_peaks = n_peak, config=config, **kwargs)
     reduced_slice = lambda *args, config=None, **kwargs: fit_full_mpe.slice_func(*args, n_peaks=n_peak, config=config, **kwargs)
+    batch_fit = hasattr(options, 'batch_fit') and options.batch_fit
     mpes_full.fit(fit_full_mpe.fit_func, reduced_p0, reduced_slice,
-                  reduced_bounds, config=prev_fit_result, labels_func=fit_full_mpe.label_func)#,limited_indices=(4,))
+                  reduced_bounds, config=prev_fit_result, labels_func=fit_full_mpe.label_func,
+                  jac_func=fit_full_mpe.jac_func, n_jobs=options.n_jobs if hasattr(options, 'n_jobs') else 1,
+                  batch_func=fit_full_mpe.batch_fit_func if batch_fit else None,
+                  batch_jac_func=fit_full_mpe.batch_jac_func)#,limited_indices=(4,))
 
 
     # get the bad fits
@@ -164,7 +170,8 @@ def perform_analysis(options):
                                                                                              config=config, **kwargs)
                 mpes_full.fit(fit_full_mpe.fit_func, reduced_p0, reduced_slice,
                               reduced_bounds, config=prev_fit_result ,limited_indices=(pix,),force_quiet=True,
-                              labels_func=fit_full_mpe.label_func)
+                              labels_func=fit_full_mpe.label_func, jac_func=fit_full_mpe.jac_func,
+                              warm_start=True)
                 i-=1
 
         if np.isnan(pix_fit_result[0,1]) and not np.isnan(pix_fit_result[0,0]):
@@ -178,7 +185,8 @@ def perform_analysis(options):
                                                                                              config=config, **kwargs)
                 mpes_full.fit(fit_full_mpe.fit_func, reduced_p0, reduced_slice,
                               reduced_bounds, config=prev_fit_result ,limited_indices=(pix,),force_quiet=True,
-                              labels_func=fit_full_mpe.label_func)
+                              labels_func=fit_full_mpe.label_func, jac_func=fit_full_mpe.jac_func,
+                              warm_start=True)
                 i-=1
 
 
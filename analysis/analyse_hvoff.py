@@ -56,6 +56,8 @@ def perform_analysis(options):
     :param options: a dictionary containing at least the following keys:
         - 'output_directory' : the directory in which the histogram will be saved (str)
         - 'histo_filename'   : the name of the file containing the histogram      (str)
+        - 'n_jobs'           : (optional) the number of processes for the fit     (int)
+        - 'batch_fit'        : (optional) fit all the pixels together              (bool)
 
     :return:
     """
@@ -65,8 +67,11 @@ def perform_analysis(options):
 
     # Fit the baseline and sigma_e of all pixels
     #TODO include the limited indicie
+    batch_fit = hasattr(options, 'batch_fit') and options.batch_fit
     adcs.fit(fit_hv_off.fit_func, fit_hv_off.p0_func, fit_hv_off.slice_func, fit_hv_off.bounds_func, \
-            labels_func=fit_hv_off.labels_func)#, limited_indices=tuple(options.pixel_list))
+            labels_func=fit_hv_off.labels_func, jac_func=fit_hv_off.jac_func,
+             n_jobs=options.n_jobs if hasattr(options, 'n_jobs') else 1,
+             batch_func=fit_hv_off.batch_fit_func if batch_fit else None, batch_jac_func=fit_hv_off.batch_jac_func)#, limited_indices=tuple(options.pixel_list))
     #adcs.fit(fit_2_gaussian.fit_func, fit_2_gaussian.p0_func, fit_2_gaussian.slice_func, fit_2_gaussian.bounds_func, \
     #         labels_func=fit_2_gaussian.label_func)#, limited_indices=tuple(options.pixel_list))
 
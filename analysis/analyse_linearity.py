@@ -10,6 +10,7 @@ import numpy as np
 import logging
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
+from utils.integrator import window_sum, max_run_sum
 import matplotlib.pyplot as plt
 
 from ctapipe import visualization
@@ -45,41 +46,6 @@ def create_histo(options):
     window_width = options.window_width
     window_start = options.window_start
 
-    def integrate_trace(d):
-        return np.convolve(d, np.ones((window_width), dtype=int), 'valid')
-
-    def contiguous_regions(data):
-        """Finds contiguous True regions of the boolean array "condition". Returns
-        a 2D array where the first column is the start index of the region and the
-        second column is the end index."""
-        condition = data > 0
-        # Find the indicies of changes in "condition"
-        d = np.diff(condition)
-        idx, = d.nonzero()
-
-        # We need to start things after the change in "condition". Therefore,
-        # we'll shift the index by 1 to the right.
-        idx += 1
-
-        if condition[0]:
-            # If the start of condition is True prepend a 0
-            idx = np.r_[0, idx]
-
-        if condition[-1]:
-            # If the end of condition is True, append the length of the array
-            idx = np.r_[idx, condition.size]  # Edit
-
-        # Reshape the result into two columns
-        idx.shape = (-1, 2)
-        val = 0.
-        for start, stop in idx:
-            sum_tmp = np.sum(data[start:stop])
-            if val < sum_tmp: val = sum_tmp
-        return val
-
-
-    integrate_trace_n = lambda x: integrate_trace(x, options.window_width)
-
     ## Create fake peak position and max window
     peak_positions = np.zeros((pulse_shape.data[20,...].shape[0],pulse_shape.data[20,...].shape[1]+1),dtype = float)
     for k in range(peak_positions.shape[1]):
@@ -111,7 +77,7 @@ def create_histo(options):
         data_sat[data_sat[max_idx] < options.threshold_sat] = 0.
         data_int[data_int[max_idx] >= options.threshold_sat] = 0.
 
-        integration = np.apply_along_axis(integrate_trace, 1, data_int)
+        integration = window_sum(data_int, window_width)
         local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
         local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
         ind_max_at_edge = (local_max == local_max_edge)
@@ -122,7 +88,7 @@ def create_histo(options):
         index_max = (np.arange(0, data_int.shape[0]), local_max,)
         full_integration = integration[index_max]
         # now deal with saturated ones:
-        sat_integration = np.apply_along_axis(contiguous_regions, 1, data_sat)
+        sat_integration = max_run_sum(data_sat)
         full_integration = full_integration + sat_integration #- baseline[level, :]
         hist.fill(full_integration, indices=(level,))
 
@@ -134,36 +100,28 @@ def perform_analysis(options):
 
     pulse_shape = histogram.Histogram(filename=options.output_directory + options.histo_filename)
 
-    def integrate_trace(d, window_width):
-
-        integrated_trace = np.convolve(d, np.ones((window_width), dtype=int), 'same')
-
-        return integrated_trace
-
-    integrate_trace_n = lambda x: integrate_trace(x, options.window_width)
-
     log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
     pbar = tqdm(total=pulse_shape.data.shape[0])
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
 
-    for level in range(pulse_shape.data.shape[0]):
+    data, errors, fit_result = pulse_shape.data, pulse_shape.errors, pulse_shape.fit_result
+    for level in range(data.shape[0]):
 
         log.debug('--|> Moving to AC level %d [DAC]' %options.scan_level[level])
 
-        for pixel in range(pulse_shape.data.shape[1]):
-
-            pulse_shape.data[level, pixel] = np.apply_along_axis(integrate_trace_n, -1, pulse_shape.data[level, pixel])
-            pulse_shape.errors[level, pixel] = np.sqrt(np.apply_along_axis(integrate_trace_n, -1, pulse_shape.errors[level, pixel]**2))
-            pulse_shape.fit_result[level, pixel, 0, 0] = np.max(pulse_shape.data[level, pixel])
-            pulse_shape.fit_result[level, pixel, 0, 1] = pulse_shape.errors[level, pixel, np.argmax(pulse_shape.data[level, pixel])]
-            pulse_shape.fit_result[level, pixel, 1, 0] = np.sum(pulse_shape.data[level, pixel])
-            pulse_shape.fit_result[level, pixel, 1, 1] = np.sqrt(np.sum(pulse_shape.errors[level, pixel]**2))
-            pulse_shape.fit_result[level, pixel, 2, 0] = np.sum(pulse_shape.data[level, pixel]**2)
-            pulse_shape.fit_result[level, pixel, 2, 1] = 0.
-            pulse_shape.fit_result[level, pixel, 3, 0] = np.sum(pulse_shape.data[level, pixel] / pulse_shape.fit_result[level, pixel, 0, 0])
-            pulse_shape.fit_result[level, pixel, 3, 1] = 0.
-            pulse_shape.fit_result[level, pixel, 4, 0] = np.sum((pulse_shape.data[level, pixel] / pulse_shape.fit_result[level, pixel, 0, 0])**2)
-            pulse_shape.fit_result[level, pixel, 4, 1] = 0.
+        # the sums of window_width samples around each sample of all the pixels (np.convolve 'same' mode)
+        window_sum(data[level], options.window_width, out=data[level], mode='same')
+        errors[level] = np.sqrt(window_sum(errors[level]**2, options.window_width, mode='same'))
+        fit_result[level, :, 0, 0] = np.max(data[level], axis=-1)
+        fit_result[level, :, 0, 1] = errors[level, np.arange(data.shape[1]), np.argmax(data[level], axis=-1)]
+        fit_result[level, :, 1, 0] = np.sum(data[level], axis=-1)
+        fit_result[level, :, 1, 1] = np.sqrt(np.sum(errors[level]**2, axis=-1))
+        fit_result[level, :, 2, 0] = np.sum(data[level]**2, axis=-1)
+        fit_result[level, :, 2, 1] = 0.
+        fit_result[level, :, 3, 0] = np.sum(data[level] / fit_result[level, :, 0, 0, None], axis=-1)
+        fit_result[level, :, 3, 1] = 0.
+        fit_result[level, :, 4, 0] = np.sum((data[level] / fit_result[level, :, 0, 0, None])**2, axis=-1)
+        fit_result[level, :, 4, 1] = 0.
 
         pbar.update(1)
 
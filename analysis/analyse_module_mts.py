@@ -11,6 +11,10 @@ import logging,sys
 import matplotlib.pyplot as plt
 import scipy.stats
 from analysis.analyse_dark import compute_dark_parameters
+from utils.event_batch import zfits_batch_reader
+from utils.event_consumers import ADCConsumer, PeakPositionConsumer, ChargeConsumer, PulseShapeConsumer, \
+    BaselineConsumer, fill_single_pass
+from utils.baseline import BaselineTracker
 import numpy as np
 
 __all__ = ["create_histo", "perform_analysis", "display_results"]
@@ -34,6 +38,11 @@ def create_histo(options):
         - 'adcs_min'         : the minimum adc value in histo                     (int)
         - 'adcs_max'         : the maximum adc value in histo                     (int)
         - 'adcs_binwidth'    : the bin width for the adcs histo                   (int)
+        - 'single_pass'      : (optional) fill all the products of a set of files from the same
+                               read of the files, see _fill_shared_reads (default False)
+                                                                                  (bool)
+        - 'synch_histo_filename' : (optional) the synch histogram of a previous run, its peak
+                               positions being used with single_pass              (str)
 
     :return:
     """
@@ -68,6 +77,12 @@ def create_histo(options):
                                bin_width=options.adcs_binwidth, data_shape=(len(options.pixel_list),),
                                label='Synch',xlabel='time sample',ylabel = 'entries')
 
+    if hasattr(options, 'single_pass') and options.single_pass:
+        _fill_shared_reads(options, hv_off_histogram, dark_histogram, synch_histogram,
+                           {'low_light': low_light_histogram, 'medium_light': medium_light_histogram,
+                            'high_light': high_light_histogram}, log)
+        return
+
     # Fill HV_Off and Dark histo
     log.info('Filling HV off')
     options.file_basename = 'hv_low.%s.fits.fz'
@@ -110,6 +125,86 @@ def create_histo(options):
     return
 
 
+def _fill_shared_reads(options, hv_off_histogram, dark_histogram, synch_histogram, light_histograms, log):
+    """
+    Fill the histograms of create_histo, the products of a set of files being filled from the same blocks of
+    events:
+        - hv_low : HV off ADC histogram and baseline statistics
+        - dark   : dark ADC histogram and baseline statistics
+        - light  : charge histogram per level and mean pulse shape per level
+    The charges are extracted as by the 'integration' method of mpe_hist (see ChargeConsumer), which needs the
+    complete synch peak positions. With options.synch_histo_filename they are those of a previous run and each
+    of the 5 sets of files is read once. Otherwise the low_light files are read a first time for the synch peak
+    positions, 6 reads in total. Each product has its own per event baseline, as the separate fillers.
+
+    :param options: see create_histo, plus
+        - 'integration_method'       : (optional) the charge extraction, only 'integration' (default) is
+                                       supported                                        (str)
+        - 'window_width'             : the number of integrated samples                 (int)
+        - 'window_start'             : the number of samples of the window before the peak
+                                                                                        (int)
+        - 'baseline_per_event_limit' : (optional) the number of baseline samples (10) of the baseline
+                                       statistics and of the per event baseline (see BaselineTracker)
+                                                                                        (int)
+        - 'prev_fit_result'          : (optional) the HV off fit result, the synch maxima out of [40, 3000] ADC
+                                       above its baseline being put in the sample 0 as in synch_hist
+                                                                                        (np.array)
+    :param hv_off_histogram, dark_histogram, synch_histogram: the histograms of create_histo   (Histogram)
+    :param light_histograms: the charge histograms of create_histo per set of files    (dict)
+    :param log: the logger
+    :return:
+    """
+    integration_method = options.integration_method if hasattr(options, 'integration_method') else 'integration'
+    if integration_method != 'integration':
+        log.critical('The single pass filling only supports the integration method integration')
+        raise ValueError('Integration method %s not supported with single_pass' % integration_method)
+    batch_size = options.n_evt_per_batch if hasattr(options, 'n_evt_per_batch') else 1000
+    n_baseline = options.baseline_per_event_limit if hasattr(options, 'baseline_per_event_limit') else 10
+    n_levels = len(options.scan_level)
+    prev_fit_result = options.prev_fit_result if hasattr(options, 'prev_fit_result') else None
+
+    def batches(file_basename, max_events=None):
+        urls = [options.directory + file_basename % file for file in options.file_list]
+        return zfits_batch_reader(urls, batch_size, pixel_list=options.pixel_list, max_events=max_events)
+
+    for name, hist in (('hv_low', hv_off_histogram), ('dark', dark_histogram)):
+        log.info('Filling %s' % hist.label)
+        baseline = BaselineConsumer(n_baseline)
+        fill_single_pass(batches(name + '.%s.fits.fz'), [ADCConsumer(hist), baseline])
+        hist.save(options.output_directory + name + '.npz')
+        baseline.save(options.output_directory + name + '_baseline.npz')
+
+    pulse_shapes = {}
+    if hasattr(options, 'synch_histo_filename'):
+        # the synch peak positions of a previous run
+        log.info('Loading %s' % synch_histogram.label)
+        synch_histogram = histogram.Histogram(filename=options.output_directory + options.synch_histo_filename)
+    else:
+        # the synch peak positions, with the cuts of synch_hist
+        log.info('Filling %s' % synch_histogram.label)
+        pulse_shapes['low_light'] = PulseShapeConsumer(events_per_level=options.events_per_level, n_levels=n_levels)
+        synch = PeakPositionConsumer(synch_histogram, baseline_tracker=BaselineTracker.from_options(options))
+        if prev_fit_result is not None:
+            synch.baseline = prev_fit_result[..., 1, 0] / options.window_width
+            synch.min_amplitude, synch.max_amplitude = 40, 3000
+        fill_single_pass(batches('low_light.%s.fits.fz', max_events=n_levels * options.events_per_level),
+                         [synch, pulse_shapes['low_light']])
+        synch_histogram.save(options.output_directory + 'synch.npz')
+
+    for name, hist in light_histograms.items():
+        log.info('Filling %s' % hist.label)
+        consumers = [ChargeConsumer(hist, options.window_width, peak_positions=synch_histogram.data,
+                                    window_start=options.window_start,
+                                    baseline_tracker=BaselineTracker.from_options(options, n_first=2),
+                                    events_per_level=options.events_per_level, n_levels=n_levels)]
+        if name not in pulse_shapes:
+            pulse_shapes[name] = PulseShapeConsumer(events_per_level=options.events_per_level, n_levels=n_levels)
+            consumers.append(pulse_shapes[name])
+        fill_single_pass(batches(name + '.%s.fits.fz', max_events=n_levels * options.events_per_level), consumers)
+        hist.save(options.output_directory + name + '.npz')
+        pulse_shapes[name].save(options.output_directory + name + '_pulse_shape.npz')
+
+
 def perform_analysis(options):
     """
     Perform a simple gaussian fit of the ADC histograms
@@ -126,14 +221,15 @@ def perform_analysis(options):
 
     hv_off_histogram = histogram.Histogram(filename = options.output_directory + 'hv_low.npz')
     hv_off_histogram.fit(fit_hv_off.fit_func, fit_hv_off.p0_func, fit_hv_off.slice_func, fit_hv_off.bounds_func,
-             labels_func=fit_hv_off.labels_func)
+             labels_func=fit_hv_off.labels_func, jac_func=fit_hv_off.jac_func)
     hv_off_histogram.save(options.output_directory + 'hv_low.npz')
 
     # Analyse low_light
 
     low_light_histogram = histogram.Histogram(filename = options.output_directory + 'low_light.npz')
     low_light_histogram.fit(fit_low_light.fit_func, fit_low_light.p0_func, fit_low_light.slice_func,
-             fit_low_light.bounds_func, config=None, labels_func=fit_low_light.label_func)
+             fit_low_light.bounds_func, config=None, labels_func=fit_low_light.label_func,
+             jac_func=fit_low_light.jac_func)
     low_light_histogram.save(options.output_directory + 'low_light.npz')
 
     # Analyse dark
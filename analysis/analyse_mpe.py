@@ -5,7 +5,7 @@
 # internal modules
 from data_treatement import mpe_hist
 from spectra_fit import fit_low_light,fit_high_light
-from utils import display, histogram, geometry
+from utils import display, histogram, geometry, histogram_hdf5, stage_cache
 import logging,sys
 import numpy as np
 import logging
@@ -35,23 +35,50 @@ def create_histo(options):
         - 'adcs_min'         : the minimum adc value in histo                     (int)
         - 'adcs_max'         : the maximum adc value in histo                     (int)
         - 'adcs_binwidth'    : the bin width for the adcs histo                   (int)
+        - 'compact_histo'    : (optional) store the counts as uint32              (bool)
+        - 'adcs_window_min'  : (optional) the minimum adc value stored per level  (list(int))
+        - 'adcs_window_width': (optional) the adc range stored per level          (int)
+        - 'n_jobs_fill'      : (optional) the number of processes reading the files (int)
+
+    With a HDF5 histo_filename (*.h5), each level is written once filled and a scan interrupted by a crash is
+    resumed from its completed levels. The file records the options and the input files it is filled from: a
+    file filled from other ones is filled again
 
     :return:
     """
 
+    # Restrict the stored adc range of each level to [adcs_window_min, adcs_window_min + adcs_window_width[
+    bin_window = None
+    if hasattr(options, 'adcs_window_width'):
+        window_min = np.array(options.adcs_window_min, dtype=float).reshape(-1, 1)
+        bin_window = (((window_min - options.adcs_min) // options.adcs_binwidth).astype(int),
+                      int(options.adcs_window_width // options.adcs_binwidth))
+
     # Define the histograms
     mpes = histogram.Histogram(bin_center_min=options.adcs_min, bin_center_max=options.adcs_max,
                                bin_width=options.adcs_binwidth, data_shape=(len(options.scan_level),len(options.pixel_list),),
-                               label='MPE',xlabel='Peak ADC',ylabel = '$\mathrm{N_{entries}}$')
+                               label='MPE',xlabel='Peak ADC',ylabel = '$\mathrm{N_{entries}}$',
+                               compact=getattr(options, 'compact_histo', False), bin_window=bin_window)
 
     # Get the reference sampling time
     peaks = histogram.Histogram(filename = options.output_directory + options.synch_histo_filename)
 
+    # Resume from the levels already written
+    level_file = None
+    if histogram_hdf5.is_hdf5(options.histo_filename):
+        fingerprint = stage_cache.options_digest(options, ignored=('n_jobs_fill', 'n_evt_per_batch'))
+        level_file = histogram_hdf5.HistogramLevelFile(options.output_directory + options.histo_filename, mpes,
+                                                       fingerprint=fingerprint)
+        level_file.read_levels(mpes)
+
     # Construct the histogram
-    mpe_hist.run(mpes, options, peak_positions=peaks.data)
+    mpe_hist.run(mpes, options, peak_positions=peaks.data, level_file=level_file)
 
-    # Save the histogram
-    mpes.save(options.output_directory + options.histo_filename)
+    # Save the histogram, in its level file to keep its fingerprint
+    if level_file is not None:
+        level_file.write(mpes)
+    else:
+        mpes.save(options.output_directory + options.histo_filename)
 
     # Delete the histograms
     del mpes,peaks
@@ -72,7 +99,8 @@ def perform_analysis(options):
     """
     # Fit the baseline and sigma_e of all pixels
     mpes = histogram.Histogram(filename=options.output_directory + options.histo_filename)
-    nlevel = mpes.data.shape[0]
+    # the histogram may be stored with a bin window, avoid materialising the full data array
+    nlevel = mpes.underflow.shape[0]
     mpes_full = histogram.Histogram(filename=options.output_directory + options.full_histo_filename, fit_only= True)
     mpes_full_fit_result = np.copy(mpes_full.fit_result)
     dark = histogram.Histogram(filename=options.output_directory + options.dark_histo_filename, fit_only= True)
@@ -86,7 +114,7 @@ def perform_analysis(options):
     mpes_full_fit_result = mpes_full_fit_result.reshape((1,) + mpes_full_fit_result.shape)
     mpes_full_fit_result = np.repeat(mpes_full_fit_result, nlevel, axis=0)
     log = logging.getLogger(sys.modules['__main__'].__name__+__name__)
-    pbar = tqdm(total=mpes.data.shape[0]*mpes.data.shape[1])
+    pbar = tqdm(total=mpes.underflow.shape[0]*mpes.underflow.shape[1])
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
     def std_dev(x, y):
         if np.sum(y)<=0: return 0.
@@ -104,13 +132,16 @@ def perform_analysis(options):
         best_fit_level = 0#-1
 
         if pixel > 0: log.debug('Pixel #' + str(pixel - 1)+' treated')
-        for level in range(mpes.data.shape[0]):
+        for level in range(nlevel):
             pbar.update(1)
             if np.isnan(mpes_full_fit_result[0,pixel,0,0]): continue
-            if np.nonzero(mpes.data[level, pixel])[0].shape[0] == 1: continue
-            #if std_dev(mpes.bin_centers, mpes.data[level, pixel]) > 400: continue
-            if mpes.data[level, pixel, -1] > 0.02 * np.sum(mpes.data[level, pixel]): continue
-            if np.sum(mpes.data[level, pixel])<1e-8 or np.sum(mpes.data[level, pixel])<options.events_per_level/2:continue
+            level_data = mpes.get_data((level, pixel))
+            if np.nonzero(level_data)[0].shape[0] == 1: continue
+            #if std_dev(mpes.bin_centers, level_data) > 400: continue
+            # saturation: the charges beyond the last bin (or out of the bin window) are in the overflow
+            n_saturated = level_data[-1] + mpes.overflow[level, pixel]
+            if n_saturated > 0.02 * (np.sum(level_data) + mpes.overflow[level, pixel]): continue
+            if np.sum(level_data)<1e-8 or np.sum(level_data)<options.events_per_level/2:continue
             if _tmp_level!= level-1: continue
             #print(np.sum(mpes.data[level, pixel]),std_dev(mpes.bin_centers, mpes.data[level, pixel]))
             #print(mpes.data[level, pixel])
@@ -171,7 +202,8 @@ def perform_analysis(options):
                     ]
                 mpes.fit(_fit_spectra.fit_func, _fit_spectra.p0_func, _fit_spectra.slice_func,
                          _fit_spectra.bounds_func, config=mpes_full_fit_result, fixed_param=fixed_param
-                         , limited_indices=[(level, pixel,)], force_quiet=True, labels_func=_fit_spectra.label_func)
+                         , limited_indices=[(level, pixel,)], force_quiet=True, labels_func=_fit_spectra.label_func,
+                         jac_func=_fit_spectra.jac_func, warm_start=True)
                 successful=True
     mpes.save(options.output_directory + options.histo_filename)
 
@@ -10,6 +10,7 @@ import numpy as np
 import logging
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
+from utils.integrator import window_sum
 import matplotlib.pyplot as plt
 
 from ctapipe import visualization
@@ -64,36 +65,28 @@ def perform_analysis(options):
 
     pulse_shape = histogram.Histogram(filename=options.output_directory + options.histo_filename)
 
-    def integrate_trace(d, window_width):
-
-        integrated_trace = np.convolve(d, np.ones((window_width), dtype=int), 'same')
-
-        return integrated_trace
-
-    integrate_trace_n = lambda x: integrate_trace(x, options.window_width)
-
     log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
     pbar = tqdm(total=pulse_shape.data.shape[0])
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
 
-    for level in range(pulse_shape.data.shape[0]):
+    data, errors, fit_result = pulse_shape.data, pulse_shape.errors, pulse_shape.fit_result
+    for level in range(data.shape[0]):
 
         log.debug('--|> Moving to AC level %d [DAC]' %options.scan_level[level])
 
-        for pixel in range(pulse_shape.data.shape[1]):
-
-            pulse_shape.data[level, pixel] = np.apply_along_axis(integrate_trace_n, -1, pulse_shape.data[level, pixel])
-            pulse_shape.errors[level, pixel] = np.sqrt(np.apply_along_axis(integrate_trace_n, -1, pulse_shape.errors[level, pixel]**2))
-            pulse_shape.fit_result[level, pixel, 0, 0] = np.max(pulse_shape.data[level, pixel])
-            pulse_shape.fit_result[level, pixel, 0, 1] = pulse_shape.errors[level, pixel, np.argmax(pulse_shape.data[level, pixel])]
-            pulse_shape.fit_result[level, pixel, 1, 0] = np.sum(pulse_shape.data[level, pixel])
-            pulse_shape.fit_result[level, pixel, 1, 1] = np.sqrt(np.sum(pulse_shape.errors[level, pixel]**2))
-            pulse_shape.fit_result[level, pixel, 2, 0] = np.sum(pulse_shape.data[level, pixel]**2)
-            pulse_shape.fit_result[level, pixel, 2, 1] = 0.
-            pulse_shape.fit_result[level, pixel, 3, 0] = np.sum(pulse_shape.data[level, pixel] / pulse_shape.fit_result[level, pixel, 0, 0])
-            pulse_shape.fit_result[level, pixel, 3, 1] = 0.
-            pulse_shape.fit_result[level, pixel, 4, 0] = np.sum((pulse_shape.data[level, pixel] / pulse_shape.fit_result[level, pixel, 0, 0])**2)
-            pulse_shape.fit_result[level, pixel, 4, 1] = 0.
+        # the sums of window_width samples around each sample of all the pixels (np.convolve 'same' mode)
+        window_sum(data[level], options.window_width, out=data[level], mode='same')
+        errors[level] = np.sqrt(window_sum(errors[level]**2, options.window_width, mode='same'))
+        fit_result[level, :, 0, 0] = np.max(data[level], axis=-1)
+        fit_result[level, :, 0, 1] = errors[level, np.arange(data.shape[1]), np.argmax(data[level], axis=-1)]
+        fit_result[level, :, 1, 0] = np.sum(data[level], axis=-1)
+        fit_result[level, :, 1, 1] = np.sqrt(np.sum(errors[level]**2, axis=-1))
+        fit_result[level, :, 2, 0] = np.sum(data[level]**2, axis=-1)
+        fit_result[level, :, 2, 1] = 0.
+        fit_result[level, :, 3, 0] = np.sum(data[level] / fit_result[level, :, 0, 0, None], axis=-1)
+        fit_result[level, :, 3, 1] = 0.
+        fit_result[level, :, 4, 0] = np.sum((data[level] / fit_result[level, :, 0, 0, None])**2, axis=-1)
+        fit_result[level, :, 4, 1] = 0.
 
         pbar.update(1)
 
@@ -63,6 +63,7 @@ def perform_analysis(options):
         - 'output_directory' : the directory in which the histogram will be saved (str)
         - 'histo_filename'   : the name of the file containing the histogram      (str)
         - 'hv_off_histo_filename' : the name of the hv_off fit results            (str)
+        - 'n_jobs'           : (optional) the number of processes for the fit     (int)
 
     :return:
     """
@@ -80,24 +81,11 @@ def perform_analysis(options):
     p0_fun = lambda *args, **kwargs : fit_full_mpe.p0_func(*args, n_peaks = 6,**kwargs )
     bound_fun = lambda *args, **kwargs : fit_full_mpe.bounds_func(*args, n_peaks = 6,**kwargs )
     adcs.fit(fit_full_mpe.fit_func,p0_fun , fit_full_mpe.slice_func,
-                bound_fun, config=hv_off_fit.fit_result, labels_func=fit_full_mpe.label_func, force_quiet=True)
+                bound_fun, config=hv_off_fit.fit_result, labels_func=fit_full_mpe.label_func, force_quiet=True,
+             jac_func=fit_full_mpe.jac_func, n_jobs=options.n_jobs if hasattr(options, 'n_jobs') else 1,
+             warm_start=True)
 
-    # get the bad fits
-
-    log.info(' |--|>Try to correct the pixels with wrong fit results ')
-    for pix,pix_fit_result in enumerate(adcs.fit_result):
-        if np.isnan(pix_fit_result[0,1]) and not np.isnan(pix_fit_result[0,0]):
-            log.debug('Pixel %d refit',pix)
-            i = 5
-            while  np.isnan(adcs.fit_result[pix,0,1]) and i > 1:
-                reduced_bounds = lambda *args, config=None, **kwargs: fit_full_mpe.bounds_func(*args, n_peaks = i ,
-                                                                                             config=config, **kwargs)
-                reduced_p0 = lambda *args, config=None, **kwargs: fit_full_mpe.p0_func(*args, n_peaks = i , config=config,
-                                                                                       **kwargs)
-                adcs.fit(fit_full_mpe.fit_func, reduced_p0, fit_full_mpe.slice_func,
-                              reduced_bounds, config= hv_off_fit.fit_result,
-                         labels_func=fit_full_mpe.label_func, limited_indices=(pix,),force_quiet=True)
-                i-=1
+    # get the bad fits (a failed warm started fit is already redone from p0_func by Histogram.fit)
 
     for pix,pix_fit_result in enumerate(adcs.fit_result):
         if np.isnan(pix_fit_result[0,1]) and not np.isnan(pix_fit_result[0,0]):
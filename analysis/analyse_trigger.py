@@ -34,6 +34,8 @@ def create_histo(options):
         - 'adcs_min'         : the minimum adc value in histo                     (int)
         - 'adcs_max'         : the maximum adc value in histo                     (int)
         - 'adcs_binwidth'    : the bin width for the adcs histo                   (int)
+        - 'n_jobs_fill'      : (optional) the number of processes the NSB levels are
+                               processed in, < 1 for all cpus (default 1)         (int)
     :return:
     """
 
@@ -65,13 +67,14 @@ def create_histo(options):
 
 
     #trigger_spectrum = trigger.run(triggers, options=options)
-    trigger.run(triggers, options=options, cluster_hist=cluster_hist, patch_hist=patch_hist, max_cluster_hist=max_cluster_hist, time_cluster_hist=time_cluster_hist)
+    cluster_max, cluster_max_time, cluster_max_sector = trigger.run(triggers, options=options, cluster_hist=cluster_hist, patch_hist=patch_hist, max_cluster_hist=max_cluster_hist, time_cluster_hist=time_cluster_hist)
     triggers.save(options.output_directory + options.histo_filename)
     cluster_hist.save(options.output_directory + options.cluster_histo_filename)
     patch_hist.save(options.output_directory + options.patch_histo_filename)
     #max_cluster_hist.save(options.output_directory + options.max_cluster_histo_filename)
 
-    np.savez(options.output_directory + options.max_cluster_histo_filename, hist_max=max_cluster_hist, hist_time=time_cluster_hist)
+    np.savez(options.output_directory + options.max_cluster_histo_filename, hist_max=max_cluster_hist, hist_time=time_cluster_hist,
+             cluster_max=cluster_max, cluster_max_time=cluster_max_time, cluster_max_sector=cluster_max_sector)
 
     return
 
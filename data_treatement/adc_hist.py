@@ -1,6 +1,6 @@
 import numpy as np
 from ctapipe.io import zfits
-from utils.peakdetect import spe_peaks_in_event_list
+from utils.peakdetect import spe_peaks
 from utils.toy_reader import ToyReader
 import logging
 import sys
@@ -16,7 +16,61 @@ from ctapipe.io import zfits
 
 from utils.event_iterator import EventCounter
 from utils.histogram import Histogram
-from utils.peakdetect import spe_peaks_in_event_list
+from utils.peakdetect import spe_peaks
+from utils.baseline import BaselineTracker, EventBlock
+from utils.integrator import window_sum
+
+
+def _baseline_tracker(options, h_type):
+    """
+    The per event baseline tracker, with no rms cut when evaluating the baseline parameters (MEANRMS)
+    :param options: configuration container        (yaml container)
+    :param h_type: type of Histogram to produce    (str)
+    :return: the tracker or None                   (BaselineTracker)
+    """
+    if not hasattr(options, 'baseline_per_event_limit'):
+        return None
+    if h_type == 'MEANRMS':
+        return BaselineTracker(options.baseline_per_event_limit)
+    return BaselineTracker.from_options(options)
+
+
+def _treat_block(block, batch, mean_rms, h_type, baseline_tracker, baseline, options):
+    """
+    Subtract the baseline of a block of events and put their window sums in the batch, or for MEANRMS put the
+    mean and rms of their baseline samples in mean_rms
+    :param block: the events, their slot being their index in the batch (in mean_rms for MEANRMS)
+                                                   (EventBlock)
+    :param batch: the batch                        (ndarray)
+    :param mean_rms: the mean and rms of each pixel and event (MEANRMS)
+                                                   (ndarray)
+    :param h_type, baseline: see run
+    :param baseline_tracker: the per event baseline tracker (BaselineTracker)
+    :param options: configuration container        (yaml container)
+    :return:
+    """
+    if len(block) == 0:
+        return
+    data, slots = block.pop()
+    # Treat the case where the baseline is computed from the event itself and is not known
+    if baseline_tracker is not None and baseline is None:
+        if h_type == 'MEANRMS':
+            # Case where we want to evaluate the baseline parameters
+            baseline_tracker.update(data)
+            mean_rms[0][..., slots] = baseline_tracker.mean.T
+            mean_rms[1][..., slots] = baseline_tracker.rms.T
+        else:
+            # Case where the baseline parameters have been evaluated already: the baseline is only
+            # updated for the pixels with no large fluctuation in the baseline samples
+            data = baseline_tracker.subtract(data)
+    # Treat the case where the baseline has been specified
+    elif baseline is not None:
+        data = data - baseline[:, None]
+
+    # For all h_type except MEANRMS, update the batch
+    if not h_type == 'MEANRMS':
+        batch[:, slots, :] = window_sum(data[..., options.baseline_per_event_limit:-1],
+                                        options.window_width).transpose(1, 0, 2)
 
 
 def batch_reset(n_batch, shape, options):
@@ -57,13 +111,11 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
         options.window_width = 1
 
     # Get the baseline parameters if running in per event baseline subtraction mode
-    params = None
-    if hasattr(options, 'baseline_per_event_limit') and not h_type == 'MEANRMS':
-        params = Histogram(filename=options.output_directory + options.baseline_param_data, fit_only=True)
-
-    # Define the integration function
-    def integrate_trace(d):
-        return np.convolve(d, np.ones(options.window_width, dtype=int), 'valid')
+    baseline_tracker = _baseline_tracker(options, h_type)
+    # the events not treated yet, the baseline being subtracted once per block
+    block = EventBlock()
+    # The SPE peak selection, 'peakdetect' (default) or 'local_maximum' see utils.peakdetect.spe_peaks
+    peak_selection = options.peak_selection if hasattr(options, 'peak_selection') else 'peakdetect'
 
     # Start the logging
     log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
@@ -75,7 +127,6 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
     # Batch counters
     # TODO fold it in the event counter
     # n_batch, batch_num, batch = options.n_evt_per_batch if hasattr(options,'n_evt_per_batch') else -1, 0, None
-    _tmp_baseline = None
 
     # Loop over the input files
     for file in options.file_list:
@@ -104,12 +155,13 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
                 # Update whenever batch size is filled
                 if counter.batch_fill:
                     log.debug('Treating the batch #%d' % counter.batch_id)
+                    _treat_block(block, batch, hist.data, h_type, baseline_tracker, baseline, options)
                     # Fill the necessary histo with batch
                     if h_type == 'ADC':
                         hist.fill_with_batch(batch.reshape(batch.shape[0], batch.shape[1] * batch.shape[2]))
                     elif h_type == 'SPE':
-                        hist.fill_with_batch(
-                            spe_peaks_in_event_list(batch, prev_fit_result[:, 1, 0], prev_fit_result[:, 2, 0]))
+                        peaks = spe_peaks(batch, prev_fit_result[:, 1, 0], prev_fit_result[:, 2, 0], selection=peak_selection)
+                        hist.fill_with_index(peaks.pixel, peaks.amplitude)
                     else :
                         pass
                     # Reset the batch
@@ -119,45 +171,15 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
                 if counter.event_id == 0:  # TODO Check if it should not be 1
                     batch = batch_reset(counter.batch_size, data.shape, options)
 
-                # Treat the case where the baseline is computed from the event itself and is not known
-                if hasattr(options, 'baseline_per_event_limit') and baseline is None:
-                    # Get the mean and std deviations
-                    _baseline = np.mean(data[..., 0:options.baseline_per_event_limit], axis=-1)
-                    _rms = np.std(data[..., 0:options.baseline_per_event_limit], axis=-1)
-                    if h_type == 'MEANRMS':
-                        # Case where we want to evaluate the baseline parameters
-                        hist.data[0, ..., counter.event_id] = _baseline
-                        hist.data[1, ..., counter.event_id] = _rms
-
-                    elif params is not None:
-                        # Case where the baseline parameters have been evaluated already
-
-                        # Get the pixel for which the rms is good, ie. there have been no huge fluctuation in the
-                        # samples in which it was evaluated
-                        ind_good_baseline = (_rms - params[:, 2]) / params[:, 3] < 0.5
-                        # If at least one event was computed, only update the previous baseline for the pixel with no
-                        # large fluctuations
-                        if counter.event_id > 0:
-                            _tmp_baseline[ind_good_baseline] = _baseline[ind_good_baseline]
-                        else:
-                            _tmp_baseline = _baseline
-                        # Subtract the baseline
-                        data = data - _tmp_baseline[:, None]
-                # Treat the case where the baseline has been specified
-                elif baseline is not None:
-                    data = data - baseline[:, None]
-
-                # For all h_type except MEANRMS, update the batch
-                if not h_type == 'MEANRMS':
-                    batch[:, counter.event_id % n_batch, :] = np.apply_along_axis(integrate_trace, -1,
-                                                                                  data[...,
-                                                                                  options.baseline_per_event_limit:-1])
+                # the events are treated when the batch is filled
+                block.append(data, counter.event_id if h_type == 'MEANRMS' else counter.event_id % n_batch)
                 '''
                 # TODO Check what was the use for this :
                 else:
                     hist.fill_with_batch(data)
                 '''
 
+    _treat_block(block, batch, hist.data, h_type, baseline_tracker, baseline, options)
     return
 
 
@@ -173,27 +195,18 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
     log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
     # Reading the file
     n_evt, n_batch, batch_num, max_evt = 0, options.n_evt_per_batch, 0, options.evt_max
-    _tmp_baseline = None
     batch = None
 
     if not options.mc:
         log.info('Running on DigiCam data')
     else:
         log.info('Running on MC data')
-    params=None
-    if hasattr(options, 'baseline_per_event_limit') and not h_type=='MEANRMS':
-
-        params = np.load(options.output_directory + options.baseline_param_data)['params']
-        #print(params)
-        #print(params.keys())
-        #print(params[:, 1])
-        #print(params[:, 2])
-        #print(params[:, 3])
+    baseline_tracker = _baseline_tracker(options, h_type)
+    peak_selection = options.peak_selection if hasattr(options, 'peak_selection') else 'peakdetect'
+    # the events not treated yet, the baseline being subtracted once per block
+    block = EventBlock()
 
 
-    def integrate_trace(d):
-        return np.convolve(d, np.ones((options.window_width), dtype=int), 'valid')
-
     pbar = tqdm(total=max_evt)
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
 
@@ -229,14 +242,16 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
 
                 if n_evt % n_batch == 0:
                     log.debug('Treating the batch #%d of %d events' % (batch_num, n_batch))
+                    if hasattr(options, 'window_width'):
+                        _treat_block(block, batch, hist, h_type, baseline_tracker, baseline, options)
                     # Update adc histo
                     if h_type == 'ADC':
                         #print(batch[0,0])
                         pass
                         #hist.fill_with_batch(batch.reshape(batch.shape[0], batch.shape[1] * batch.shape[2]))
                     elif h_type == 'SPE':
-                        hist.fill_with_batch(
-                            spe_peaks_in_event_list(batch, prev_fit_result[:, 1, 0], prev_fit_result[:, 2, 0]))
+                        peaks = spe_peaks(batch, prev_fit_result[:, 1, 0], prev_fit_result[:, 2, 0], selection=peak_selection)
+                        hist.fill_with_index(peaks.pixel, peaks.amplitude)
                     # Reset the batch
                     if hasattr(options, 'window_width'):
                         batch = np.zeros((data.shape[0], n_batch, data.shape[1] - options.window_width + 1), dtype=int)
@@ -259,35 +274,8 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
                     else:
                         batch = np.zeros((data.shape[0], n_batch, data.shape[1]),dtype=int)
                 if hasattr(options,'window_width'):
-                    #print('hello')
-                    if hasattr(options, 'baseline_per_event_limit') and baseline is None:
-                        #print('hello')
-                        _baseline = np.mean(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        _rms = np.std(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        if h_type == 'MEANRMS':
-                            hist[0][...,n_evt-1]=_baseline
-                            hist[1][...,n_evt-1]=_rms
-                        # get the indices where baseline is good
-                        #print('hello')
-
-                        if params is not None:
-
-                            ind_good_baseline = (_rms - params[:,2])/params[:,3] < 0.5
-                            #print(params[:,2])
-                            if n_evt > 1:
-                                _tmp_baseline[ind_good_baseline] = _baseline[ind_good_baseline]
-                                #_tmp_baseline[~ind_good_baseline] = 10000
-
-                            else:
-                                _tmp_baseline = _baseline
-                            #_tmp_baseline = baseline
-                            data = data - _tmp_baseline[:, None]
-                    elif baseline is not None:
-                        data = data - baseline[:, None]
-                    if not  h_type == 'MEANRMS':
-                        batch[:,n_evt%n_batch,:]=np.apply_along_axis(integrate_trace,-1,data[...,options.baseline_per_event_limit:-1])
-                        #print(batch[:,n_evt%n_batch][1])
-                        #print(batch.shape,n_evt%n_batch)
+                    # the events are treated when the batch is filled
+                    block.append(data, n_evt - 1 if h_type == 'MEANRMS' else n_evt % n_batch)
 
                 else:
                     #print(np.sum(np.sum(data, axis=0), axis=0))
@@ -295,4 +283,6 @@ def run(hist, options, h_type='ADC', prev_fit_result=None, baseline=None):
                     #print(data.shape)
                     hist.fill_with_batch(data)
 
+    if hasattr(options, 'window_width'):
+        _treat_block(block, batch, hist, h_type, baseline_tracker, baseline, options)
     return
@@ -5,6 +5,7 @@ import logging,sys
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
 from utils.toy_reader import ToyReader
+from utils.integrator import window_sum, max_run_sum
 import matplotlib.pyplot as plt
 
 # noinspection PyProtectedMember
@@ -64,37 +65,7 @@ def run(hist, options, peak_positions=None, prev_fit_result= None):
             #mask_window = np.append(mask_window,np.zeros((mask_window.shape[0],missing),dtype=bool),axis=1)
             #mask_windows_edge = np.append(mask_windows_edge,np.zeros((mask_windows_edge.shape[0],missing),dtype=bool),axis=1)
             print(shift)
-    def integrate_trace(d):
-        return np.convolve(d, np.ones((window_width), dtype=int), 'valid')
-
-    def contiguous_regions(data):
-        """Finds contiguous True regions of the boolean array "condition". Returns
-        a 2D array where the first column is the start index of the region and the
-        second column is the end index."""
-        condition = data>0
-        # Find the indicies of changes in "condition"
-        d = np.diff(condition)
-        idx, = d.nonzero()
-
-        # We need to start things after the change in "condition". Therefore,
-        # we'll shift the index by 1 to the right.
-        idx += 1
-
-        if condition[0]:
-            # If the start of condition is True prepend a 0
-            idx = np.r_[0, idx]
-
-        if condition[-1]:
-            # If the end of condition is True, append the length of the array
-            idx = np.r_[idx, condition.size]  # Edit
-
-        # Reshape the result into two columns
-        idx.shape = (-1, 2)
-        val = 0.
-        for start, stop in idx:
-            sum_tmp = np.sum( data[start:stop])
-            if val < sum_tmp: val = sum_tmp
-        return val
+
 
     plt.figure()
     plt.ion()
@@ -147,7 +118,7 @@ def run(hist, options, peak_positions=None, prev_fit_result= None):
                     index_max = (np.arange(0, data[0].shape[0]), peak,)
                     hist.fill(data[0][index_max])
                 elif charge_extraction == 'integration':
-                    integration = np.apply_along_axis(integrate_trace,1,data[0])
+                    integration = window_sum(data[0], window_width)
                     local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
                     local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
                     ind_max_at_edge = (local_max == local_max_edge)
@@ -177,9 +148,10 @@ def run(hist, options, peak_positions=None, prev_fit_result= None):
                     input('press')
                     '''
                 elif charge_extraction == 'local_max':
-                    cum_sum_trace1 = data[0].cumsum(axis=-1)
-                    cum_sum_trace1[..., 3:] = (cum_sum_trace1[..., 3:] - cum_sum_trace1[..., :-3])
-                    cum_sum_trace1 = np.append(cum_sum_trace1[..., 1:], np.zeros((data[0].shape[0], 1,)), axis=1)
+                    # sum of the 3 samples centred on each sample (a partial window at the trace start, 0 at its end)
+                    cum_sum_trace1 = np.zeros(data[0].shape)
+                    window_sum(data[0], 3, out=cum_sum_trace1[..., 1:-1])
+                    cum_sum_trace1[..., 0] = data[0][..., 0] + data[0][..., 1]
                     local_max = np.argmax(np.multiply(cum_sum_trace1, mask_window), axis=1)
                     local_max_edge = np.argmax(np.multiply(cum_sum_trace1, mask_windows_edge), axis=1)
                     ind_max_at_edge = (local_max == local_max_edge)
@@ -198,7 +170,7 @@ def run(hist, options, peak_positions=None, prev_fit_result= None):
                     data_sat[ data_sat[max_idx] < (options.threshold_sat - prev_fit_result[:,1,0])] = 0.
                     data_int[ data_int[max_idx] >= (options.threshold_sat - prev_fit_result[:,1,0])] = 0.
 
-                    integration = np.apply_along_axis(integrate_trace,1,data_int)
+                    integration = window_sum(data_int, window_width)
                     local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
                     local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
                     ind_max_at_edge = (local_max == local_max_edge)
@@ -209,7 +181,7 @@ def run(hist, options, peak_positions=None, prev_fit_result= None):
                     index_max = (np.arange(0, data_int.shape[0]), local_max,)
                     full_integration = integration[index_max]
                     # now deal with saturated ones:
-                    sat_integration = np.apply_along_axis(contiguous_regions, 1, data_sat)
+                    sat_integration = max_run_sum(data_sat)
                     full_integration = full_integration + sat_integration
                     hist.fill(full_integration)
                     '''
@@ -10,7 +10,7 @@ from iminuit import Minuit
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from utils.event_iterator import EventCounter
-from data_treatement.timing import compute_time
+from data_treatement.timing import compute_times, timing_estimator
 
 
 def run(options):
@@ -27,6 +27,7 @@ def run(options):
     event_counter = EventCounter(options.min_event, options.max_event, options.scan_level[0], options.scan_level[-1], options.events_per_level, options.events_per_level_in_file, log)
 
     cosmic_info = []
+    estimator = timing_estimator(options)
 
     for file in options.file_list:
         # Open the file
@@ -70,10 +71,9 @@ def run(options):
 
                 event_info = {'event_id': counter.event_id, 'time': np.zeros(len(pixel_list)), 'charge': np.zeros(len(pixel_list)), 'pixel': pixel_list}
 
-                for pixel_id, pixel_soft_id in enumerate(pixel_list):
-                    fit_result = compute_time(data[pixel_id], time, errors, options, pixel_soft_id)
-                    event_info['time'][pixel_id] = fit_result[0]
-                    event_info['charge'][pixel_id] = fit_result[1]
+                fit_results = compute_times(data, time, errors, options, pixel_list, estimator)
+                event_info['time'] = fit_results[:, 0]
+                event_info['charge'] = fit_results[:, 1]
 
                 cosmic_info.append(event_info)
 
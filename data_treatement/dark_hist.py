@@ -1,6 +1,7 @@
 import numpy as np
 from ctapipe.io import zfits
 from utils.mc_events_reader import hdf5_mc_event_source
+from utils.event_batch import EventBatchReader
 import logging
 import sys
 import peakutils
@@ -19,9 +20,6 @@ def run(hist, options, hist_type):
     :return:
     """
     log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
-    # Reading the file
-    event_number = 0
-
     if not options.mc:
         log.info('Running on DigiCam data')
     else:
@@ -29,57 +27,46 @@ def run(hist, options, hist_type):
 
     pbar = tqdm(total=options.max_event-options.min_event)
 
-    for file in options.file_list:
-        # Open the file
-        _url = options.directory + options.file_basename % file
-
-        if not options.mc:
-            inputfile_reader = zfits.zfits_event_source(url=_url, max_events=options.max_event)  #TODO data_type arg does not exist anymore
-        else:
-            #inputfile_reader = ToyReader(filename=_url, id_list=[0],
-            #                             max_events=options.max_event,
-            #                             n_pixel=options.n_pixels, events_per_level=options.events_per_level)
-
-            inputfile_reader = hdf5_mc_event_source(url=_url, events_per_dc_level=options.dc_step, events_per_ac_level=options.ac_step, dc_start=options.dc_start, ac_start=options.ac_start, max_events=options.max_event)
-
-
-        log.debug('--|> Moving to file %s' % _url)
-        # Loop over event in this file
-        for event in inputfile_reader:
+    def event_sources():
+        for file in options.file_list:
+            # Open the file
+            _url = options.directory + options.file_basename % file
 
-            if event_number > options.max_event:
-                break
+            if not options.mc:
+                inputfile_reader = zfits.zfits_event_source(url=_url, max_events=options.max_event)  #TODO data_type arg does not exist anymore
+            else:
+                #inputfile_reader = ToyReader(filename=_url, id_list=[0],
+                #                             max_events=options.max_event,
+                #                             n_pixel=options.n_pixels, events_per_level=options.events_per_level)
 
-            if event_number < options.min_event:
-                event_number += 1
-                continue
+                inputfile_reader = hdf5_mc_event_source(url=_url, events_per_dc_level=options.dc_step, events_per_ac_level=options.ac_step, dc_start=options.dc_start, ac_start=options.ac_start, max_events=options.max_event)
 
-            pbar.update(1)
+            log.debug('--|> Moving to file %s' % _url)
+            yield inputfile_reader
 
-            for telid in event.r0.tels_with_data:
+    # Loop over the blocks of events (the events from min_event to max_event included)
+    batch_size = options.n_evt_per_batch if hasattr(options, 'n_evt_per_batch') else 1000
+    for batch in EventBatchReader(event_sources(), batch_size, pixel_list=options.pixel_list,
+                                  event_min=options.min_event, event_max=options.max_event + 1):
 
-                # Take data from zfits
-                data = np.array(list(event.r0.tel[telid].adc_samples.values()))
+        pbar.update(batch.n_events)
 
-                # Get rid off unwanted pixels
+        # samples of the block, shape (n_events, n_pixels, n_samples)
+        data = batch.adc_samples
 
+        if hist_type == 'raw':
 
-                data = data[options.pixel_list]
+            hist.fill_with_batch(data.transpose(1, 0, 2).reshape(data.shape[1], -1))
 
+        elif hist_type == 'integral':
 
-                if hist_type == 'raw':
+            temp = np.sum(data, axis=-1, dtype=int) - 2000 * data.shape[-1] # TODO need to compress this <4095
+            # the integrals out of the binning are counted in the first and last bins, as with Histogram.fill
+            temp = np.clip(temp, hist.bin_centers[0], hist.bin_centers[-1])
+            hist.fill_with_batch(temp.T)
 
-                    hist.fill_with_batch(data)
-
-                elif hist_type == 'integral':
-
-                    temp = np.sum(data - 2000, axis=1) # TODO need to compress this <4095
-                    hist.fill(temp)
-
-                else:
-
-                    log.info('Unknown hist_type = %s' %hist_type)
+        else:
 
-            event_number += 1
+            log.info('Unknown hist_type = %s' %hist_type)
 
     return
@@ -7,6 +7,7 @@ from utils.logger import TqdmToLogger
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from utils.event_iterator import EventCounter
+from utils.integrator import window_sum
 import peakutils
 
 
@@ -49,7 +50,7 @@ def run(hist, options):
                 data = np.array(list(event.r0.tel[telid].adc_samples.values()))
                 data = data[options.pixel_list]
 
-                data = np.apply_along_axis(integrate_trace, axis=-1, arr=data, window_width=options.window_width)
+                data = window_sum(data, options.window_width)
 
                 n_peaks = compute_n_peaks(data, thresholds=thresholds, min_distance=options.min_distance)
 
@@ -82,4 +83,4 @@ def compute_peaks(y, threshold, min_distance):
     return n_peaks
 
 def integrate_trace(data, window_width):
-    return np.convolve(data, np.ones((window_width), dtype=int), 'valid')
+    return window_sum(data, window_width)
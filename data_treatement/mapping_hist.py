@@ -5,6 +5,7 @@ import logging,sys
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
 from utils.toy_reader import ToyReader
+from utils.integrator import window_sum
 import matplotlib.pyplot as plt
 # noinspection PyProtectedMember
 def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', baseline=0.):
@@ -76,8 +77,6 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
             # mask_windows_edge = np.append(mask_windows_edge,np.zeros((mask_windows_edge.shape[0],missing),dtype=bool),axis=1)
             #print(shift)
 
-    def integrate_trace(d):
-        return np.convolve(d, np.ones((window_width), dtype=int), 'valid')
 
     def contiguous_regions(data):
         """Finds contiguous True regions of the boolean array "condition". Returns
@@ -160,7 +159,7 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                         _tmp_baseline = baseline
                     data = data - _tmp_baseline[:, None]
                     # if level>32 :
-                integration = np.apply_along_axis(integrate_trace, 1, data)
+                integration = window_sum(data, window_width)
                 local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
                 local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
                 ind_max_at_edge = (local_max == local_max_edge)
@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 #from ctapipe.calib.camera import integrators fix import with updated cta
 from ctapipe.io import zfits
@@ -5,20 +6,99 @@ import logging,sys
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
 from utils.toy_reader import ToyReader
+from utils.integrator import window_sum, max_run_sum
+from utils.parallel_fill import fill_parallel
+from utils.baseline import BaselineTracker, EventBlock
 import matplotlib.pyplot as plt
+def _open_file(options, _url, trigger_output=None):
+    if not options.mc:
+        return zfits.zfits_event_source(url=_url, max_events=len(options.scan_level)*options.events_per_level,expert_mode=type(trigger_output).__name__ == 'ndarray')
+    seed = 0
+    return ToyReader(filename=_url, id_list=[0], seed=seed, max_events=len(options.scan_level)*options.events_per_level, n_pixel=options.n_pixels, events_per_level=options.events_per_level, level_start=options.scan_level[0])
+
+
+def _integration_charges(data, baseline_tracker, window_width, window_start, peak, mask_window, mask_windows_edge):
+    """
+    The charges of the 'integration' extraction for a block of events: the window of largest sum starting in the
+    synch peak region, else the window starting window_start samples before the most probable peak position
+
+    :param data: the traces, shape (n_events, n_pixels, n_samples)   (np.array)
+    :param baseline_tracker: the per event baseline subtracted      (BaselineTracker)
+    :param window_width, window_start: see run
+    :param peak: the most probable peak position of each pixel     (np.array)
+    :param mask_window, mask_windows_edge: the window starts in the synch peak region and at its edge
+                                                                    (np.array)
+    :return: the charges, shape (n_pixels, n_events)                (np.array)
+    """
+    if baseline_tracker is not None:
+        data = baseline_tracker.subtract(data)
+    integration = window_sum(data, window_width)
+    local_max = np.argmax(np.multiply(integration, mask_window), axis=-1)
+    local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=-1)
+    peak_start = np.broadcast_to(peak - window_start, local_max.shape)
+    ind_max_at_edge = (local_max == local_max_edge)
+    local_max[ind_max_at_edge] = peak_start[ind_max_at_edge]
+    ind_with_lt_th = np.take_along_axis(integration, local_max[..., None], axis=-1)[..., 0] < 10.
+    local_max[ind_with_lt_th] = peak_start[ind_with_lt_th]
+    local_max[local_max<0]=0
+    return np.take_along_axis(integration, local_max[..., None], axis=-1)[..., 0].T
+
+
+def _first_event_number(options):
+    # camera event number of the first event of the scan, it defines the level of the events of every file
+    _url = options.directory + options.file_basename % options.file_list[0]
+    for event in _open_file(options, _url):
+        for telid in event.r0.tels_with_data:
+            return event.r0.tel[telid].camera_event_number
+
+
 # noinspection PyProtectedMember
-def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', baseline=0., trigger_output=None):
+def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', baseline=0., trigger_output=None,
+        level_file=None):
+    """
+    Fill the histogram of the scan levels
+
+    :param level_file: the file to which each level is written once filled, its completed levels being skipped
+                       (they have to be read in hist beforehand, see HistogramLevelFile.read_levels)
+                                                                          (utils.histogram_hdf5.HistogramLevelFile)
+    """
+    log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
+
+    # the levels already filled (resumed scan)
+    skip_levels = set(options.skip_levels) if hasattr(options, 'skip_levels') else set()
+    if level_file is not None:
+        skip_levels.update(level_file.completed_levels())
+        if len(skip_levels) > 0:
+            log.info('--|> Skipping the completed levels %s' % sorted(skip_levels))
+
+    # Parallel filling: one process per chunk of files, the scan levels being defined by the first event
+    n_jobs = options.n_jobs_fill if hasattr(options, 'n_jobs_fill') else 1
+    if n_jobs != 1 and len(options.file_list) > 1:
+        options = copy.copy(options)
+        if not hasattr(options, 'first_event_number'):
+            options.first_event_number = _first_event_number(options)
+        options.skip_levels = sorted(skip_levels)
+        fill_parallel(run, hist, options, n_jobs, peak_positions=peak_positions, charge_extraction=charge_extraction,
+                      baseline=baseline, trigger_output=trigger_output,
+                      accumulate=('trigger_output',) if type(trigger_output).__name__ == 'ndarray' else ())
+        # the levels are complete once the partial histograms are merged
+        if level_file is not None:
+            for level in range(len(options.scan_level)):
+                if level not in skip_levels:
+                    level_file.write_level(hist, level)
+        return
+
     # Few counters
     level, evt_num, first_evt, first_evt_num = 0, 0, True, 0
 
-    log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
     pbar = tqdm(total=len(options.scan_level)*options.events_per_level)
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
 
-    params=None
-    if hasattr(options, 'baseline_per_event_limit'):
-        params = np.load(options.output_directory + options.baseline_param_data)['params']
-
+    # the baseline of every pixel is set by the first two events
+    baseline_tracker = BaselineTracker.from_options(options, n_first=2)
+    # the events whose charge is not extracted yet, the baseline being subtracted once per block
+    block = EventBlock()
+    block_size = options.n_evt_per_batch if hasattr(options, 'n_evt_per_batch') else 100
 
     charge_extraction = options.integration_method
     if charge_extraction == 'integration' or charge_extraction == 'integration_sat' or charge_extraction == 'baseline':
@@ -69,37 +149,7 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
             # mask_windows_edge = np.append(mask_windows_edge,np.zeros((mask_windows_edge.shape[0],missing),dtype=bool),axis=1)
             #print(shift)
 
-    def integrate_trace(d):
-        return np.convolve(d, np.ones((window_width), dtype=int), 'valid')
-
-    def contiguous_regions(data):
-        """Finds contiguous True regions of the boolean array "condition". Returns
-        a 2D array where the first column is the start index of the region and the
-        second column is the end index."""
-        condition = data > 0
-        # Find the indicies of changes in "condition"
-        d = np.diff(condition)
-        idx, = d.nonzero()
-
-        # We need to start things after the change in "condition". Therefore,
-        # we'll shift the index by 1 to the right.
-        idx += 1
-
-        if condition[0]:
-            # If the start of condition is True prepend a 0
-            idx = np.r_[0, idx]
-
-        if condition[-1]:
-            # If the end of condition is True, append the length of the array
-            idx = np.r_[idx, condition.size]  # Edit
-
-        # Reshape the result into two columns
-        idx.shape = (-1, 2)
-        val = 0.
-        for start, stop in idx:
-            sum_tmp = np.sum(data[start:stop])
-            if val < sum_tmp: val = sum_tmp
-        return val
+
 
     batch = None
     for file in options.file_list:
@@ -107,14 +157,7 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
             break
         # Get the file
         _url = options.directory + options.file_basename % file
-        inputfile_reader = None
-        if not options.mc:
-            inputfile_reader = zfits.zfits_event_source(url=_url, max_events=len(options.scan_level)*options.events_per_level,expert_mode=type(trigger_output).__name__ == 'ndarray')
-        else:
-
-            seed = 0
-            inputfile_reader = ToyReader(filename=_url, id_list=[0], seed=seed, max_events=len(options.scan_level)*options.events_per_level, n_pixel=options.n_pixels, events_per_level=options.events_per_level, level_start=options.scan_level[0])
-
+        inputfile_reader = _open_file(options, _url, trigger_output=trigger_output)
 
         if options.verbose:
             log.debug('--|> Moving to file %s' % _url)
@@ -125,6 +168,10 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
             for telid in event.r0.tels_with_data:
                 if first_evt:
                     first_evt_num = event.r0.tel[telid].camera_event_number
+                    if hasattr(options, 'first_event_number'):
+                        # the files do not start the scan (parallel filling)
+                        first_evt_num = options.first_event_number
+                    level = int((event.r0.tel[telid].camera_event_number - first_evt_num) / options.events_per_level)
                     batch_index = 0
                     batch = np.zeros((len(options.pixel_list), options.events_per_level),dtype=int)
                     if charge_extraction=='baseline':
@@ -132,18 +179,26 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                         #batch = np.zeros((len(options.pixel_list*(1+options.n_bins-options.window_width)), options.events_per_level),dtype=int)
 
                     first_evt = False
+                    if level > len(options.scan_level) - 1:
+                        break
                 evt_num = event.r0.tel[telid].camera_event_number - first_evt_num
                 if evt_num % options.events_per_level == 0:
-                    batch_index = 0
                     if charge_extraction == 'integration':
-                        #print(batch)
-                        hist.fill_with_batch(batch, indices=(level,))
-                        # Reset the batch
-                        batch = np.zeros((len(options.pixel_list), options.events_per_level),dtype=int)
+                        if len(block) > 0:
+                            events, slots = block.pop()
+                            batch[..., slots] = _integration_charges(events, baseline_tracker, window_width,
+                                                                     window_start, peak, mask_window,
+                                                                     mask_windows_edge)
+                        # the events of the level not filled yet
+                        hist.fill_with_batch(batch[..., 0:batch_index], indices=(level,))
+                    batch_index = 0
                     if charge_extraction == 'baseline':
                         pass
                         #batch = np.zeros((len(options.pixel_list*(1+ options.n_bins - options.window_width)), options.events_per_level), dtype=int)
-                    level = int(evt_num / options.events_per_level)
+                    new_level = int(evt_num / options.events_per_level)
+                    if level_file is not None and new_level != level and level not in skip_levels:
+                        level_file.write_level(hist, level)
+                    level = new_level
                     if level > len(options.scan_level) - 1:
                         break
                     if options.verbose:
@@ -155,6 +210,9 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                     if evt_num % int(options.events_per_level/1000)== 0:
                         pbar.update(int(options.events_per_level/1000))
 
+                if level in skip_levels:
+                    continue
+
                 # get the data
                 data = np.array(list(event.r0.tel[telid].adc_samples.values()))
 
@@ -185,51 +243,20 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                     index_max = (np.arange(0, data.shape[0]), peak,)
                     hist.fill(data[index_max] - baseline[level, :], indices=(level,))
                 elif charge_extraction == 'integration':
-                    if hasattr(options, 'baseline_per_event_limit'):
-                        baseline = np.mean(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        rms = np.std(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        # get the indices where baseline is good
-                        ind_good_baseline = (rms - params[:,2])/params[:,3] < 0.5
-                        if evt_num > 1:
-                            _tmp_baseline[ind_good_baseline] = baseline[ind_good_baseline]
-                        else:
-                            _tmp_baseline = baseline
-                        data = data - _tmp_baseline[:, None]
-                        #if level>32 :
-
-                    else:
-                        baseline = np.zeros((len(options.scan_level), data.shape[0]))
-                    integration = np.apply_along_axis(integrate_trace,1,data)
-                    local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
-                    local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
-                    ind_max_at_edge = (local_max == local_max_edge)
-                    local_max[ind_max_at_edge] = peak[ind_max_at_edge]-window_start
-                    index_max = (np.arange(0, data.shape[0]), local_max,)
-                    ind_with_lt_th = integration[index_max] < 10.
-                    local_max[ind_with_lt_th] = peak[ind_with_lt_th]-window_start
-                    local_max[local_max<0]=0
-                    index_max = (np.arange(0, data.shape[0]), local_max,)
-                    '''
-                    print('integrated value',integration[index_max][options.pixel_list.index(44)])
-                    print('------------------------------------------')
-                    if integration[index_max][options.pixel_list.index(44)]<-5:
-                        plt.plot(np.arange(92),data[options.pixel_list.index(44)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(29)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(30)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(45)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(61)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(62)])
-                        plt.show()
-                    '''
-                    #print(baseline)
-                    batch[...,batch_index]=integration[index_max] - baseline[level,:]
+                    # the charges are extracted by blocks of events
+                    block.append(data, batch_index)
                     batch_index += 1
-                    #hist.fill(integration[index_max],indices=(level,))
+                    if len(block) == block_size or batch_index == options.events_per_level:
+                        events, slots = block.pop()
+                        batch[..., slots] = _integration_charges(events, baseline_tracker, window_width,
+                                                                 window_start, peak, mask_window,
+                                                                 mask_windows_edge)
 
                 elif charge_extraction == 'local_max':
-                    cum_sum_trace1 = data.cumsum(axis=-1)
-                    cum_sum_trace1[..., 3:] = (cum_sum_trace1[..., 3:] - cum_sum_trace1[..., :-3])
-                    cum_sum_trace1 = np.append(cum_sum_trace1[..., 1:], np.zeros((data.shape[0], 1,)), axis=1)
+                    # sum of the 3 samples centred on each sample (a partial window at the trace start, 0 at its end)
+                    cum_sum_trace1 = np.zeros(data.shape)
+                    window_sum(data, 3, out=cum_sum_trace1[..., 1:-1])
+                    cum_sum_trace1[..., 0] = data[..., 0] + data[..., 1]
                     local_max = np.argmax(np.multiply(cum_sum_trace1, mask_window), axis=1)
                     local_max_edge = np.argmax(np.multiply(cum_sum_trace1, mask_windows_edge), axis=1)
                     ind_max_at_edge = (local_max == local_max_edge)
@@ -248,7 +275,7 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                     data_sat[ data_sat[max_idx] < options.threshold_sat ] = 0.
                     data_int[ data_int[max_idx] >= options.threshold_sat ] = 0.
 
-                    integration = np.apply_along_axis(integrate_trace,1,data_int)
+                    integration = window_sum(data_int, window_width)
                     local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
                     local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
                     ind_max_at_edge = (local_max == local_max_edge)
@@ -259,7 +286,7 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                     index_max = (np.arange(0, data_int.shape[0]), local_max,)
                     full_integration = integration[index_max]
                     # now deal with saturated ones:
-                    sat_integration = np.apply_along_axis(contiguous_regions, 1, data_sat)
+                    sat_integration = max_run_sum(data_sat)
                     full_integration = full_integration + sat_integration - baseline[level, :]
                     hist.fill(full_integration,indices=(level,))
 
@@ -274,11 +301,21 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                     #batch[:,evt_num%(options.events_per_level*integral.shape[1]):evt_num%(options.events_per_level*integral.shape[1])+integral.shape[1]]=np.apply_along_axis(integrate_trace,-1,data)
                     hist.fill(integral,indices=(level,))
 
-                if batch_index % options.events_per_level == 0:
+                if batch_index == options.events_per_level:
+                    hist.fill_with_batch(batch, indices=(level,))
                     batch_index = 0
 
+    # the events of the last level not filled yet
+    if charge_extraction == 'integration' and batch is not None and batch_index > 0:
+        if len(block) > 0:
+            events, slots = block.pop()
+            batch[..., slots] = _integration_charges(events, baseline_tracker, window_width, window_start, peak,
+                                                     mask_window, mask_windows_edge)
+        hist.fill_with_batch(batch[..., 0:batch_index], indices=(level,))
+    if level_file is not None and not first_evt and level <= len(options.scan_level) - 1 and level not in skip_levels:
+        level_file.write_level(hist, level)
+
 
 
 
-    # Update the errors
-    hist._compute_errors()
\ No newline at end of file
+    # The errors are computed when accessed (avoids materialising them for compact histograms)
\ No newline at end of file
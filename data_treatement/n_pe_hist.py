@@ -5,7 +5,58 @@ import logging,sys
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
 from utils.toy_reader import ToyReader
+from utils.integrator import window_sum, max_run_sum
+from utils.baseline import BaselineTracker, EventBlock
 import matplotlib.pyplot as plt
+
+
+def _charges(data, baseline_tracker, charge_extraction, window_width, window_start, peak, mask_window,
+             mask_windows_edge, threshold_sat=None, baseline=0., level=0):
+    """
+    The charges of the 'integration' or 'integration_sat' extraction for a block of events (see run)
+
+    :param data: the traces, shape (n_events, n_pixels, n_samples)   (np.array)
+    :param baseline_tracker: the per event baseline subtracted      (BaselineTracker)
+    :param charge_extraction: 'integration' or 'integration_sat'     (str)
+    :param window_width, window_start: see run
+    :param peak: the most probable peak position of each pixel     (np.array)
+    :param mask_window, mask_windows_edge: the window starts in the synch peak region and at its edge
+                                                                    (np.array)
+    :param threshold_sat: the saturation threshold ('integration_sat')
+                                                                    (float)
+    :param baseline, level: the baseline of each shower and pixel and the shower ('integration_sat'), see run
+                                                                    (np.array, int)
+    :return: the charges, shape (n_pixels, n_events)                (np.array)
+    """
+    if baseline_tracker is not None:
+        data = baseline_tracker.subtract(data)
+    if charge_extraction == 'integration_sat':
+        # first deal with normal values
+        amplitude = np.max(data, axis=-1)
+        data_int = np.copy(data)
+        data_sat = np.copy(data)
+        data_sat[amplitude < threshold_sat] = 0.
+        data_int[amplitude >= threshold_sat] = 0.
+        data = data_int
+    integration = window_sum(data, window_width)
+    local_max = np.argmax(np.multiply(integration, mask_window), axis=-1)
+    local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=-1)
+    peak_start = np.broadcast_to(peak - window_start, local_max.shape)
+    ind_max_at_edge = (local_max == local_max_edge)
+    local_max[ind_max_at_edge] = peak_start[ind_max_at_edge]
+    ind_with_lt_th = np.take_along_axis(integration, local_max[..., None], axis=-1)[..., 0] < 10.
+    local_max[ind_with_lt_th] = peak_start[ind_with_lt_th]
+    if charge_extraction == 'integration':
+        local_max[local_max<0]=0
+    full_integration = np.take_along_axis(integration, local_max[..., None], axis=-1)[..., 0]
+    if charge_extraction == 'integration_sat':
+        # now deal with saturated ones:
+        sat_integration = max_run_sum(data_sat)
+        full_integration = full_integration + sat_integration - baseline[level, :]
+        full_integration = full_integration - baseline[level, :]
+    return full_integration.T
+
+
 # noinspection PyProtectedMember
 def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', baseline=0.):
 
@@ -16,9 +67,12 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
     pbar = tqdm(total=len(options.shower_ids)*options.evt_per_shower)
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
 
-    params=None
-    if hasattr(options, 'baseline_per_event_limit'):
-        params = np.load(options.output_directory + options.baseline_param_data)['params']
+    # the baseline of every pixel is set by the first two events
+    baseline_tracker = BaselineTracker.from_options(options, n_first=2)
+    # the events whose charge is not extracted yet, the baseline being subtracted once per block
+    block = EventBlock()
+    block_size = options.n_evt_per_batch if hasattr(options, 'n_evt_per_batch') else 100
+    threshold_sat = options.threshold_sat if hasattr(options, 'threshold_sat') else None
 
 
     charge_extraction = options.integration_method
@@ -79,37 +133,7 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
             # mask_windows_edge = np.append(mask_windows_edge,np.zeros((mask_windows_edge.shape[0],missing),dtype=bool),axis=1)
             #print(shift)
 
-    def integrate_trace(d):
-        return np.convolve(d, np.ones((window_width), dtype=int), 'valid')
-
-    def contiguous_regions(data):
-        """Finds contiguous True regions of the boolean array "condition". Returns
-        a 2D array where the first column is the start index of the region and the
-        second column is the end index."""
-        condition = data > 0
-        # Find the indicies of changes in "condition"
-        d = np.diff(condition)
-        idx, = d.nonzero()
-
-        # We need to start things after the change in "condition". Therefore,
-        # we'll shift the index by 1 to the right.
-        idx += 1
-
-        if condition[0]:
-            # If the start of condition is True prepend a 0
-            idx = np.r_[0, idx]
-
-        if condition[-1]:
-            # If the end of condition is True, append the length of the array
-            idx = np.r_[idx, condition.size]  # Edit
-
-        # Reshape the result into two columns
-        idx.shape = (-1, 2)
-        val = 0.
-        for start, stop in idx:
-            sum_tmp = np.sum(data[start:stop])
-            if val < sum_tmp: val = sum_tmp
-        return val
+
 
     batch = None
     n_init = 0
@@ -150,7 +174,12 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                 if evt_num % options.evt_per_shower == 0:
                     batch_index = 0
                     if charge_extraction == 'integration_sat' or charge_extraction=='integration':
-                        #print(batch)
+                        if len(block) > 0:
+                            events, slots = block.pop()
+                            batch[..., slots] = _charges(events, baseline_tracker, charge_extraction, window_width,
+                                                         window_start, peak, mask_window, mask_windows_edge,
+                                                         threshold_sat=threshold_sat,
+                                                         baseline=baseline, level=level)
                         hist.data[level]=np.mean(batch,axis=-1)
                         # Reset the batch
                         batch = np.zeros((len(options.pixel_list), options.evt_per_shower),dtype=int)
@@ -194,49 +223,22 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                 elif charge_extraction == 'fixed_max':
                     index_max = (np.arange(0, data.shape[0]), peak,)
                     hist.fill(data[index_max] - baseline[level, :], indices=(level,))
-                elif charge_extraction == 'integration':
-                    if hasattr(options, 'baseline_per_event_limit'):
-                        baseline = np.mean(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        rms = np.std(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        # get the indices where baseline is good
-                        ind_good_baseline = (rms - params[:,2])/params[:,3] < 0.5
-                        if evt_num > 1:
-                            _tmp_baseline[ind_good_baseline] = baseline[ind_good_baseline]
-                        else:
-                            _tmp_baseline = baseline
-                        data = data - _tmp_baseline[:, None]
-                        #if level>32 :
-                    integration = np.apply_along_axis(integrate_trace,1,data)
-                    local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
-                    local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
-                    ind_max_at_edge = (local_max == local_max_edge)
-                    local_max[ind_max_at_edge] = peak[ind_max_at_edge]-window_start
-                    index_max = (np.arange(0, data.shape[0]), local_max,)
-                    ind_with_lt_th = integration[index_max] < 10.
-                    local_max[ind_with_lt_th] = peak[ind_with_lt_th]-window_start
-                    local_max[local_max<0]=0
-                    index_max = (np.arange(0, data.shape[0]), local_max,)
-
-                    '''
-                    print('integrated value',integration[index_max][options.pixel_list.index(44)])
-                    print('------------------------------------------')
-                    if integration[index_max][options.pixel_list.index(44)]<-5:
-                        plt.plot(np.arange(92),data[options.pixel_list.index(44)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(29)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(30)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(45)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(61)])
-                        plt.plot(np.arange(92),data[options.pixel_list.index(62)])
-                        plt.show()
-                    '''
-                    batch[...,batch_index]=integration[index_max] #- baseline[level,:]
+                elif charge_extraction == 'integration' or charge_extraction == 'integration_sat':
+                    # the charges are extracted by blocks of events
+                    block.append(data, batch_index)
                     batch_index += 1
-                    #hist.fill(integration[index_max],indices=(level,))
+                    if len(block) == block_size or batch_index % options.evt_per_shower == 0:
+                        events, slots = block.pop()
+                        batch[..., slots] = _charges(events, baseline_tracker, charge_extraction, window_width,
+                                                     window_start, peak, mask_window, mask_windows_edge,
+                                                     threshold_sat=threshold_sat,
+                                                     baseline=baseline, level=level)
 
                 elif charge_extraction == 'local_max':
-                    cum_sum_trace1 = data.cumsum(axis=-1)
-                    cum_sum_trace1[..., 3:] = (cum_sum_trace1[..., 3:] - cum_sum_trace1[..., :-3])
-                    cum_sum_trace1 = np.append(cum_sum_trace1[..., 1:], np.zeros((data.shape[0], 1,)), axis=1)
+                    # sum of the 3 samples centred on each sample (a partial window at the trace start, 0 at its end)
+                    cum_sum_trace1 = np.zeros(data.shape)
+                    window_sum(data, 3, out=cum_sum_trace1[..., 1:-1])
+                    cum_sum_trace1[..., 0] = data[..., 0] + data[..., 1]
                     local_max = np.argmax(np.multiply(cum_sum_trace1, mask_window), axis=1)
                     local_max_edge = np.argmax(np.multiply(cum_sum_trace1, mask_windows_edge), axis=1)
                     ind_max_at_edge = (local_max == local_max_edge)
@@ -247,39 +249,6 @@ def run(hist, options, peak_positions=None, charge_extraction = 'amplitude', bas
                     index_max = (np.arange(0, data.shape[0]), local_max,)
                     hist.fill(data[index_max] - baseline[level,:],indices=(level,))
 
-                elif charge_extraction == 'integration_sat':
-                    if hasattr(options, 'baseline_per_event_limit'):
-                        baseline = np.mean(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        rms = np.std(data[...,0:options.baseline_per_event_limit], axis=-1)
-                        # get the indices where baseline is good
-                        ind_good_baseline = (rms - params[:,2])/params[:,3] < 0.5
-                        if evt_num > 1:
-                            _tmp_baseline[ind_good_baseline] = baseline[ind_good_baseline]
-                        else:
-                            _tmp_baseline = baseline
-                        data = data - _tmp_baseline[:, None]
-                    # first deal with normal values
-                    max_idx = (np.arange(0, data.shape[0]),np.argmax(data, axis=1) ,)
-                    data_int = np.copy(data)
-                    data_sat = np.copy(data)
-                    data_sat[ data_sat[max_idx] < options.threshold_sat ] = 0.
-                    data_int[ data_int[max_idx] >= options.threshold_sat ] = 0.
-                    integration = np.apply_along_axis(integrate_trace,1,data_int)
-                    local_max = np.argmax(np.multiply(integration, mask_window), axis=1)
-                    local_max_edge = np.argmax(np.multiply(integration, mask_windows_edge), axis=1)
-                    ind_max_at_edge = (local_max == local_max_edge)
-                    local_max[ind_max_at_edge] = peak[ind_max_at_edge]-window_start
-                    index_max = (np.arange(0, data_int.shape[0]), local_max,)
-                    ind_with_lt_th = integration[index_max] < 10.
-                    local_max[ind_with_lt_th] = peak[ind_with_lt_th]-window_start
-                    index_max = (np.arange(0, data_int.shape[0]), local_max,)
-                    full_integration = integration[index_max]
-                    # now deal with saturated ones:
-                    sat_integration = np.apply_along_axis(contiguous_regions, 1, data_sat)
-                    full_integration = full_integration + sat_integration - baseline[level, :]
-                    batch[..., batch_index] = full_integration - baseline[level, :]
-                    batch_index += 1
-
                 elif charge_extraction == 'full':
 
                     temp = np.sum(data, axis=1) - baseline[level, :]
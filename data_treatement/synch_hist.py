@@ -4,6 +4,29 @@ import logging,sys
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
 from utils.toy_reader import ToyReader
+from utils.baseline import BaselineTracker, EventBlock
+
+
+def _peak_positions(data, options, baseline_tracker):
+    """
+    The sample of the maximum of each pixel for a block of events
+
+    :param data: the traces, shape (n_events, n_pixels, n_samples)  (np.array)
+    :param options: see run
+    :param baseline_tracker: the per event baseline subtracted     (BaselineTracker)
+    :return: the positions, shape (n_events, n_pixels)             (np.array)
+    """
+    if baseline_tracker is not None:
+        data = baseline_tracker.subtract(data)
+    elif options.prev_fit_result is not None:
+        data = data-options.prev_fit_result[...,1,0][:,None]/options.window_width
+
+    data_max = np.argmax(data, axis=-1)
+
+    if options.prev_fit_result is not None:
+        data_max[np.take_along_axis(data, data_max[..., None], axis=-1)[..., 0] < 40] = 0
+        data_max[np.take_along_axis(data, data_max[..., None], axis=-1)[..., 0] > 3000] = 0 #TODO need to adapt this more generic
+    return data_max
 
 
 def run(hist, options, min_evt = 0):
@@ -12,11 +35,10 @@ def run(hist, options, min_evt = 0):
 
     n_evt, n_batch, batch_num, max_evt = (options.evt_max - options.evt_min), options.n_evt_per_batch, 0, options.evt_max
     batch = None
-    _tmp_baseline=None
 
-    params=None
-    if hasattr(options, 'baseline_per_event_limit'):
-        params = np.load(options.output_directory + options.baseline_param_data)['params']
+    baseline_tracker = BaselineTracker.from_options(options)
+    # the events not treated yet, the baseline being subtracted once per block
+    block = EventBlock()
     log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
     pbar = tqdm(total=max_evt-min_evt)
     tqdm_out = TqdmToLogger(log, level=logging.INFO)
@@ -52,6 +74,9 @@ def run(hist, options, min_evt = 0):
                 evt_num += 1
                 if evt_num % n_batch == 0:
                     log.debug('Treating the batch #%d of %d events' % (batch_num, n_batch))
+                    if len(block) > 0:
+                        events, slots = block.pop()
+                        batch[:, slots] = _peak_positions(events, options, baseline_tracker).T
                     # Update adc histo
                     #print(np.max(batch))
                     hist.fill_with_batch(batch.reshape(batch.shape[0], batch.shape[1] ))
@@ -66,33 +91,11 @@ def run(hist, options, min_evt = 0):
                 # get rid of unwanted pixels
                 data = data[options.pixel_list]
 
-                if hasattr(options, 'baseline_per_event_limit'):
-                    baseline = np.mean(data[..., 0:options.baseline_per_event_limit], axis=-1)
-                    rms = np.std(data[..., 0:options.baseline_per_event_limit], axis=-1)
-                    ind_good_baseline = (rms - params[:, 2]) / params[:, 3] < 0.5
-                    if evt_num>1:
-                        _tmp_baseline[ind_good_baseline] = baseline[ind_good_baseline]
-                    else:
-                        _tmp_baseline = baseline
-                    # _tmp_baseline = baseline
-                    data = data - _tmp_baseline[:, None]
-                elif options.prev_fit_result is not None:
-                    data = data-options.prev_fit_result[...,1,0][:,None]/options.window_width
-
-
                 if evt_num==min_evt + 1:
                     batch = np.zeros((data.shape[0], n_batch),dtype=int)
 
-                # subtract the pedestals
-                data_max = np.argmax(data, axis=1)
-
-                if options.prev_fit_result is not None:
-
-                    data_max[data[(np.arange(0,data.shape[0]),data_max)] < 40] = 0
-                    data_max[data[(np.arange(0,data.shape[0]),data_max)] > 3000] = 0 #TODO need to adapt this more generic
-                #if (data_max-np.argmin(data, axis=1))/data_max>0.2:
-
-                batch[:,batch_index]=data_max
+                # the peak position is found when the batch is filled
+                block.append(data, batch_index)
                 batch_index += 1
                 if batch_index%n_batch==0:
                     batch_index = 0
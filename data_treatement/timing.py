@@ -10,6 +10,7 @@ from iminuit import Minuit
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from utils.event_iterator import EventCounter
+from utils.pulse_timing import PulseTimingEstimator
 
 
 def run(arrival_time, options):
@@ -24,6 +25,7 @@ def run(arrival_time, options):
     log = logging.getLogger(sys.modules['__main__'].__name__+'.'+__name__)
     # Reading the file
     event_counter = EventCounter(options.min_event, options.max_event, options.scan_level[0], options.scan_level[-1], 0, 0, options.events_per_level, options.events_per_level_in_file, log)
+    estimator = timing_estimator(options)
 
     for file in options.file_list:
         # Open the file
@@ -51,10 +53,12 @@ def run(arrival_time, options):
                 time = np.arange(0, data.shape[-1], 1) * 4
                 errors = np.ones(data.shape[-1]) / np.sqrt(12)
 
+                fit_results = compute_times(data, time, errors, options, options.pixel_list, estimator)
+                arrival_time[counter.level_dc, :, counter.event_count_in_level] = fit_results[:, 0]
+
                 for pixel_id, pixel_soft_id in enumerate(options.pixel_list):
 
-                    fit_result = compute_time(data[pixel_id], time, errors, options, pixel_soft_id)
-                    arrival_time[counter.level_dc, pixel_id, counter.event_count_in_level] = fit_result[0]
+                    fit_result = fit_results[pixel_id]
 
                     if options.debug:
 
@@ -73,6 +77,52 @@ def run(arrival_time, options):
     return
 
 
+def timing_estimator(options):
+    """
+    The batched estimator of the pulse parameters, None for the per pixel least squares fit of compute_time
+
+    :param options: a dictionary containing at least the following keys:
+        - 'mc'               : MC or data pulse template                                  (bool)
+        - 'timing_method'    : (optional) 'least_squares' (default, the fit of compute_time) or 'template'
+                               (the batched template estimator, faster but not bit-identical)
+                                                                                          (str)
+    :return: the estimator                                                                (PulseTimingEstimator)
+    """
+    method = options.timing_method if hasattr(options, 'timing_method') else 'least_squares'
+    if method == 'least_squares':
+        return None
+    elif method != 'template':
+        raise ValueError('Unknown timing method %s' % method)
+    return PulseTimingEstimator.from_options(options)
+
+
+def compute_times(data, time, errors, options, pixel_list, estimator=None):
+    """
+    The pulse parameters [t_0, amplitude, baseline] of every pixel of an event
+
+    :param data: the traces, shape (n_pixels, n_samples)                                  (np.array)
+    :param time: the sample times [ns]                                                    (np.array)
+    :param errors: the errors of the samples                                              (np.array)
+    :param options: a dictionary containing at least the following keys:
+        - 'timing_refine'    : (optional) refine the template cross-correlation by a fit
+                               (default True)                                             (bool)
+        - 'timing_tolerance' : (optional) the convergence tolerance (relative chi2 decrease and parameter
+                               step) of the Levenberg-Marquardt refinement of the template estimator, not a
+                               tolerance on the difference to the least squares fit (default 1e-6)
+                                                                                          (float)
+    :param pixel_list: the pixel id of the traces                                         (list(int))
+    :param estimator: see timing_estimator                                                (PulseTimingEstimator)
+    :return: the parameters, shape (n_pixels, 3)                                          (np.array)
+    """
+    if estimator is None:
+        return np.array([compute_time(data[pixel_id], time, errors, options, pixel_soft_id)
+                         for pixel_id, pixel_soft_id in enumerate(pixel_list)]).reshape(-1, 3)
+
+    return estimator.fit(data, errors=errors,
+                         refine=options.timing_refine if hasattr(options, 'timing_refine') else True,
+                         tolerance=options.timing_tolerance if hasattr(options, 'timing_tolerance') else 1e-6)
+
+
 def residual_function(function, p, x, y, y_err, pixel_id):
 
     return (y - function(p, x, pixel_id)) / y_err
@@ -1,3 +1,7 @@
+import collections
+import copy
+import multiprocessing
+
 import numpy as np
 from ctapipe.io import zfits
 import logging, sys
@@ -6,29 +10,169 @@ from utils.logger import TqdmToLogger
 from utils.toy_reader import ToyReader
 from utils.mc_events_reader import hdf5_mc_event_source
 from cts_core.camera import Camera
+from utils.trigger_operator import TriggerOperator
 
 
 def run(trigger_rate_camera, options, min_evt=0, cluster_hist=None, patch_hist=None, max_cluster_hist=None,
         time_cluster_hist=None):
-    # Few counters
+    """
+    Fill the trigger rates, the cluster and patch spectra of the NSB levels of options.nsb_rate
+
+    The events of the level l are the events [l * events_per_level, (l + 1) * events_per_level[. The files are
+    read once; with options.n_jobs_fill != 1, the events of each level are processed in a pool of processes while
+    the next levels are read, and the results are merged.
+
+    :param trigger_rate_camera: the trigger rates, shape (n_levels, n_thresholds)     (Histogram)
+    :param options: configuration container
+    :param cluster_hist: the cluster 7 spectra, shape (n_levels, n_clusters)           (Histogram)
+    :param patch_hist: the patch spectra, shape (n_levels, n_patches)                  (Histogram)
+    :param max_cluster_hist: (optional) the list of the maximal cluster value of the events of each sector
+    :param time_cluster_hist: (optional) the list of the first crossing time of the events of each sector
+    :return: the maximal cluster value, its first crossing time and its sector for each level and event,
+             shape (n_levels, events_per_level), nan / -1 for the events not processed   (tuple(ndarray))
+    """
+    log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+    n_levels = len(options.nsb_rate)
+    n_jobs = options.n_jobs_fill if hasattr(options, 'n_jobs_fill') else 1
+    levels = [level for level in range(n_levels) if _level_events(level, options)[1] > _level_events(level, options)[0]]
+
+    results = _TriggerResults(trigger_rate_camera, cluster_hist, patch_hist, options)
+
+    context = None
+    if n_jobs != 1 and len(levels) > 1:
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            log.warning('Parallel trigger scan needs the fork start method, run in a single process')
+
+    if context is None:
+        for level_block in _read_levels(levels, options, log):
+            _fill_level_block(level_block, options, results, log)
+    else:
+        global _level_context
+        if n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        n_jobs = min(n_jobs, len(levels))
+        log.info('Processing %d NSB levels in %d processes' % (len(levels), n_jobs))
+        _level_context = (options, results)
+        try:
+            with context.Pool(processes=n_jobs) as pool:
+                # at most n_jobs levels are held in memory, waiting for or being processed
+                pending = collections.deque()
+                for level_block in _read_levels(levels, options, log):
+                    if len(pending) == n_jobs:
+                        results.merge(pending.popleft().get())
+                    pending.append(pool.apply_async(_fill_level, (level_block,)))
+                while pending:
+                    results.merge(pending.popleft().get())
+        finally:
+            _level_context = None
+
+    trigger_rate_camera.data[...] += results.trigger_count
+    trigger_rate_camera.errors = np.sqrt(trigger_rate_camera.data) / (results.time[:, np.newaxis] * 4.) * 1E9
+    trigger_rate_camera.data = trigger_rate_camera.data / (results.time[:, np.newaxis] * 4.) * 1E9
+
+    # the former lists of the maxima per sector
+    for level in range(n_levels):
+        for event in np.where(results.cluster_max_sector[level] >= 0)[0]:
+            sector = results.cluster_max_sector[level, event]
+            if max_cluster_hist is not None:
+                max_cluster_hist[sector].append(results.cluster_max[level, event])
+            if time_cluster_hist is not None:
+                time_cluster_hist[sector].append(results.cluster_max_time[level, event])
+
+    return results.cluster_max, results.cluster_max_time, results.cluster_max_sector
+
+
+class _TriggerResults:
+    """
+    The trigger counts, time normalisation, spectra and per event maxima of a set of NSB levels
+    """
+
+    def __init__(self, trigger_rate_camera, cluster_hist, patch_hist, options):
+        n_levels = len(options.nsb_rate)
+        self.trigger_count = np.zeros(trigger_rate_camera.data.shape)
+        self.time = np.zeros(n_levels)
+        self.cluster_hist = cluster_hist
+        self.patch_hist = patch_hist
+        self.cluster_max = np.full((n_levels, options.events_per_level), np.nan)
+        self.cluster_max_time = np.full((n_levels, options.events_per_level), -1, dtype=int)
+        self.cluster_max_sector = np.full((n_levels, options.events_per_level), -1, dtype=int)
+
+    def empty_like(self):
+        results = copy.copy(self)
+        results.trigger_count = np.zeros_like(self.trigger_count)
+        results.time = np.zeros_like(self.time)
+        results.cluster_hist = None if self.cluster_hist is None else self.cluster_hist._empty_like()
+        results.patch_hist = None if self.patch_hist is None else self.patch_hist._empty_like()
+        results.cluster_max = np.full_like(self.cluster_max, np.nan)
+        results.cluster_max_time = np.full_like(self.cluster_max_time, -1)
+        results.cluster_max_sector = np.full_like(self.cluster_max_sector, -1)
+        return results
+
+    def merge(self, other):
+        self.trigger_count += other.trigger_count
+        self.time += other.time
+        if self.cluster_hist is not None:
+            self.cluster_hist.merge(other.cluster_hist)
+        if self.patch_hist is not None:
+            self.patch_hist.merge(other.patch_hist)
+        filled = other.cluster_max_sector >= 0
+        self.cluster_max[filled] = other.cluster_max[filled]
+        self.cluster_max_time[filled] = other.cluster_max_time[filled]
+        self.cluster_max_sector[filled] = other.cluster_max_sector[filled]
+
+
+# options and results inherited by the processes forked in run
+_level_context = None
+
+
+def _fill_level(level_block):
+    """
+    Process the events of one NSB level in a forked process
+
+    :param level_block: the level index and its events, see _read_levels     (tuple)
+    :return: the results of this level                            (_TriggerResults)
+    """
+    options, results = _level_context
+    level_results = results.empty_like()
+    log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+    _fill_level_block(level_block, options, level_results, log)
+    return level_results
 
-    def integrate_trace(d):
 
-        return np.convolve(d, np.ones((options.baseline_window_width), dtype=int), 'valid')
+def _level_events(level, options):
+    # the range of event numbers of a level, within [evt_min, evt_max]
+    first = max(level * options.events_per_level, options.evt_min)
+    last = min((level + 1) * options.events_per_level, options.evt_max + 1)
+    return first, last
 
-    event_number, event_min, event_max = 0, options.evt_min, options.evt_max
-    level = 0
-    time = np.zeros(len(options.nsb_rate))
-    baseline = []
-    baseline_computed = False
-    baseline_counter = 0
 
-    log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
-    progress_bar = tqdm(total=options.events_per_level * len(options.nsb_rate))
-    tqdm_out = TqdmToLogger(log, level=logging.INFO)
+def _read_levels(levels, options, log):
+    """
+    Read the files once and yield the events of each NSB level
+
+    :param levels: the consecutive level indices                  (list(int))
+    :param options: configuration container
+    :param log: the logger
+    :return: generator of the level index and the list of its events, an event being its number and the adc
+             samples of each telescope                            (tuple(int, list(tuple(int, list(ndarray)))))
+    """
+    if len(levels) == 0:
+        return
+    event_min = _level_events(levels[0], options)[0]
+    event_max = _level_events(levels[-1], options)[1]
+
+    progress_bar = tqdm(total=event_max - event_min)
+    # the MC files are read from the first level, the event numbers starting there
+    event_number = levels[0] * options.events_per_level if options.mc else 0
+    level, events = -1, []
 
     for file in options.file_list:
 
+        if event_number >= event_max:
+            break
+
         # read the file
         _url = options.directory + options.file_basename % file
 
@@ -41,147 +185,128 @@ def run(trigger_rate_camera, options, min_evt=0, cluster_hist=None, patch_hist=N
                                          events_per_level=options.events_per_level, seed=seed,
                                          max_events=len(options.nsb_rate) * options.events_per_level, level_start=0)
             """
-            inputfile_reader = hdf5_mc_event_source(url=_url, events_per_ac_level=0, events_per_dc_level=options.events_per_level, dc_start=0, ac_start=0, max_events=options.evt_max)
+            inputfile_reader = hdf5_mc_event_source(url=_url, events_per_ac_level=0,
+                                                    events_per_dc_level=options.events_per_level,
+                                                    dc_start=levels[0], ac_start=0,
+                                                    max_events=event_max - event_number)
 
         if options.verbose:
             log.debug('--|> Moving to file %s' % _url)
         # Loop over event in this file
 
         for event in inputfile_reader:
-            if event_number > event_max:
+            if event_number >= event_max:
                 break
 
             elif event_number < event_min:
                 event_number += 1
                 continue
 
-            for telid in event.r0.tels_with_data:
-
-                data = np.array(list(event.r0.tel[telid].adc_samples.values()))
-
-                if options.mc:
-
-                    baseline = np.mean(data, axis=1)
-
-                    """
-                    if baseline_counter < options.baseline_window_width :
-                        baseline.append(data)
-                        baseline_counter += data.shape[-1]
-                        event_number += 1
-                        progress_bar.update(1)
-                        break
+            if event_number // options.events_per_level != level:
+                if len(events) > 0:
+                    yield level, events
+                level, events = event_number // options.events_per_level, []
+                log.debug('Going to level %d' % level)
 
-                    elif baseline_counter >= options.baseline_window_width and not baseline_computed:
-                        log.debug('Computing baseline for level % d with %d bins' % (level, options.baseline_window_width))
-                        baseline = np.array(baseline)
-                        baseline = np.mean(np.mean(np.array(baseline), axis=0), axis=-1).astype(int)
-                        baseline_computed = True
-                        log.debug('Baseline recomputed for level %d : = %d [LSB]' % (level, np.mean(baseline)))
-                    """
+            events.append((event_number, [np.array(list(event.r0.tel[telid].adc_samples.values()))
+                                          for telid in event.r0.tels_with_data]))
 
-                    data = data[options.pixel_list, :] - baseline[:, np.newaxis]
+            progress_bar.update(1)
+            event_number += 1
 
-                    """
-                    for i in range(len(options.crate)):
+    if len(events) > 0:
+        yield level, events
 
-                        if not options.crate[i]:
 
-                            data[pixel_in_sector[i]] = np.zeros((len(pixel_in_sector[i]), data.shape[-1]))
+def _fill_level_block(level_block, options, results, log):
+    """
+    Fill the results with the events of one NSB level
 
-                        if not options.pdp[i] and options.crate[i]:
-
-                            data[pixel_in_sector[i]] = np.random.normal(options.baseline_mc, options.sigma_e, size=(len(pixel_in_sector[i]), data.shape[-1]))
-                    """
-
-                else:
+    :param level_block: the level index and its events, see _read_levels     (tuple)
+    :param options: configuration container
+    :param results: the results to fill                           (_TriggerResults)
+    :param log: the logger
+    :return:
+    """
+    level, events = level_block
+    baseline = []
+    baseline_computed = False
+    baseline_counter = 0
 
-                    if baseline_counter < options.baseline_window_width:
-                        baseline.append(data)
-                        baseline_counter += data.shape[-1]
-                        event_number += 1
-                        progress_bar.update(1)
-                        break
+    for event_number, tel_data in events:
 
-                    elif baseline_counter >= options.baseline_window_width and not baseline_computed:
-                        log.debug('Computing baseline for level % d with %d bins' % (level, options.baseline_window_width))
-                        baseline = np.array(baseline)
-                        baseline = np.mean(np.mean(np.array(baseline), axis=0), axis=-1).astype(int)
-                        baseline_computed = True
-                        log.debug('Baseline recomputed for level %d : = %d [LSB]' % (level, np.mean(baseline)))
+        for data in tel_data:
 
+            if options.mc:
 
-                    data = data[options.pixel_list, :] - baseline[:, np.newaxis]
+                baseline = np.mean(data, axis=1)
+                data = data[options.pixel_list, :] - baseline[:, np.newaxis]
 
+                """
+                for i in range(len(options.crate)):
 
+                    if not options.crate[i]:
 
-                if options.blinding:
+                        data[pixel_in_sector[i]] = np.zeros((len(pixel_in_sector[i]), data.shape[-1]))
 
-                    if data.shape[-1] < options.window_width:
-                        time[level] += data.shape[-1]
+                    if not options.pdp[i] and options.crate[i]:
 
-                    else:
-                        time[level] += data.shape[-1] - data.shape[-1] % options.window_width
-                        print(data.shape)
+                        data[pixel_in_sector[i]] = np.random.normal(options.baseline_mc, options.sigma_e, size=(len(pixel_in_sector[i]), data.shape[-1]))
+                """
 
-                    """
-                    elif options.window_width % data.shape[-1] == options.window_width:
+            else:
 
-                        print (options.window_width)
-                        print (data.shape[-1])
-                        print (options.window_width % data.shape[-1])
-                        print(level)
-                        time[level] += data.shape[-1]
-                        print('hello')
-                    """
+                if baseline_counter < options.baseline_window_width:
+                    baseline.append(data)
+                    baseline_counter += data.shape[-1]
+                    break
 
+                elif baseline_counter >= options.baseline_window_width and not baseline_computed:
+                    log.debug('Computing baseline for level % d with %d bins' % (level, options.baseline_window_width))
+                    baseline = np.array(baseline)
+                    baseline = np.mean(np.mean(np.array(baseline), axis=0), axis=-1).astype(int)
+                    baseline_computed = True
+                    log.debug('Baseline recomputed for level %d : = %d [LSB]' % (level, np.mean(baseline)))
 
-                else:
+                data = data[options.pixel_list, :] - baseline[:, np.newaxis]
 
-                    time[level] += data.shape[-1]
-                cluster_trace, patch_trace = compute_cluster_trace(data, options, log)
-                cluster_max_sector, cluster_max, cluster_max_time, cluster_max_id = compute_trigger_info(cluster_trace,
-                                                                                                         options)
-                trigger_count = compute_trigger_count(cluster_trace, options, log)
+            if options.blinding and data.shape[-1] >= options.window_width:
+                results.time[level] += data.shape[-1] - data.shape[-1] % options.window_width
+            else:
+                results.time[level] += data.shape[-1]
 
-                cluster_hist.fill_with_batch(cluster_trace, indices=(level,))
-                patch_hist.fill_with_batch(patch_trace, indices=(level,))
-                max_cluster_hist[cluster_max_sector].append(cluster_max)
-                time_cluster_hist[cluster_max_sector].append(cluster_max_time)
-                trigger_rate_camera.data[level] += trigger_count
+            cluster_trace, patch_trace = compute_cluster_trace(data, options, log)
+            event_index = event_number - level * options.events_per_level
+            results.cluster_max_sector[level, event_index], results.cluster_max[level, event_index], \
+                results.cluster_max_time[level, event_index], _ = compute_trigger_info(cluster_trace, options)
+            results.trigger_count[level] += compute_trigger_count(cluster_trace, options, log)
 
-                progress_bar.update(1)
-                event_number += 1
-                if event_number % options.events_per_level == 0:
-                    log.debug('Going to level %d' % level)
-                    level += 1
-                    baseline = []
-                    baseline_computed = False
-                    baseline_counter = 0
+            if results.cluster_hist is not None:
+                results.cluster_hist.fill_with_batch(cluster_trace, indices=(level,))
+            if results.patch_hist is not None:
+                results.patch_hist.fill_with_batch(patch_trace, indices=(level,))
 
-    trigger_rate_camera.errors = np.sqrt(trigger_rate_camera.data) / (time[:, np.newaxis] * 4.) * 1E9
-    trigger_rate_camera.data = trigger_rate_camera.data / (time[:, np.newaxis] * 4.) * 1E9
 
-    return
+def trigger_operator(options):
+    """
+    The pixel -> patch -> cluster 7 operator of options.cts.camera, cached in options.output_directory under
+    the digest of the camera configuration of options.cts_directory
+    :param options: configuration container        (yaml container)
+    :return: the operator                          (TriggerOperator)
+    """
+    config_file = options.cts_directory + 'config/camera_config.cfg' if hasattr(options, 'cts_directory') else None
+    cache_directory = options.output_directory if hasattr(options, 'output_directory') else None
+    return TriggerOperator.from_camera(options.cts.camera, config_file=config_file, cache_directory=cache_directory)
 
 
 def compute_cluster_trace(data, options, log=None):
-    camera = options.cts.camera
-
-    cluster_trace = np.zeros((len(camera.Clusters_7), data.shape[-1]))
-    patch_trace = np.zeros((len(camera.Patches), data.shape[-1]))
-
-    for cluster_index, cluster in enumerate(camera.Clusters_7):
-
-        for patch_index, patch in enumerate(cluster.patches):
-
-            for pixel in patch.pixels:
-                patch_trace[patch.ID] += data[pixel.ID]
-
-            patch_trace[patch.ID] /= options.compression_factor
-            patch_trace[patch.ID] = np.clip(patch_trace[patch.ID], 0., options.clipping_patch).astype(int)
-            cluster_trace[cluster.ID] += patch_trace[patch.ID]
-
-    return cluster_trace, patch_trace
+    """
+    The cluster 7 and patch traces of an event, or of a block of events
+    :param data: the pixel traces, shape (n_pixels, n_samples) or (n_events, n_pixels, n_samples)
+    :param options: configuration container        (yaml container)
+    :return: the cluster and the patch traces      (tuple(ndarray))
+    """
+    return trigger_operator(options).compute(data, options.compression_factor, options.clipping_patch)
 
 
 def compute_trigger_info(cluster_trace, options):
@@ -208,22 +333,45 @@ def compute_trigger_info(cluster_trace, options):
 
 
 def compute_trigger_count(cluster_trace, options, log):
-    trigger_count = np.zeros(len(options.threshold))
-
-    for threshold_index, threshold in enumerate(options.threshold):
-
-        t = 0
-
-        while t < cluster_trace.shape[-1] - (cluster_trace.shape[-1] % options.window_width):
-
-            if np.any(cluster_trace[:, t] > threshold):
-
-                trigger_count[threshold_index] += 1
-                log.debug('Trigger at time %d [ns] for threshold %d [ADC]' % (t * 4, threshold))
-
-                if options.blinding:
-                    t += options.window_width + 1
-
-            t += 1
+    """
+    Count the triggers of every threshold of options.threshold
+    :param cluster_trace: the cluster traces of an event, shape (n_clusters, n_samples), or of a block of events,
+                          shape (n_events, n_clusters, n_samples)
+    :param options: configuration container, threshold, window_width and blinding being used
+    :param log: the logger
+    :return: the number of triggers of each threshold, summed over the events    (ndarray)
+    """
+    thresholds = np.asarray(options.threshold, dtype=float)
+    n_samples = cluster_trace.shape[-1] - (cluster_trace.shape[-1] % options.window_width)
+    # traces shorter than the window hold no complete window, hence no trigger
+    if n_samples == 0:
+        return np.zeros(len(options.threshold))
+
+    # the camera maximum of each sample, the triggers of all thresholds being crossings of this maximum
+    camera_max = np.max(cluster_trace[..., 0:n_samples], axis=-2).reshape(-1, n_samples)
+
+    if not options.blinding:
+        # the number of samples above each threshold from the sorted maxima
+        sorted_max = np.sort(camera_max, axis=None)
+        trigger_count = sorted_max.shape[0] - np.searchsorted(sorted_max, thresholds, side='right')
+
+    else:
+        # after a trigger at t the next sample tested is t + window_width + 2. For each threshold and event, the
+        # next crossing at or after every sample (n_samples if none) gives the next trigger in one lookup
+        crossing = camera_max[None, ...] > thresholds[:, None, None]
+        next_crossing = np.where(crossing, np.arange(n_samples), n_samples)
+        next_crossing = np.minimum.accumulate(next_crossing[..., ::-1], axis=-1)[..., ::-1]
+        next_crossing = np.concatenate((next_crossing, np.full(next_crossing.shape[:-1] + (1,), n_samples)),
+                                       axis=-1)
+
+        trigger_count = np.zeros(thresholds.shape[0], dtype=int)
+        position = np.zeros(next_crossing.shape[:-1], dtype=int)
+        while True:
+            position = np.take_along_axis(next_crossing, np.minimum(position, n_samples)[..., None], axis=-1)[..., 0]
+            triggered = position < n_samples
+            if not np.any(triggered):
+                break
+            trigger_count += np.sum(triggered, axis=-1)
+            position = position + options.window_width + 2
 
-    return trigger_count
+    return trigger_count.astype(float)
@@ -1,5 +1,13 @@
+#!/usr/bin/env python3
 
-## First run analyse_hvoff script
+# external modules
+from optparse import OptionParser
+import logging,sys
+#internal modules
+from utils import logger
+from utils.stage_graph import StageGraph
+
+## Run the full calibration chain (HV off, SPE/dark, synch, MPE, gain, AC/DC LED) as a graph of stages
 
 
 if __name__ == '__main__':
@@ -11,10 +19,8 @@ if __name__ == '__main__':
 
     # Job configuration (the only mandatory option)
     parser.add_option("-y", "--yaml_config", dest="yaml_config",
-                      help="full path of the yaml configuration function",
-                      default='/data/software/DigiCamCommissioning/options/full_gain.yaml')
-
-    # Other options allows to overwrite the yaml_config interactively
+                      help="full path of the yaml configuration of the chain",
+                      default='options/full_chain.yaml')
 
     # Output level
     parser.add_option("-v", "--verbose",
@@ -25,45 +31,28 @@ if __name__ == '__main__':
     parser.add_option("-l", "--log_file_basename", dest="log_file_basename",
                       help="string to appear in the log file name")
 
-    # Parse the options
-    (options, args) = parser.parse_args()
-
-    # Load the YAML configuration
-    options_yaml = {}
-    with open(options.yaml_config) as f:
-        options_yaml.update(load(f))
+    # Steering of the chain
+    parser.add_option("-j", "--n_jobs", dest="n_jobs", type="int", default=1,
+                      help="number of stages run concurrently, 0 for the number of cpus")
 
+    parser.add_option("-r", "--restart", dest="restart", action="store_true", default=False,
+                      help="run all the stages again instead of resuming after the completed ones")
 
-    # Update with interactive options
-    for key,val in options_yaml.items():
-        if not ((key in options.__dict__.keys()) and (options.__dict__[key])):
-            options.__dict__[key]=val
-        else:
-            options_yaml[key]=options.__dict__[key]
+    # Parse the options
+    (options, args) = parser.parse_args()
 
-    __name__ = options.analysis_module
     # Start the loggers
-    logger.initialise_logger( options )
-    # load the analysis module
-    analysis_module = __import__('analysis.%s'%options.analysis_module,
-                                 locals=None,
-                                 globals=None,
-                                 fromlist=[None],
-                                 level=0)
+    logger.initialise_logger(options, 'full_chain')
+
+    graph = StageGraph.from_config(options.yaml_config)
 
     # Some logging
     log = logging.getLogger(sys.modules['__main__'].__name__)
-    log.info('\t\t-|> Will run %s with the following configuration:'%options.analysis_module)
-    for key,val in options_yaml.items():
-        log.info('\t\t |--|> %s : \t %s'%(key,val))
+    log.info('\t\t-|> Will run the chain %s with the following stages:' % options.yaml_config)
+    for name in graph.order:
+        stage = graph.stages[name]
+        log.info('\t\t |--|> %s : \t %s %s after %s' % (name, stage.config, stage.steps,
+                                                          sorted(graph.dependencies[name])))
     log.info('-|')
 
-    analysis_hvoff.create_histo(options['hvoff'])
-    analysis_hvoff.perform_analysis(options['hvoff'])
-    analysis_spe.create_histo(options['spe'])
-    analysis_spe.perform_analysis(options['spe'])
-    analysis_mpe.create_histo(options['mpe'])
-    analysis_gain.create_histo(options['gain'])
-    analysis_gain.perform_analysis(options['gain'])
-
-
+    graph.run(n_jobs=options.n_jobs, restart=options.restart)
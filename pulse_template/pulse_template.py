@@ -1,19 +1,39 @@
+import os
+
 import numpy as np
-from scipy.optimize import splev, splrep, splint, splder
+from scipy.interpolate import splev, splrep, splint, splder
 import pickle
 
 
 class PulseTemplate:
-
-    def __init__(self, n_pixels=1296, filename=None):
+    """
+    Normalised pulse template of each pixel, stored as splines and evaluated from lookup tables of the value and of
+    the derivative sampled every table_step [ns]
+    """
+
+    def __init__(self, n_pixels=1296, filename=None, table_step=0.1):
+        """
+        :param n_pixels: the number of pixels of the camera                                      (int)
+        :param filename: a template saved by save or a npz file of splines and pixel_id (pulse_shape.npz), the
+                         tables of the latter being cached next to it                            (str)
+        :param table_step: the time step of the lookup tables [ns]                               (float)
+        """
+        self.n_pixels = n_pixels
+        self.table_step = table_step
+        self.table_time = None
+        self.table_index = None
+        self.table_value = None
+        self.table_derivative = None
 
         if filename is not None:
 
-            self._load(filename)
+            if filename.endswith('.npz'):
+                self._load_npz(filename)
+            else:
+                self._load(filename)
 
         else:
 
-            self.n_pixels = n_pixels
             self.splines = [None]*self.n_pixels
             self.splines_derivative = [None]*self.n_pixels
             self.t_min = 0
@@ -31,11 +51,82 @@ class PulseTemplate:
             max = np.max(splev(t_temp, self.splines[pixel]))
             self.splines[pixel] = splrep(time_data, pulse_data[i]/max, **kwargs)
 
-            self.spines_derivative[pixel] = splder(self.splines[pixel])
-
-    def evaluate(self, time, pixels_id, derivative=0):
-
-        return [splev(time, self.splines[pixel], der=derivative) for pixel in pixels_id]
+            self.splines_derivative[pixel] = splder(self.splines[pixel])
+
+        self.build_tables()
+
+    def build_tables(self):
+        """
+        Sample the splines of all the pixels on a common time grid covering their knots
+
+        :return:
+        """
+        pixels = [pixel for pixel, spline in enumerate(self.splines) if spline is not None]
+        self.table_index = np.full(len(self.splines), -1, dtype=int)
+        self.table_index[pixels] = np.arange(len(pixels))
+        if len(pixels) == 0:
+            self.table_time = np.zeros(1)
+            self.table_value = np.zeros((1, 1))
+            self.table_derivative = np.zeros((1, 1))
+            return
+
+        t_min = min(self.splines[pixel][0][0] for pixel in pixels)
+        t_max = max(self.splines[pixel][0][-1] for pixel in pixels)
+        self.table_time = t_min + np.arange(int(np.ceil((t_max - t_min) / self.table_step)) + 1) * self.table_step
+        # one extra row of zeros for the pixels without template
+        self.table_value = np.zeros((len(pixels) + 1, self.table_time.shape[0]))
+        self.table_derivative = np.zeros((len(pixels) + 1, self.table_time.shape[0]))
+        for row, pixel in enumerate(pixels):
+            spline = self.splines[pixel]
+            inside = (self.table_time >= spline[0][0]) & (self.table_time <= spline[0][-1])
+            self.table_value[row, inside] = splev(self.table_time[inside], spline)
+            self.table_derivative[row, inside] = splev(self.table_time[inside], spline, der=1)
+
+    def evaluate(self, time, pixels_id, derivative=0, kind='linear'):
+        """
+        Evaluate the templates from the lookup tables, 0 outside the time range of the splines
+
+        :param time: the times [ns] common to all the pixels, or of shape (len(pixels_id), n, ...) for times
+                     per pixel                                                                   (np.array)
+        :param pixels_id: the pixels                                                             (list(int))
+        :param derivative: 0 for the template, 1 for its derivative                             (int)
+        :param kind: 'linear' interpolation or 'cubic' Hermite interpolation from the value and derivative tables
+                                                                                                 (str)
+        :return: the templates, shape (len(pixels_id), ...)                                      (np.array)
+        """
+        if self.table_value is None:
+            self.build_tables()
+        rows = self.table_index[np.asarray(pixels_id, dtype=int)]
+        time = np.asarray(time, dtype=float)
+        if time.ndim < 2 or time.shape[0] != rows.shape[0]:
+            time = np.broadcast_to(time, rows.shape + time.shape)
+        rows = rows.reshape(rows.shape + (1,) * (time.ndim - 1))
+
+        n_times = self.table_time.shape[0]
+        position = (time - self.table_time[0]) / self.table_step
+        inside = (position >= 0) & (position <= n_times - 1)
+        index = np.clip(position, 0, max(n_times - 2, 0)).astype(int)
+        fraction = np.where(inside, position - index, 0.)
+        # the times outside the tables read the row of zeros
+        rows = np.where(inside, rows, -1)
+        next_index = np.minimum(index + 1, n_times - 1)
+
+        value_0, value_1 = self.table_value[rows, index], self.table_value[rows, next_index]
+        slope_0, slope_1 = self.table_derivative[rows, index], self.table_derivative[rows, next_index]
+
+        if kind == 'linear':
+            if derivative == 0:
+                return value_0 + fraction * (value_1 - value_0)
+            return slope_0 + fraction * (slope_1 - slope_0)
+        elif kind != 'cubic':
+            raise ValueError('Unknown interpolation %s' % kind)
+
+        s, h = fraction, self.table_step
+        if derivative == 0:
+            return (value_0 * (2 * s ** 3 - 3 * s ** 2 + 1) + slope_0 * h * (s ** 3 - 2 * s ** 2 + s) +
+                    value_1 * (3 * s ** 2 - 2 * s ** 3) + slope_1 * h * (s ** 3 - s ** 2))
+        return ((value_1 - value_0) * (6 * s - 6 * s ** 2) / h + slope_0 * (3 * s ** 2 - 4 * s + 1) +
+                slope_1 * (3 * s ** 2 - 2 * s))
 
     def compute_integral(self, pixels_id):
 
@@ -58,13 +149,41 @@ class PulseTemplate:
             tmp_dict = pickle.load(output)
             self.__dict__.update(tmp_dict)
 
-
-
-
-
-
-
-
-
-
-
+        if self.table_value is None:
+            self.build_tables()
+
+    def _load_npz(self, filename):
+        """
+        Load the splines of a npz file with the keys 'spline' and 'pixel_id', the lookup tables being read from
+        (or written to) the file <filename>_table.npz if it is newer than filename
+
+        :param filename: the npz file                                                            (str)
+        :return:
+        """
+        data = np.load(filename)
+        pixel_id = data['pixel_id']
+        self.n_pixels = max(self.n_pixels, int(np.max(pixel_id)) + 1)
+        self.splines = [None]*self.n_pixels
+        self.splines_derivative = [None]*self.n_pixels
+        for pixel, spline in zip(pixel_id, data['spline']):
+            self.splines[pixel] = tuple(spline)
+        self.t_min = 0
+        self.t_max = None
+
+        table_filename = os.path.splitext(filename)[0] + '_table.npz'
+        if os.path.isfile(table_filename) and os.path.getmtime(table_filename) >= os.path.getmtime(filename):
+            table = np.load(table_filename)
+            if table['table_step'] == self.table_step and np.array_equal(table['pixel_id'], pixel_id):
+                self.table_time = table['table_time']
+                self.table_index = table['table_index']
+                self.table_value = table['table_value']
+                self.table_derivative = table['table_derivative']
+                return
+
+        self.build_tables()
+        try:
+            np.savez(table_filename, table_step=self.table_step, pixel_id=pixel_id, table_time=self.table_time,
+                     table_index=self.table_index, table_value=self.table_value,
+                     table_derivative=self.table_derivative)
+        except OSError:
+            pass
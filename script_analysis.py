@@ -5,12 +5,11 @@ from optparse import OptionParser
 from  yaml import load,dump
 import matplotlib.pyplot as plt
 import logging,sys
-from utils.geometry import generate_geometry
+from utils.geometry import setup_pixels
 #internal modules
 from utils import logger
-import numpy as np
-from cts_core.cameratestsetup import CTS
-from cts_core.camera import Camera
+from utils.stage_cache import StageCache, run_stage
+from utils.calibration_store import store_fit_results
 
 if __name__ == '__main__':
     """
@@ -75,83 +74,8 @@ if __name__ == '__main__':
                                  fromlist=[None],
                                  level=0)
 
-    # cts_path = '/data/software/CTS/'
-    cts_path = '/home/alispach/Documents/PhD/ctasoft/CTS/'
-
-    if hasattr(options,'angle_cts'):
-
-        options.cts = CTS(cts_path + 'config/cts_config_' + str(int(options.angle_cts)) + '.cfg', cts_path + 'config/camera_config.cfg', angle=options.angle_cts, connected=True)
-        options.pixel_list = generate_geometry(options.cts, available_board=None)[1]
-
-    elif not hasattr(options, 'pixel_list'):
-
-        if not hasattr(options, 'n_pixels'):
-
-            options.cts = CTS(cts_path + 'config/cts_config_' + str(0) + '.cfg',
-                              cts_path + 'config/camera_config.cfg', angle=0, connected=True)
-            options.pixel_list = generate_geometry(options.cts, available_board=None, all_camera=True)[1]
-
-    else:
-        options.cts = CTS(cts_path + 'config/cts_config_' + str(0) + '.cfg',
-                          cts_path + 'config/camera_config.cfg', angle=0, connected=True)
-
-        if options.pixel_list == 'all':
-
-            options.cts = options.cts = CTS(cts_path + 'config/cts_config_' + str(0) + '.cfg', cts_path + 'config/camera_config.cfg', angle=0, connected=True)
-            options.pixel_list = generate_geometry(options.cts, available_board=None, all_camera=True)[1]
-
-        elif hasattr(options, 'n_pixels'):
-
-            options.pixel_list = np.arange(0, options.n_pixels, 1)
-
-        else:
-
-            options.pixel_list = options.pixel_list
-
-
-    if not hasattr(options,'pixel_list') and hasattr(options,'n_pixels'):
-        # TODO add usage of digicam and cts geometry to define the list
-        options.pixel_list = np.arange(0, options.n_pixels, 1)
-
-
-
-    if hasattr(options, 'n_clusters'):
-
-        if options.n_clusters==1:
-
-            camera = Camera(options.cts_directory + 'config/camera_config_clusters.cfg')
-            patches_in_cluster = np.load(options.cts_directory + 'config/cluster.p')['patches_in_cluster']
-
-            patch_index = 300
-            patches_in_cluster = patches_in_cluster[patch_index]
-
-            #print(patches_in_cluster)
-            options.pixel_list = []
-            options.cluster_list = [patch_index]
-
-            for patch in patches_in_cluster:
-
-                for pixel in camera.Patches[patch].pixels:
-
-                    options.pixel_list.append(pixel.ID)
-
-            for pixel in camera.Patches[patch_index].pixels:
-                options.pixel_list.append(pixel.ID)
-
-
-
-
-        else:
-
-            exit()
-
-
-    if hasattr(options, 'clusters'):
-
-        if options.clusters=='all' or options.clusters is None:
-
-            options.clusters = [i for i in range(432)]
-
+    # the camera test setup and the pixels to analyse
+    setup_pixels(options)
 
     # Some logging
     log = logging.getLogger(sys.modules['__main__'].__name__)
@@ -160,17 +84,22 @@ if __name__ == '__main__':
         log.info('\t\t |--|> %s : \t %s'%(key,val))
     log.info('-|')
 
+    # Cache of the products of the stages (options stage_cache and stage_cache_directory)
+    stage_cache = StageCache.from_options(options)
+
     # Histogram creation
     if options.create_histo:
         # Call the histogram creation function
         log.info('\t\t-|> Create the analysis histogram')
-        analysis_module.create_histo(options)
+        run_stage(analysis_module.create_histo, options, 'create_histo', stage_cache)
 
     # Analysis of the histogram
     if options.perform_analysis:
         # Call the histogram creation function
         log.info('\t\t-|> Perform the analysis')
-        analysis_module.perform_analysis(options)
+        run_stage(analysis_module.perform_analysis, options, 'perform_analysis', stage_cache)
+        # Fit results in the calibration database (option calibration_database)
+        store_fit_results(options)
 
     # Display the results of the analysis
     if options.display_results:
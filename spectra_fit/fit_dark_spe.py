@@ -104,9 +104,9 @@ def labels_func(*args,n_peaks = 5, **kwargs):
 
 '''
 import numpy as np
-from utils.pdf import multi_gaussian_with0
+from utils.pdf import multi_gaussian_with0, gaussian_derivatives
 
-__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
+__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func", "jac_func"]
 
 #TODO Find p0, slice, bounds, from args=(y,x) if config==None
 
@@ -164,3 +164,31 @@ def fit_func(p, x, *args,config = None, **kwargs):
     p_new[11] = p[8]
 
     return multi_gaussian_with0(p_new, x)
+
+
+# noinspection PyUnusedLocal
+def jac_func(p, x, *args, config = None, **kwargs):
+    """
+    Jacobian of fit_func
+    :param p: [sigma_e, sigma_1, gain, amplitude_1, amplitude_2, amplitude_3, offset, amplitude_4, amplitude_5]
+    :param x: x
+    :param config: the previous fit result holding the baseline in config[1][0]
+    :return: the derivatives of fit_func with respect to p, shape (len(x), len(p))
+    """
+    x = np.asfarray(x)
+    jac = np.zeros((len(p),) + x.shape)
+    sigma_e, sigma_1, gain, offset = p[0], p[1], p[2], p[6]
+    # index of the amplitude of the peaks 1 to 5 in p
+    amplitude_index = [3, 4, 5, 7, 8]
+
+    for k in range(1, 6):
+        sigma = np.sqrt(sigma_e ** 2 + k * sigma_1 ** 2)
+        mean = k * gain + config[1][0] + offset
+        value, d_sigma, d_mean, d_amplitude = gaussian_derivatives([sigma, mean, p[amplitude_index[k - 1]]], x)
+        jac[0] += d_sigma * sigma_e / sigma
+        jac[1] += d_sigma * k * sigma_1 / sigma
+        jac[2] += d_mean * k
+        jac[6] += d_mean
+        jac[amplitude_index[k - 1]] = d_amplitude
+
+    return jac.T
@@ -1,14 +1,15 @@
 import numpy as np
 import peakutils
 from utils.pdf import gaussian_sum
+from utils.pdf_kernels import gaussian_peaks
 from scipy.optimize import curve_fit
 
-__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
+__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func", "jac_func", "batch_fit_func", "batch_jac_func"]
 
 
 import numpy as np
 
-__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
+__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func", "jac_func", "batch_fit_func", "batch_jac_func"]
 
 #TODO Find p0, slice, bounds, from args=(y,x) if config==None  ADD Jac
 
@@ -227,6 +228,88 @@ def fit_func(p, x ,*args, **kwargs):
     """
     return gaussian_sum(p, x)
 
+
+def jac_func(p, x, *args, **kwargs):
+    """
+    Jacobian of fit_func
+    :param p: [baseline, gain, sigma_e, sigma_1, amplitudes...]
+    :param x: x
+    :return: the derivatives of fit_func with respect to p, shape (len(x), len(p))
+    """
+    jac = np.zeros((len(p),) + x.shape)
+    bin_width = x[1] - x[0]
+
+    baseline = p[0]
+    gain = p[1]
+    sigma_e = p[2]
+    sigma_1 = p[3]
+    amplitudes = np.asarray(p[4:], dtype=float)
+
+    # all the peaks at once, shape (n_peaks, n_bins)
+    i = np.arange(len(p) - 4)
+    sigma = np.sqrt(sigma_e ** 2 + i * sigma_1 ** 2 + bin_width ** 2 / 12.)
+    residual = x[None, :] - (baseline + i * gain)[:, None]
+    peaks = gaussian_peaks(x, baseline + i * gain, sigma)
+    d_mean = amplitudes[:, None] * peaks * residual / sigma[:, None] ** 2
+    d_sigma = amplitudes[:, None] * peaks * (residual ** 2 / sigma[:, None] ** 3 - 1. / sigma[:, None])
+    jac[0] = np.sum(d_mean, axis=0)
+    jac[1] = np.dot(i, d_mean)
+    jac[2] = np.dot(sigma_e / sigma, d_sigma)
+    jac[3] = np.dot(i * sigma_1 / sigma, d_sigma)
+    jac[4:] = peaks
+
+    return jac.T
+
+
+def _batch_peaks(p, x):
+    """
+    The normalised peaks of a batch of histograms
+    :param p: [baseline, gain, sigma_e, sigma_1, amplitudes...] of each histogram, shape (n_hist, n_params)
+    :param x: x
+    :return: the peaks (n_hist, n_peaks, len(x)), their means and sigmas (n_hist, n_peaks)
+    """
+    bin_width = x[1] - x[0]
+    i = np.arange(p.shape[1] - 4)
+    sigma = np.sqrt(p[:, 2, None] ** 2 + i * p[:, 3, None] ** 2 + bin_width ** 2 / 12.)
+    mean = p[:, 0, None] + i * p[:, 1, None]
+    return gaussian_peaks(x, mean, sigma), mean, sigma
+
+
+def batch_fit_func(p, x, *args, **kwargs):
+    """
+    fit_func for a batch of histograms
+    :param p: [baseline, gain, sigma_e, sigma_1, amplitudes...] of each histogram, shape (n_hist, n_params)
+    :param x: x
+    :return: the sum of the peaks, shape (n_hist, len(x))
+    """
+    p = np.asarray(p, dtype=float)
+    peaks = _batch_peaks(p, x)[0]
+    return np.einsum('nk,nkb->nb', p[:, 4:], peaks)
+
+
+def batch_jac_func(p, x, *args, **kwargs):
+    """
+    jac_func for a batch of histograms
+    :param p: [baseline, gain, sigma_e, sigma_1, amplitudes...] of each histogram, shape (n_hist, n_params)
+    :param x: x
+    :return: the derivatives with respect to p, shape (n_hist, len(x), n_params)
+    """
+    p = np.asarray(p, dtype=float)
+    jac = np.zeros(p.shape[:1] + x.shape + p.shape[1:])
+    i = np.arange(p.shape[1] - 4)
+    peaks, mean, sigma = _batch_peaks(p, x)
+    residual = x - mean[..., None]
+    weighted = p[:, 4:, None] * peaks
+    d_mean = weighted * residual / sigma[..., None] ** 2
+    d_sigma = weighted * (residual ** 2 / sigma[..., None] ** 3 - 1. / sigma[..., None])
+    jac[..., 0] = np.sum(d_mean, axis=1)
+    jac[..., 1] = np.einsum('k,nkb->nb', i, d_mean)
+    jac[..., 2] = np.einsum('nk,nkb->nb', p[:, 2, None] / sigma, d_sigma)
+    jac[..., 3] = np.einsum('nk,nkb->nb', i * p[:, 3, None] / sigma, d_sigma)
+    jac[..., 4:] = np.swapaxes(peaks, 1, 2)
+
+    return jac
+
 # noinspection PyUnusedLocal,PyUnusedLocal
 def label_func(*args,n_peaks = 22, **kwargs):
     """
@@ -1,7 +1,7 @@
 import numpy as np
 import utils.pdf
 
-__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
+__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func", "jac_func"]
 
 #TODO Find p0, slice, bounds, from args=(y,x) if config==None
 
@@ -93,9 +93,22 @@ def fit_func(p, x,*args,**kwargs):
     return utils.pdf.gaussian([sigma_e,mu * (1 + mu_xt) * gain,amplitude],x )
 
 
-def jac_func(x, *args, **kwargs):
-
-    return #TODO compute jacobian matrix
+def jac_func(p, x, *args, **kwargs):
+    """
+    Jacobian of fit_func
+    :param p: [mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset]
+    :param x: x
+    :return: the derivatives of fit_func with respect to p, shape (len(x), len(p))
+    """
+    [mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset] = p
+    jac = np.zeros((len(p),) + x.shape)
+    value, d_sigma, d_mean, d_amplitude = utils.pdf.gaussian_derivatives([sigma_e, mu * (1 + mu_xt) * gain, amplitude], x)
+    jac[0] = d_mean * (1 + mu_xt) * gain
+    jac[1] = d_mean * mu * gain
+    jac[2] = d_mean * mu * (1 + mu_xt)
+    jac[4] = d_sigma
+    jac[6] = d_amplitude
+    return jac.T
 
 def label_func(*args, ** kwargs):
     """
@@ -1,6 +1,7 @@
 import numpy as np
+import utils.pdf
 
-__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
+__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func", "jac_func", "batch_fit_func", "batch_jac_func"]
 
 
 
@@ -79,9 +80,48 @@ def fit_func(p, x):
     :return: G(x)
     """
     bin_width = x[1] - x[0]
-    p[2] = np.sqrt(p[2]**2 + bin_width**2/12.)
+    sigma = np.sqrt(p[2]**2 + bin_width**2/12.)
 
-    return p[0] / p[2] / np.sqrt(2. * np.pi) * np.exp(-(np.asfarray(x) - p[1]) ** 2 / (2. * p[2] ** 2))
+    return p[0] / sigma / np.sqrt(2. * np.pi) * np.exp(-(np.asfarray(x) - p[1]) ** 2 / (2. * sigma ** 2))
+
+
+def jac_func(p, x, *args, **kwargs):
+    """
+    Jacobian of fit_func
+    :param p: [norm,mean,sigma]
+    :param x: x
+    :return: the derivatives of G(x) with respect to p, shape (len(x), len(p))
+    """
+    bin_width = x[1] - x[0]
+    sigma = np.sqrt(p[2]**2 + bin_width**2/12.)
+    value, d_sigma, d_mean, d_norm = utils.pdf.gaussian_derivatives([sigma, p[1], p[0]], np.asfarray(x))
+
+    return np.array([d_norm, d_mean, d_sigma * p[2] / sigma]).T
+
+
+def batch_fit_func(p, x, *args, **kwargs):
+    """
+    fit_func for a batch of histograms
+    :param p: [norm,mean,sigma] of each histogram, shape (n_hist, 3)
+    :param x: x
+    :return: G(x), shape (n_hist, len(x))
+    """
+    return fit_func(np.asarray(p, dtype=float).T[..., None], x)
+
+
+def batch_jac_func(p, x, *args, **kwargs):
+    """
+    jac_func for a batch of histograms
+    :param p: [norm,mean,sigma] of each histogram, shape (n_hist, 3)
+    :param x: x
+    :return: the derivatives of G(x) with respect to p, shape (n_hist, len(x), 3)
+    """
+    p = np.asarray(p, dtype=float).T[..., None]
+    bin_width = x[1] - x[0]
+    sigma = np.sqrt(p[2]**2 + bin_width**2/12.)
+    value, d_sigma, d_mean, d_norm = utils.pdf.gaussian_derivatives([sigma, p[1], p[0]], np.asfarray(x))
+
+    return np.stack([d_norm, d_mean, d_sigma * p[2] / sigma], axis=-1)
 
 
 # noinspection PyUnusedLocal,PyUnusedLocal
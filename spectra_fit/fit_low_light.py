@@ -3,8 +3,9 @@ from scipy.optimize import curve_fit
 import peakutils
 import logging,sys
 import utils.pdf
+import utils.pdf_kernels
 
-__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
+__all__ = ["p0_func", "slice_func", "bounds_func", "fit_func", "jac_func"]
 
 
 # noinspection PyUnusedLocal,PyUnusedLocal
@@ -165,7 +166,19 @@ def bounds_func(y,x,*args, config=None, **kwargs):
     return param_min, param_max
 
 
-def fit_func(p, x, *args, **kwargs):
+def _peaks(x, baseline, gain):
+    """
+    The number of photo-electrons which can contribute to the spectrum in the range of x
+    """
+    n_peak=40
+    n_peakmin = 0
+    if len(x)>0:
+        n_peak = int(float(x[-1] - baseline) / gain * 1.5)
+        n_peakmin = max(0,int(float(x[0] - baseline) / gain * 0.7))
+    return np.arange(n_peakmin, n_peak)
+
+
+def fit_func(p, x, *args, tolerance=utils.pdf_kernels.TOLERANCE, **kwargs):
     """
     Simple gaussian pdf
     :param p: [norm,mean,sigma]
@@ -174,21 +187,25 @@ def fit_func(p, x, *args, **kwargs):
     """
     #mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset, variance = p
     mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset = p
-    temp = np.zeros(x.shape)
-    n_peak=40
-    n_peakmin = 0
     # TODO avoir si ca marche quand on utilise en high light
-    if len(x)>0:
-        n_peak = int(float(x[-1] - baseline) / gain * 1.5)
-        n_peakmin = max(0,int(float(x[0] - baseline) / gain * 0.7))
+    return utils.pdf_kernels.mpe_distribution(x, mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude,
+                                              _peaks(x, baseline, gain), smearing=1./12., tolerance=tolerance)
 
-    x = x - baseline
-    for n in range(n_peakmin,n_peak):
-        sigma_n = np.sqrt(sigma_e ** 2 + n * sigma_1 ** 2 + 1./12.) # * gain
-        param_gauss = [sigma_n, n*gain, 1.]
-        temp += utils.pdf.generalized_poisson(n, mu, mu_xt) * utils.pdf.gaussian(param_gauss, x)
 
-    return temp * amplitude
+def jac_func(p, x, *args, tolerance=utils.pdf_kernels.TOLERANCE, **kwargs):
+    """
+    Jacobian of fit_func (the number of peaks summed being taken as constant)
+    :param p: [mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset]
+    :param x: x
+    :return: the derivatives of fit_func with respect to p, shape (len(x), len(p))
+    """
+    mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset = p
+    jac = utils.pdf_kernels.mpe_distribution_derivatives(x, mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude,
+                                                         _peaks(x, baseline, gain), smearing=1./12.,
+                                                         tolerance=tolerance)
+    # the offset is not used by fit_func
+    jac[7] = 0.
+    return jac.T
 
 def label_func(*args, ** kwargs):
     """
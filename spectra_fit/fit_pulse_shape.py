@@ -4,6 +4,7 @@ import scipy.interpolate
 from scipy.interpolate import splev
 import logging,sys
 import utils.pdf
+from pulse_template.pulse_template import PulseTemplate
 
 __all__ = ["p0_func", "slice_func", "bounds_func", "fit_func"]
 
@@ -108,14 +109,25 @@ def fit_func(parameter, time, pixel_id, *args, **kwargs):
     baseline = parameter[2]
 
     #filename_pulse_shape = 'utils/pulse_SST-1M_AfterPreampLowGain.dat'  # pulse shape template file
-    filename_pulse_shape = 'pulse_template/pulse_shape.npz'  # pulse shape template file
+    template = pulse_template()
 
-    data = np.load(filename_pulse_shape)
-    pixel = data['pixel_id']
+    return amplitude * template.evaluate(time - t_0 + 210, [pixel_id], kind='cubic')[0] + baseline
 
-    spline = data['spline'][np.argwhere(pixel == pixel_id)[0][0]]
 
-    return amplitude * splev(time - t_0 + 210, spline) + baseline
+def pulse_template(filename='pulse_template/pulse_shape.npz'):
+    """
+    The pulse template of fit_func, loaded once
+
+    :param filename: the pulse shape template file (str)
+    :return: the template (PulseTemplate)
+    """
+    if filename not in _pulse_templates:
+        _pulse_templates[filename] = PulseTemplate(filename=filename)
+    return _pulse_templates[filename]
+
+
+# templates already loaded by pulse_template, {filename: PulseTemplate}
+_pulse_templates = {}
 
 def label_func(*args, ** kwargs):
     """
@@ -0,0 +1,206 @@
+import numpy as np
+
+# Per event baseline estimated from the first samples of the traces, updated only for the
+# pixels whose rms over these samples is compatible with the dark rms (no pulse in the
+# baseline samples). The events are treated by blocks, the mean and rms coming from one
+# pass of sums and sums of squares. The fillers buffer their events in an EventBlock to
+# subtract the baseline of a whole block at once
+
+__all__ = ["BaselineTracker", "EventBlock"]
+
+
+class BaselineTracker:
+    """
+    Track the baseline of each pixel over a stream of events
+
+    Modes:
+      - 'last_good': the baseline of the last event with a good rms (former behaviour of the fillers)
+      - 'ema'      : exponential moving average of the good events, the weight of the last one being alpha
+      - 'rolling'  : average of the good events among the last window events
+    A pixel without any good event keeps its previous baseline, the first n_first events are good for all the
+    pixels (the former fillers overwrite every pixel for the first event, mpe_hist and n_pe_hist for the first
+    two events)
+    """
+
+    def __init__(self, n_samples, params=None, mode='last_good', alpha=0.1, window=100, rms_cut=0.5, n_first=1):
+        """
+        :param n_samples: the number of samples at the start of the traces used for the baseline
+                                                                          (int)
+        :param params: the baseline parameters of each pixel, params[:, 2] and params[:, 3] being the mean and
+                       the spread of the rms in dark run, None to accept all the events
+                                                                          (np.array)
+        :param mode: 'last_good', 'ema' or 'rolling'                      (str)
+        :param alpha: the weight of the last event in 'ema' mode          (float)
+        :param window: the number of events averaged in 'rolling' mode    (int)
+        :param rms_cut: the maximum (rms - params[:, 2]) / params[:, 3] of a good event
+                                                                          (float)
+        :param n_first: the number of first events good for all the pixels (int)
+        """
+        if mode not in ('last_good', 'ema', 'rolling'):
+            raise ValueError('Unknown baseline mode %s' % mode)
+        self.n_samples = n_samples
+        self.params = params
+        self.mode = mode
+        self.alpha = alpha
+        self.window = window
+        self.rms_cut = rms_cut
+        self.n_first = n_first
+        # number of events seen
+        self.n_events = 0
+        # current baseline of each pixel
+        self.baseline = None
+        # mean and rms of the events of the last block
+        self.mean = None
+        self.rms = None
+        # the sums of the good means and the number of good events of the last window - 1 events ('rolling')
+        self._tail_sum = None
+        self._tail_count = None
+
+    @classmethod
+    def from_options(cls, options, n_first=1):
+        """
+        The tracker configured by the options, None if no per event baseline is requested
+
+        :param options: a dictionary containing at least the following keys:
+            - 'baseline_per_event_limit' : the number of baseline samples           (int)
+            - 'output_directory'         : the directory of the baseline parameters (str)
+            - 'baseline_param_data'      : (optional) the file of the baseline parameters
+                                                                                    (str)
+            - 'baseline_mode'            : (optional) see BaselineTracker           (str)
+            - 'baseline_alpha'           : (optional) the 'ema' weight              (float)
+            - 'baseline_window'          : (optional) the 'rolling' window          (int)
+        :param n_first: see BaselineTracker                                         (int)
+        :return: the tracker                                                        (BaselineTracker)
+        """
+        if not hasattr(options, 'baseline_per_event_limit'):
+            return None
+        params = None
+        if hasattr(options, 'baseline_param_data'):
+            params = np.load(options.output_directory + options.baseline_param_data)['params']
+        return cls(options.baseline_per_event_limit, params=params,
+                   mode=options.baseline_mode if hasattr(options, 'baseline_mode') else 'last_good',
+                   alpha=options.baseline_alpha if hasattr(options, 'baseline_alpha') else 0.1,
+                   window=options.baseline_window if hasattr(options, 'baseline_window') else 100,
+                   n_first=n_first)
+
+    def _statistics(self, block):
+        samples = block[..., 0:self.n_samples]
+        sum_1 = np.sum(samples, axis=-1, dtype=float)
+        sum_2 = np.einsum('...i,...i->...', samples, samples, dtype=float)
+        mean = sum_1 / samples.shape[-1]
+        rms = np.sqrt(np.maximum(sum_2 / samples.shape[-1] - mean ** 2, 0.))
+        return mean, rms
+
+    @staticmethod
+    def _forward_fill(values, valid, initial):
+        # for each event the last valid value, initial before the first one
+        index = np.where(valid, np.arange(values.shape[0])[:, None] + 1, 0)
+        np.maximum.accumulate(index, axis=0, out=index)
+        return np.take_along_axis(np.concatenate((initial[None], values)), index, axis=0)
+
+    def _rolling(self, mean, good):
+        if self._tail_sum is None:
+            self._tail_sum = np.zeros((0,) + mean.shape[1:])
+            self._tail_count = np.zeros((0,) + mean.shape[1:])
+        n_tail = self._tail_sum.shape[0]
+        cumulative_sum = np.cumsum(np.concatenate((np.zeros((1,) + mean.shape[1:]), self._tail_sum,
+                                                   np.where(good, mean, 0.))), axis=0)
+        cumulative_count = np.cumsum(np.concatenate((np.zeros((1,) + mean.shape[1:]), self._tail_count, good)),
+                                     axis=0)
+        # sums over the window ending at each event of the block
+        end = np.arange(n_tail + 1, cumulative_sum.shape[0])
+        start = np.maximum(end - self.window, 0)
+        window_sum = cumulative_sum[end] - cumulative_sum[start]
+        window_count = cumulative_count[end] - cumulative_count[start]
+
+        n_keep = min(self.window - 1, cumulative_sum.shape[0] - 1)
+        self._tail_sum = np.diff(cumulative_sum[-n_keep - 1:], axis=0)
+        self._tail_count = np.diff(cumulative_count[-n_keep - 1:], axis=0)
+
+        valid = window_count > 0
+        return self._forward_fill(window_sum / np.where(valid, window_count, 1.), valid, self.baseline)
+
+    def _ema(self, mean, good):
+        baselines = np.empty(mean.shape)
+        baseline = self.baseline
+        for i in range(mean.shape[0]):
+            baseline = np.where(good[i], baseline + self.alpha * (mean[i] - baseline), baseline)
+            baselines[i] = baseline
+        return baselines
+
+    def update(self, block):
+        """
+        Update the baseline with a block of events
+
+        :param block: the traces, shape (n_events, n_pixels, n_samples) or (n_pixels, n_samples) for one event
+                                                                          (np.array)
+        :return: the baseline of each event and pixel, shape block.shape[:-1]
+                                                                          (np.array)
+        """
+        single_event = block.ndim == 2
+        if single_event:
+            block = block[None]
+        self.mean, self.rms = self._statistics(block)
+        good = np.ones(self.mean.shape, dtype=bool)
+        if self.params is not None:
+            good = (self.rms - self.params[:, 2]) / self.params[:, 3] < self.rms_cut
+        good[0:max(self.n_first - self.n_events, 0)] = True
+        self.n_events += good.shape[0]
+        if self.baseline is None:
+            self.baseline = self.mean[0]
+
+        if self.mode == 'last_good':
+            baselines = self._forward_fill(self.mean, good, self.baseline)
+        elif self.mode == 'ema':
+            baselines = self._ema(self.mean, good)
+        else:
+            baselines = self._rolling(self.mean, good)
+        self.baseline = baselines[-1]
+
+        if single_event:
+            self.mean, self.rms = self.mean[0], self.rms[0]
+            return baselines[0]
+        return baselines
+
+    def subtract(self, block):
+        """
+        Update the baseline with a block of events and subtract it
+
+        :param block: see update                                          (np.array)
+        :return: the baseline subtracted traces                           (np.array)
+        """
+        return block - self.update(block)[..., None]
+
+
+class EventBlock:
+    """
+    The events of a filler buffered until they are treated together, with the slot of each one in the batch
+    of the filler
+    """
+
+    def __init__(self):
+        self.events = []
+        self.slots = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def append(self, data, slot=None):
+        """
+        :param data: the traces of the event, shape (n_pixels, n_samples) (np.array)
+        :param slot: the index of the event in the batch of the filler    (int)
+        :return:
+        """
+        self.events.append(data)
+        self.slots.append(slot)
+
+    def pop(self):
+        """
+        Empty the block
+
+        :return: the traces of the events, shape (n_events, n_pixels, n_samples), and their slots
+                                                                          (tuple(np.array, list))
+        """
+        events, slots = np.array(self.events), self.slots
+        self.events, self.slots = [], []
+        return events, slots
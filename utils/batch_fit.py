@@ -0,0 +1,150 @@
+import numpy as np
+
+# Levenberg-Marquardt least squares run simultaneously on a batch of histograms: every
+# iteration is a handful of array operations on (n_hist, n_params) parameters with a
+# damping factor and a convergence flag per histogram
+
+__all__ = ["levenberg_marquardt", "parameter_errors"]
+
+
+def _solve(a, b):
+    """
+    Solve the stacked linear systems a x = b, with a pseudo inverse for the singular ones
+
+    :param a: the matrices, shape (n, m, m)                           (np.array)
+    :param b: the vectors, shape (n, m)                               (np.array)
+    :return: x, shape (n, m)                                          (np.array)
+    """
+    try:
+        return np.linalg.solve(a, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('nij,nj->ni', np.linalg.pinv(a), b)
+
+
+def _numerical_jac(func, p, x, step=1e-8):
+    """
+    Forward finite differences estimate of the jacobian of func
+
+    :param func: the model, see levenberg_marquardt                   (function)
+    :param p: the parameters, shape (n_hist, n_params)                (np.array)
+    :param x: the bin centers                                         (np.array)
+    :param step: the relative step                                    (float)
+    :return: the jacobian, shape (n_hist, n_bins, n_params)           (np.array)
+    """
+    value = func(p, x)
+    jac = np.zeros(value.shape + p.shape[-1:])
+    for i in range(p.shape[-1]):
+        p_step = np.array(p, dtype=float)
+        h = step * np.maximum(1., np.abs(p[:, i]))
+        p_step[:, i] += h
+        jac[..., i] = (func(p_step, x) - value) / h[:, None]
+    return jac
+
+
+def _residual(func, p, x, y, weight):
+    return (func(p, x) - y) * weight
+
+
+def levenberg_marquardt(func, jac, p0, x, y, weight, bounds=None, free=None, max_iter=200, ftol=1e-10,
+                        xtol=1e-10, damping=1.):
+    """
+    Minimise sum(((func(p, x) - y) * weight)**2) for a batch of histograms
+
+    :param func: the model, func(p, x) with p of shape (n_hist, n_params) returns (n_hist, n_bins)
+                                                                      (function)
+    :param jac: the jacobian of func, returns (n_hist, n_bins, n_params), None for finite differences
+                                                                      (function)
+    :param p0: the initial parameters, shape (n_hist, n_params)       (np.array)
+    :param x: the bin centers common to all histograms                (np.array)
+    :param y: the histograms, shape (n_hist, n_bins)                  (np.array)
+    :param weight: 1 / error for the bins to fit and 0 elsewhere, shape (n_hist, n_bins)
+                                                                      (np.array)
+    :param bounds: the lower and upper bounds, each (n_hist, n_params) (tuple(np.array, np.array))
+    :param free: False for the fixed parameters, shape (n_hist, n_params)
+                                                                      (np.array)
+    :param max_iter: the maximum number of iterations                 (int)
+    :param ftol: the relative chi2 decrease under which a fit has converged
+                                                                      (float)
+    :param xtol: the relative parameter step under which a fit has converged
+                                                                      (float)
+    :param damping: the initial damping factor                        (float)
+    :return: the parameters, the chi2 and the convergence flags       (np.array, np.array, np.array)
+    """
+    p = np.array(p0, dtype=float)
+    n_hist, n_param = p.shape
+    if jac is None:
+        jac = lambda _p, _x: _numerical_jac(func, _p, _x)
+    if free is None:
+        free = np.ones(p.shape, dtype=bool)
+    if bounds is None:
+        bounds = (np.full(p.shape, -np.inf), np.full(p.shape, np.inf))
+    lower, upper = np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float)
+    p = np.clip(p, lower, upper)
+
+    residual = _residual(func, p, x, y, weight)
+    chi2 = np.sum(residual * residual, axis=-1)
+    lam = np.full(n_hist, damping)
+    converged = np.zeros(n_hist, dtype=bool)
+    # the histograms still being fitted
+    active = np.arange(n_hist)
+    eye = np.eye(n_param, dtype=bool)
+
+    for _ in range(max_iter):
+        if active.shape[0] == 0:
+            break
+        p_a, y_a, w_a, free_a = p[active], y[active], weight[active], free[active]
+        jacobian = jac(p_a, x) * w_a[..., None] * free_a[:, None, :]
+        hessian = np.einsum('nbi,nbj->nij', jacobian, jacobian)
+        gradient = np.einsum('nbi,nb->ni', jacobian, residual[active])
+        # Marquardt scaling of the damping, the fixed parameters get a unit diagonal and no step
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+        hessian[:, eye] = np.where(free_a, diagonal + lam[active, None] * np.maximum(diagonal, 1e-12), 1.)
+        step = -_solve(hessian, gradient) * free_a
+
+        # the components pushing against an active bound are dropped, the others leaving the bounds stop
+        # just before them
+        p_low, p_up = lower[active], upper[active]
+        step[((p_a <= p_low) & (step < 0)) | ((p_a >= p_up) & (step > 0))] = 0.
+        p_new = np.clip(p_a + step, p_a + 0.99 * (p_low - p_a), p_a + 0.99 * (p_up - p_a))
+        residual_new = _residual(func, p_new, x, y_a, w_a)
+        chi2_new = np.sum(residual_new * residual_new, axis=-1)
+        better = chi2_new <= chi2[active]
+
+        decrease = chi2[active] - chi2_new
+        step_norm = np.linalg.norm(p_new - p_a, axis=-1)
+        done = better & ((decrease <= ftol * chi2[active]) |
+                         (step_norm <= xtol * (np.linalg.norm(p_a, axis=-1) + xtol)))
+        # a fit which can not improve any more is also done
+        done |= ~better & (lam[active] > 1e10)
+
+        p[active[better]] = p_new[better]
+        chi2[active[better]] = chi2_new[better]
+        residual[active[better]] = residual_new[better]
+        lam[active] = np.where(better, lam[active] / 10., lam[active] * 10.)
+        converged[active[done]] = True
+        active = active[~done]
+
+    return p, chi2, converged
+
+
+def parameter_errors(func, jac, p, x, weight, free=None):
+    """
+    The parameter errors from the diagonal of (J^T J)^-1, nan when J^T J is singular
+
+    :param func, jac, p, x, weight, free: see levenberg_marquardt
+    :return: the errors, 0 for the fixed parameters, shape (n_hist, n_params)
+                                                                      (np.array)
+    """
+    if free is None:
+        free = np.ones(np.shape(p), dtype=bool)
+    if jac is None:
+        jac = lambda _p, _x: _numerical_jac(func, _p, _x)
+    jacobian = jac(p, x) * weight[..., None]
+    errors = np.zeros(np.shape(p))
+    for i in range(errors.shape[0]):
+        jacobian_i = jacobian[i][:, free[i]]
+        try:
+            errors[i, free[i]] = np.sqrt(np.diag(np.linalg.inv(np.dot(jacobian_i.T, jacobian_i))))
+        except np.linalg.LinAlgError:
+            errors[i, free[i]] = np.nan
+    return errors
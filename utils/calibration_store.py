@@ -0,0 +1,349 @@
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+import numpy as np
+
+# SQLite database of the calibration parameters (gain, sigma_e, sigma_1, crosstalk, baseline, LED coefficients,
+# ...) of each pixel for each run. A value is identified by its parameter, pixel, run, analysis module and scan
+# level, the primary key being ordered (parameter, pixel, run) so that the time series of a parameter over
+# hundreds of runs is read from one contiguous range of the index. The fit results of a Histogram are inserted
+# at once, the parameters being named from their labels
+
+__all__ = ["CalibrationStore", "parameter_name", "store_fit_results"]
+
+# the parameter names of the fit result labels of spectra_fit, the unit in brackets being ignored. The
+# crosstalk of fit_low_light and fit_high_light has the name of the Calibration_Container field
+_PARAMETER_NAMES = {'Gain': 'gain',
+                    'Baseline': 'baseline',
+                    '$\\sigma_e$': 'sigma_e',
+                    '$\\sigma_1$': 'sigma_1',
+                    '$\\mu$': 'mu',
+                    '$\\mu_{XT}$': 'crosstalk',
+                    'P(XT)': 'crosstalk',
+                    'Amplitude': 'amplitude',
+                    'Offset': 'offset',
+                    '$f_0$': 'dc_led_f_0',
+                    'c': 'dc_led_c',
+                    'a0': 'ac_led_a0',
+                    'a1': 'ac_led_a1',
+                    'a2': 'ac_led_a2',
+                    'a3': 'ac_led_a3',
+                    'a4': 'ac_led_a4'}
+
+# the parameter names of the fields of utils.calibration_container.Calibration_Container, a list for the fields
+# holding several coefficients per pixel
+_CONTAINER_NAMES = {'gain': 'gain',
+                    'electronic_noise': 'sigma_e',
+                    'gain_smearing': 'sigma_1',
+                    'crosstalk': 'crosstalk',
+                    'baseline': 'baseline',
+                    'mean_temperature': 'mean_temperature',
+                    'ac_led': ['ac_led_a0', 'ac_led_a1', 'ac_led_a2', 'ac_led_a3'],
+                    'dc_led': ['dc_led_f_0', 'dc_led_c']}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id   INTEGER PRIMARY KEY,
+    run_date TEXT NOT NULL,
+    name     TEXT NOT NULL DEFAULT '',
+    UNIQUE (run_date, name)
+);
+CREATE TABLE IF NOT EXISTS calibration (
+    parameter TEXT NOT NULL,
+    pixel     INTEGER NOT NULL,
+    run_id    INTEGER NOT NULL REFERENCES runs (run_id),
+    analysis  TEXT NOT NULL DEFAULT '',
+    level     INTEGER NOT NULL DEFAULT 0,
+    value     REAL,
+    error     REAL,
+    PRIMARY KEY (parameter, pixel, run_id, analysis, level)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS calibration_run ON calibration (run_id, parameter);
+"""
+
+
+def parameter_name(label):
+    """
+    :param label: the label of a fit parameter, e.g. 'Gain [LSB / p.e.]'  (str)
+    :return: the name of the parameter in the database, e.g. 'gain'     (str)
+    """
+    label = re.sub(r'\s*\[.*\]\s*$', '', str(label)).strip()
+    if label in _PARAMETER_NAMES:
+        return _PARAMETER_NAMES[label]
+    return re.sub(r'[^0-9a-z]+', '_', label.lower()).strip('_')
+
+
+class CalibrationStore:
+    """
+    Calibration parameters per pixel and per run in a SQLite file
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: the SQLite file, created if it does not exist   (str)
+        """
+        self.filename = filename
+        self.logger = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+        self.connection = sqlite3.connect(filename)
+        # write ahead log and a large page cache for the bulk insertions into the primary key B-tree
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('PRAGMA cache_size = -65536')
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _date(run_date):
+        if isinstance(run_date, (datetime.date, datetime.datetime)):
+            return run_date.isoformat()
+        return str(run_date)
+
+    def run_id(self, run_date, name=''):
+        """
+        The run of a date and name, added if it does not exist
+
+        :param run_date: the date of the run, ISO 8601 (e.g. '2017-03-22')  (str or datetime.date)
+        :param name: the name distinguishing the runs of a date             (str)
+        :return: the id of the run                                          (int)
+        """
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO runs (run_date, name) VALUES (?, ?)',
+                                    (self._date(run_date), name))
+        return self.connection.execute('SELECT run_id FROM runs WHERE run_date = ? AND name = ?',
+                                       (self._date(run_date), name)).fetchone()[0]
+
+    def runs(self):
+        """
+        :return: the (run_id, run_date, name) of the runs ordered by date (list(tuple))
+        """
+        return self.connection.execute('SELECT run_id, run_date, name FROM runs ORDER BY run_date, name').fetchall()
+
+    def parameters(self):
+        """
+        :return: the (parameter, analysis) in the database                (list(tuple))
+        """
+        return self.connection.execute('SELECT DISTINCT parameter, analysis FROM calibration '
+                                       'ORDER BY parameter, analysis').fetchall()
+
+    def insert(self, run_id, parameter, pixels, values, errors=None, analysis='', levels=None):
+        """
+        Insert (or replace) values of a parameter
+
+        :param run_id: the run, see run_id                                (int)
+        :param parameter: the name of the parameter                       (str)
+        :param pixels: the pixels                                          (np.array)
+        :param values: the values, same shape as pixels, the nan being skipped
+                                                                          (np.array)
+        :param errors: the errors, same shape as pixels                    (np.array)
+        :param analysis: the analysis module the values come from          (str)
+        :param levels: the scan levels, same shape as pixels, 0 by default (np.array)
+        :return: the number of values inserted                            (int)
+        """
+        rows = self._rows(run_id, parameter, pixels, values, errors, analysis, levels)
+        return self._insert_rows(rows)
+
+    @staticmethod
+    def _rows(run_id, parameter, pixels, values, errors=None, analysis='', levels=None):
+        # the rows of the calibration table, see insert
+        pixels = np.asarray(pixels, dtype=int).ravel()
+        values = np.asarray(values, dtype=float).ravel()
+        errors = np.full(values.shape, np.nan) if errors is None else np.asarray(errors, dtype=float).ravel()
+        levels = np.zeros(values.shape, dtype=int) if levels is None else np.asarray(levels, dtype=int).ravel()
+        valid = np.isfinite(values)
+        n_valid = int(np.sum(valid))
+        return list(zip([parameter] * n_valid, pixels[valid].tolist(), [run_id] * n_valid, [analysis] * n_valid,
+                        levels[valid].tolist(), values[valid].tolist(),
+                        [None if not np.isfinite(error) else error for error in errors[valid].tolist()]))
+
+    def _insert_rows(self, rows):
+        # insert the rows in a single transaction
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO calibration '
+                                        '(parameter, pixel, run_id, analysis, level, value, error) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def insert_fit_result(self, run_id, hist, pixel_list=None, analysis='', parameters=None):
+        """
+        Insert the fit results of a histogram, fit_result of shape ([n_levels,] n_pixels, n_parameters, >= 2)
+        holding the values and errors
+
+        :param run_id: the run, see run_id                                (int)
+        :param hist: the fitted histogram                                 (Histogram)
+        :param pixel_list: the pixel of each histogram, by default its index (list(int))
+        :param analysis: the analysis module of the fit                   (str)
+        :param parameters: the names of the parameters, by default from fit_result_label (see parameter_name),
+                           None for a parameter not to insert             (list(str))
+        :return: the number of values inserted                            (int)
+        """
+        fit_result = np.asarray(hist.fit_result, dtype=float)
+        if parameters is None:
+            labels = hist.fit_result_label
+            if labels is None or np.asarray(labels).ndim == 0:
+                labels = ['parameter_%d' % i for i in range(fit_result.shape[-2])]
+            parameters = [parameter_name(label) for label in labels]
+        n_pixels = fit_result.shape[-3]
+        pixels = np.arange(n_pixels) if pixel_list is None else np.asarray(pixel_list, dtype=int)
+        levels = np.zeros(fit_result.shape[:-2], dtype=int)
+        pixels = np.broadcast_to(pixels, fit_result.shape[:-2])
+        if fit_result.ndim > 3:
+            levels = np.broadcast_to(np.arange(fit_result.shape[0]).reshape((-1,) + (1,) * (fit_result.ndim - 3)),
+                                     fit_result.shape[:-2])
+        rows = []
+        for i, parameter in enumerate(parameters[0:fit_result.shape[-2]]):
+            if parameter is not None:
+                rows += self._rows(run_id, parameter, pixels, fit_result[..., i, 0], fit_result[..., i, 1],
+                                   analysis=analysis, levels=levels)
+        n_values = self._insert_rows(rows)
+        self.logger.info('%d values of %s inserted in %s' % (n_values, analysis, self.filename))
+        return n_values
+
+    def insert_container(self, run_id, container, analysis='calibration_container'):
+        """
+        Insert the values of a utils.calibration_container.Calibration_Container, the None being skipped
+
+        :param run_id: the run, see run_id                                (int)
+        :param container: the calibration container                       (Calibration_Container)
+        :param analysis: the analysis name of the values                  (str)
+        :return: the number of values inserted                            (int)
+        """
+        rows = []
+        for field, parameters in _CONTAINER_NAMES.items():
+            if not hasattr(container, field):
+                continue
+            values = getattr(container, field)['value']
+            errors = getattr(container, field)['error']
+            for i, parameter in enumerate(parameters if isinstance(parameters, list) else [parameters]):
+                value, error = np.full(len(values), np.nan), np.full(len(values), np.nan)
+                for pixel, (pixel_value, pixel_error) in enumerate(zip(values, errors)):
+                    if isinstance(parameters, list):
+                        pixel_value = pixel_value[i] if pixel_value is not None else None
+                        pixel_error = pixel_error[i] if pixel_error is not None else None
+                    value[pixel] = np.nan if pixel_value is None else pixel_value
+                    error[pixel] = np.nan if pixel_error is None else pixel_error
+                rows += self._rows(run_id, parameter, container.pixel_id, value, error, analysis=analysis)
+        return self._insert_rows(rows)
+
+    def _analysis(self, parameter, analysis):
+        if analysis is not None:
+            return analysis
+        analyses = [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT analysis FROM calibration WHERE parameter = ?', (parameter,))]
+        if len(analyses) > 1:
+            raise ValueError('%s is given by the analyses %s, choose one' % (parameter, ', '.join(analyses)))
+        return analyses[0] if analyses else ''
+
+    def time_series(self, parameter, pixels=None, date_min=None, date_max=None, analysis=None, level=0):
+        """
+        The values of a parameter over the runs, for stability studies
+
+        :param parameter: the name of the parameter                       (str)
+        :param pixels: the pixels, by default all the ones with values     (list(int))
+        :param date_min, date_max: the range of run dates (included)       (str or datetime.date)
+        :param analysis: the analysis module of the values, needed if several analyses give the parameter
+                                                                          (str)
+        :param level: the scan level                                      (int)
+        :return: the run dates (n_runs, ), the pixels (n_pixels, ), the values and errors (n_runs, n_pixels),
+                 nan where missing                                        (np.array, np.array, np.array, np.array)
+        """
+        analysis = self._analysis(parameter, analysis)
+        query = 'SELECT r.run_date, r.name, c.pixel, c.value, c.error FROM calibration c ' \
+                'JOIN runs r ON r.run_id = c.run_id WHERE c.parameter = ? AND c.analysis = ? AND c.level = ?'
+        arguments = [parameter, analysis, level]
+        if date_min is not None:
+            query += ' AND r.run_date >= ?'
+            arguments.append(self._date(date_min))
+        if date_max is not None:
+            query += ' AND r.run_date <= ?'
+            arguments.append(self._date(date_max))
+        if pixels is not None:
+            pixels = np.asarray(pixels, dtype=int).ravel()
+            query += ' AND c.pixel IN (%s)' % ','.join(str(pixel) for pixel in pixels.tolist())
+        rows = self.connection.execute(query, arguments).fetchall()
+
+        runs = sorted(set((row[0], row[1]) for row in rows))
+        if pixels is None:
+            pixels = np.array(sorted(set(row[2] for row in rows)), dtype=int)
+        run_index = {run: i for i, run in enumerate(runs)}
+        pixel_index = {pixel: i for i, pixel in enumerate(pixels.tolist())}
+        values = np.full((len(runs), pixels.shape[0]), np.nan)
+        errors = np.full((len(runs), pixels.shape[0]), np.nan)
+        for run_date, name, pixel, value, error in rows:
+            values[run_index[(run_date, name)], pixel_index[pixel]] = value
+            errors[run_index[(run_date, name)], pixel_index[pixel]] = np.nan if error is None else error
+        return np.array([run[0] for run in runs]), pixels, values, errors
+
+    def run_values(self, run_id, parameter, n_pixels=1296, analysis=None, level=0):
+        """
+        :param run_id: the run, see run_id                                (int)
+        :param parameter: the name of the parameter                       (str)
+        :param n_pixels: the number of pixels of the camera               (int)
+        :param analysis, level: see time_series
+        :return: the values and errors of each pixel, nan where missing   (np.array, np.array)
+        """
+        analysis = self._analysis(parameter, analysis)
+        values, errors = np.full(n_pixels, np.nan), np.full(n_pixels, np.nan)
+        for pixel, value, error in self.connection.execute(
+                'SELECT pixel, value, error FROM calibration WHERE run_id = ? AND parameter = ? AND analysis = ? '
+                'AND level = ?', (run_id, parameter, analysis, level)):
+            values[pixel] = value
+            errors[pixel] = np.nan if error is None else error
+        return values, errors
+
+
+def _run_date(options):
+    # the run_date option, else the first date YYYYMMDD of the input directory, else today
+    if hasattr(options, 'run_date'):
+        return options.run_date
+    match = re.search(r'(?<!\d)(20\d{2})(\d{2})(\d{2})(?!\d)', options.directory if hasattr(options, 'directory')
+                      else '')
+    if match is not None:
+        try:
+            return datetime.date(*(int(group) for group in match.groups()))
+        except ValueError:
+            pass
+    log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+    log.warning('No run_date option nor date YYYYMMDD in the input directory, the results are stored for today %s'
+                % datetime.date.today().isoformat())
+    return datetime.date.today()
+
+
+def store_fit_results(options):
+    """
+    Insert the fit results of the histogram of an analysis in the calibration database, if there is one
+
+    :param options: a dictionary containing at least the following keys:
+        - 'output_directory'     : the directory of the histogram                              (str)
+        - 'histo_filename'       : the name of the file containing the histogram                (str)
+        - 'calibration_database' : (optional) the SQLite file, no insertion without it          (str)
+        - 'run_date'             : (optional) the date of the run, by default the date YYYYMMDD in
+                                   options.directory or today                                  (str)
+        - 'run_name'             : (optional) the name distinguishing the runs of a date        (str)
+    :return: the number of values inserted                                                      (int)
+    """
+    if not hasattr(options, 'calibration_database') or not hasattr(options, 'histo_filename'):
+        return 0
+    from utils.histogram import Histogram
+    filename = os.path.join(options.output_directory, options.histo_filename)
+    hist = Histogram(filename=filename, fit_only=True)
+    if hist.fit_result is None or np.asarray(hist.fit_result).ndim < 3:
+        return 0
+    pixel_list = options.pixel_list if hasattr(options, 'pixel_list') and \
+        len(options.pixel_list) == np.asarray(hist.fit_result).shape[-3] else None
+    with CalibrationStore(options.calibration_database) as store:
+        run_id = store.run_id(_run_date(options), options.run_name if hasattr(options, 'run_name') else '')
+        return store.insert_fit_result(run_id, hist, pixel_list=pixel_list,
+                                       analysis=options.analysis_module if hasattr(options, 'analysis_module')
+                                       else '')
@@ -0,0 +1,136 @@
+import numpy as np
+from ctapipe.io import zfits
+
+__all__ = ['EventBatch', 'EventBatchReader', 'zfits_batch_reader']
+
+
+class EventBatch:
+    """
+    A block of consecutive events stored as columns
+
+    The arrays are views of the buffers of the EventBatchReader which are overwritten by the next batch,
+    they have to be copied to be kept
+    """
+
+    def __init__(self, adc_samples, camera_event_number, local_camera_clock, gps_time, event_id):
+        """
+        :param adc_samples: the samples of the selected pixels, shape (n_events, n_pixels, n_samples)
+                                                                          (np.array)
+        :param camera_event_number: the camera event number of each event (np.array)
+        :param local_camera_clock: the camera clock of each event         (np.array)
+        :param gps_time: the gps time of each event                       (np.array)
+        :param event_id: the index of each event in the whole input       (np.array)
+        """
+        self.adc_samples = adc_samples
+        self.camera_event_number = camera_event_number
+        self.local_camera_clock = local_camera_clock
+        self.gps_time = gps_time
+        self.event_id = event_id
+
+    @property
+    def n_events(self):
+        return self.adc_samples.shape[0]
+
+
+def _header(r0, name):
+    # -1 for the headers missing in the event (e.g. simulated events)
+    value = getattr(r0, name, None)
+    return -1 if value is None else value
+
+
+class EventBatchReader:
+    """
+    Read the events of a list of event sources by blocks of batch_size events
+
+    The pixel selection is applied once while copying the samples of an event in the preallocated block,
+    the blocks span the boundaries between the sources (files). The last block can be shorter.
+    """
+
+    def __init__(self, event_sources, batch_size, pixel_list=None, event_min=0, event_max=None, telescope_id=None,
+                 dtype=np.uint16):
+        """
+        :param event_sources: the event sources, e.g. one zfits_event_source per file, opened when iterated
+                                                                          (iterable)
+        :param batch_size: the number of events per block                 (int)
+        :param pixel_list: the pixels to keep, None for all               (list)
+        :param event_min: the index of the first event to read            (int)
+        :param event_max: the index of the event after the last one to read, None to read everything
+                                                                          (int)
+        :param telescope_id: the telescope to read, None for the first one with data
+                                                                          (int)
+        :param dtype: the type of the samples                             (np.dtype)
+        """
+        self.event_sources = event_sources
+        self.batch_size = batch_size
+        self.pixel_list = None if pixel_list is None else np.asarray(pixel_list, dtype=int)
+        self.event_min = event_min
+        self.event_max = event_max
+        self.telescope_id = telescope_id
+        self.dtype = dtype
+        self._buffers = None
+
+    def _allocate(self, n_pixels, n_samples):
+        self._buffers = (np.zeros((self.batch_size, n_pixels, n_samples), dtype=self.dtype),
+                         np.zeros(self.batch_size, dtype=np.int64),
+                         np.zeros(self.batch_size, dtype=np.int64),
+                         np.zeros(self.batch_size, dtype=np.int64),
+                         np.zeros(self.batch_size, dtype=np.int64))
+
+    def _batch(self, n):
+        return EventBatch(*(buffer[0:n] for buffer in self._buffers))
+
+    def __iter__(self):
+        event_id = -1
+        n = 0
+        for event_source in self.event_sources:
+            for event in event_source:
+                event_id += 1
+                if event_id < self.event_min:
+                    continue
+                if self.event_max is not None and event_id >= self.event_max:
+                    break
+
+                telescope_id = self.telescope_id
+                if telescope_id is None:
+                    telescope_id = list(event.r0.tels_with_data)[0]
+                r0 = event.r0.tel[telescope_id]
+                # references to the samples of the pixels, no copy
+                samples = list(r0.adc_samples.values())
+                if self.pixel_list is not None:
+                    samples = [samples[pixel] for pixel in self.pixel_list]
+                if self._buffers is None:
+                    self._allocate(len(samples), len(samples[0]))
+
+                adc_samples, camera_event_number, local_camera_clock, gps_time, event_ids = self._buffers
+                adc_samples[n] = samples
+                camera_event_number[n] = _header(r0, 'camera_event_number')
+                local_camera_clock[n] = _header(r0, 'local_camera_clock')
+                gps_time[n] = _header(r0, 'gps_time')
+                event_ids[n] = event_id
+                n += 1
+
+                if n == self.batch_size:
+                    yield self._batch(n)
+                    n = 0
+            if self.event_max is not None and event_id >= self.event_max:
+                # do not open the next sources
+                break
+
+        if n > 0:
+            yield self._batch(n)
+
+
+def zfits_batch_reader(urls, batch_size, pixel_list=None, event_min=0, event_max=None, max_events=None):
+    """
+    EventBatchReader over a list of zfits files
+
+    :param urls: the files to read                                    (list(str))
+    :param batch_size: the number of events per block                 (int)
+    :param pixel_list: the pixels to keep, None for all               (list)
+    :param event_min, event_max: the range of events to read over all the files, see EventBatchReader
+    :param max_events: the max_events of each zfits_event_source      (int)
+    :return: the reader                                               (EventBatchReader)
+    """
+    event_sources = (zfits.zfits_event_source(url=url, max_events=max_events) for url in urls)
+    return EventBatchReader(event_sources, batch_size, pixel_list=pixel_list, event_min=event_min,
+                            event_max=event_max)
@@ -0,0 +1,305 @@
+import logging
+import sys
+
+import numpy as np
+
+from utils.integrator import window_sum
+
+# Several products filled from a single read of the data: the consumers are registered on one
+# stream of EventBatch blocks (utils.event_batch) and every decoded block is handed to each of
+# them in turn, so the files of a calibration run are read once whatever the number of
+# histograms and accumulators filled from them
+
+__all__ = ["EventConsumer", "ADCConsumer", "PeakPositionConsumer", "ChargeConsumer", "PulseShapeConsumer",
+           "BaselineConsumer", "fill_single_pass"]
+
+
+class EventConsumer:
+    """
+    A product filled from blocks of events
+
+    With events_per_level, the events are split in levels of events_per_level consecutive camera event numbers
+    (event index in the input for the events without camera event number) counted from the first event
+    consumed, the level being the first index of the product.
+    """
+
+    def __init__(self, events_per_level=None, n_levels=None):
+        """
+        :param events_per_level: the number of events per level, None for no level       (int)
+        :param n_levels: the number of levels, the events of the next ones are ignored   (int)
+        """
+        self.events_per_level = events_per_level
+        self.n_levels = n_levels
+        self._first_event = None
+
+    def _levels(self, batch):
+        """
+        The events of the block grouped by level
+
+        :param batch: the block of events                                 (EventBatch)
+        :return: the level and the slice of the events of each level      (list(tuple(int, slice)))
+        """
+        if self.events_per_level is None:
+            return [(None, slice(0, batch.n_events))]
+        event_number = np.where(batch.camera_event_number >= 0, batch.camera_event_number, batch.event_id)
+        if self._first_event is None:
+            self._first_event = event_number[0]
+        level = (event_number - self._first_event) // self.events_per_level
+        bounds = np.concatenate(([0], np.where(np.diff(level) != 0)[0] + 1, [batch.n_events]))
+        return [(int(level[start]), slice(start, end)) for start, end in zip(bounds[:-1], bounds[1:])
+                if self.n_levels is None or 0 <= level[start] < self.n_levels]
+
+    def consume(self, batch):
+        """
+        Add a block of events to the product
+
+        :param batch: the block of events                                 (EventBatch)
+        :return:
+        """
+        for level, events in self._levels(batch):
+            self._consume(batch.adc_samples[events], () if level is None else (level,))
+
+    def _consume(self, data, indices):
+        """
+        :param data: the samples of the events of one level, shape (n_events, n_pixels, n_samples)
+                                                                          (np.array)
+        :param indices: the index of the level in the product, () without level
+                                                                          (tuple)
+        :return:
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        Called once the stream is exhausted
+
+        :return:
+        """
+        pass
+
+
+class ADCConsumer(EventConsumer):
+    """
+    Histogram of all the samples of each pixel (e.g. HV off or dark ADC)
+    """
+
+    def __init__(self, hist, events_per_level=None, n_levels=None):
+        """
+        :param hist: the Histogram, data_shape ([n_levels,] n_pixels)     (Histogram)
+        :param events_per_level, n_levels: see EventConsumer
+        """
+        super().__init__(events_per_level, n_levels)
+        self.hist = hist
+
+    def _consume(self, data, indices):
+        self.hist.fill_with_batch(data.transpose(1, 0, 2).reshape(data.shape[1], -1), indices=indices)
+
+
+class PeakPositionConsumer(EventConsumer):
+    """
+    Histogram of the sample of the maximum of each pixel (e.g. synch peak positions), the maxima out of
+    [min_amplitude, max_amplitude] above the baseline being put in the sample 0
+    """
+
+    def __init__(self, hist, baseline=None, min_amplitude=None, max_amplitude=None, baseline_tracker=None,
+                 events_per_level=None, n_levels=None):
+        """
+        :param hist: the Histogram, data_shape ([n_levels,] n_pixels)     (Histogram)
+        :param baseline: the baseline of each pixel, needed for the amplitude cuts without baseline_tracker
+                                                                          (np.array)
+        :param min_amplitude: the minimal amplitude of a maximum          (float)
+        :param max_amplitude: the maximal amplitude of a maximum          (float)
+        :param baseline_tracker: the per event baseline subtracted from the samples, as in
+                                 data_treatement.synch_hist                (BaselineTracker)
+        :param events_per_level, n_levels: see EventConsumer
+        """
+        super().__init__(events_per_level, n_levels)
+        self.hist = hist
+        self.baseline = baseline
+        self.min_amplitude = min_amplitude
+        self.max_amplitude = max_amplitude
+        self.baseline_tracker = baseline_tracker
+
+    def _consume(self, data, indices):
+        baseline = self.baseline
+        if self.baseline_tracker is not None:
+            data = self.baseline_tracker.subtract(data)
+            baseline = 0.
+        position = np.argmax(data, axis=-1)
+        if baseline is not None:
+            amplitude = np.take_along_axis(data, position[..., None], axis=-1)[..., 0] - baseline
+            if self.min_amplitude is not None:
+                position[amplitude < self.min_amplitude] = 0
+            if self.max_amplitude is not None:
+                position[amplitude > self.max_amplitude] = 0
+        self.hist.fill_with_batch(position.T, indices=indices)
+
+
+class ChargeConsumer(EventConsumer):
+    """
+    Histogram of the sum of window_width samples of each pixel, the charges being truncated to integers as in
+    data_treatement.mpe_hist
+
+    With peak positions, the window is chosen as by the 'integration' charge extraction of mpe_hist: the window
+    of largest sum among the ones starting window_start samples before a sample of the synch peak region
+    (the samples holding more than 1e-3 of the peak positions and their neighbours), else the window starting
+    window_start samples before the most probable peak position. Without peak positions, it is the window of
+    largest sum.
+    """
+
+    def __init__(self, hist, window_width, peak_positions=None, window_start=0, baseline_tracker=None,
+                 events_per_level=None, n_levels=None):
+        """
+        :param hist: the Histogram, data_shape ([n_levels,] n_pixels)     (Histogram)
+        :param window_width: the number of samples summed                 (int)
+        :param peak_positions: the peak position histogram of each pixel, shape (n_pixels, n_samples + 1)
+                               (see data_treatement.synch_hist)            (np.array)
+        :param window_start: the number of samples of the window before the peak
+                                                                          (int)
+        :param baseline_tracker: the baseline subtracted from the samples (BaselineTracker)
+        :param events_per_level, n_levels: see EventConsumer
+        """
+        super().__init__(events_per_level, n_levels)
+        self.hist = hist
+        self.window_width = window_width
+        self.window_start = window_start
+        self.baseline_tracker = baseline_tracker
+        self.start = None
+        self.mask_window = None
+        self.mask_window_edge = None
+        if peak_positions is not None:
+            self.start = np.argmax(peak_positions, axis=-1) - window_start
+            # the synch peak region, its edge and their window starts, see mpe_hist
+            mask = (peak_positions.T / np.sum(peak_positions, axis=-1)).T > 1e-3
+            mask_window = mask.copy()
+            mask_window[..., :-1] |= mask[..., 1:]
+            mask_window[..., 1:] |= mask[..., :-1]
+            mask_window_edge = mask_window & ~mask
+            n_windows = mask_window.shape[-1] - 1 - (window_width - 1)
+            self.mask_window = mask_window[..., window_start:window_start + n_windows]
+            self.mask_window_edge = mask_window_edge[..., window_start:window_start + n_windows]
+
+    def _consume(self, data, indices):
+        if self.baseline_tracker is not None:
+            data = self.baseline_tracker.subtract(data)
+        integration = window_sum(data, self.window_width)
+        if self.start is None:
+            charge = np.max(integration, axis=-1)
+        else:
+            n_windows = self.mask_window.shape[-1]
+            integration = integration[..., 0:n_windows]
+            start = np.argmax(integration * self.mask_window, axis=-1)
+            start_edge = np.argmax(integration * self.mask_window_edge, axis=-1)
+            default_start = np.broadcast_to(np.clip(self.start, 0, n_windows - 1), start.shape)
+            # the window at the edge of the peak region or with a small sum is moved to the most probable peak
+            start = np.where(start == start_edge, default_start, start)
+            small = np.take_along_axis(integration, start[..., None], axis=-1)[..., 0] < 10.
+            start = np.where(small, default_start, start)
+            charge = np.take_along_axis(integration, start[..., None], axis=-1)[..., 0]
+        self.hist.fill_with_batch(charge.astype(int).T, indices=indices)
+
+
+class _MomentConsumer(EventConsumer):
+    """
+    Sums and sums of squares of the entries of each element of a product, allocated at the first block
+    """
+
+    def __init__(self, events_per_level=None, n_levels=None):
+        """
+        :param events_per_level, n_levels: see EventConsumer, n_levels is needed with events_per_level
+        """
+        super().__init__(events_per_level, n_levels)
+        self.sum = None
+        self.sum_square = None
+        self.count = None
+
+    def _add(self, indices, total, total_square, n_entries):
+        """
+        :param indices: see EventConsumer._consume                         (tuple)
+        :param total: the sum of the new entries of each element           (np.array)
+        :param total_square: the sum of their squares                      (np.array)
+        :param n_entries: the number of new entries of each element        (int)
+        :return:
+        """
+        if self.sum is None:
+            shape = (() if self.events_per_level is None else (self.n_levels,)) + total.shape
+            self.sum = np.zeros(shape)
+            self.sum_square = np.zeros(shape)
+            self.count = np.zeros(shape[0:len(shape) - total.ndim])
+        self.sum[indices] += total
+        self.sum_square[indices] += total_square
+        self.count[indices] += n_entries
+
+    @property
+    def mean(self):
+        count = np.maximum(self.count, 1).reshape(self.count.shape + (1,) * (self.sum.ndim - self.count.ndim))
+        return self.sum / count
+
+    @property
+    def std(self):
+        count = np.maximum(self.count, 1).reshape(self.count.shape + (1,) * (self.sum.ndim - self.count.ndim))
+        return np.sqrt(np.maximum(self.sum_square / count - (self.sum / count) ** 2, 0.))
+
+    def save(self, filename):
+        """
+        Save the mean, the standard deviation and the number of entries in a npz file
+
+        :param filename: the full path of the file                        (str)
+        :return:
+        """
+        np.savez(filename, mean=self.mean, std=self.std, count=self.count)
+
+
+class PulseShapeConsumer(_MomentConsumer):
+    """
+    Mean and standard deviation of the traces of each pixel, shape ([n_levels,] n_pixels, n_samples)
+    """
+
+    def _consume(self, data, indices):
+        data = data.astype(float)
+        self._add(indices, np.sum(data, axis=0), np.einsum('ijk,ijk->jk', data, data), data.shape[0])
+
+
+class BaselineConsumer(_MomentConsumer):
+    """
+    Mean and rms (std) of the first n_samples samples of each pixel over all the events, shape
+    ([n_levels,] n_pixels)
+    """
+
+    def __init__(self, n_samples, events_per_level=None, n_levels=None):
+        """
+        :param n_samples: the number of baseline samples at the start of the traces
+                                                                          (int)
+        :param events_per_level, n_levels: see EventConsumer, n_levels is needed with events_per_level
+        """
+        super().__init__(events_per_level, n_levels)
+        self.n_samples = n_samples
+
+    def _consume(self, data, indices):
+        samples = data[..., 0:self.n_samples].astype(float)
+        self._add(indices, np.sum(samples, axis=(0, 2)), np.einsum('ijk,ijk->j', samples, samples),
+                  samples.shape[0] * samples.shape[2])
+
+    @property
+    def rms(self):
+        return self.std
+
+
+def fill_single_pass(batches, consumers):
+    """
+    Hand every block of events to all the consumers
+
+    :param batches: the blocks of events, e.g. an EventBatchReader     (iterable(EventBatch))
+    :param consumers: the products to fill                            (list(EventConsumer))
+    :return: the number of events read                                (int)
+    """
+    log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+    n_events = 0
+    for batch in batches:
+        for consumer in consumers:
+            consumer.consume(batch)
+        n_events += batch.n_events
+    for consumer in consumers:
+        consumer.finish()
+    log.debug('%d events read for %d products' % (n_events, len(consumers)))
+    return n_events
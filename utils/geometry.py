@@ -2,6 +2,12 @@ import numpy as np
 from ctapipe.io.camera import CameraGeometry
 from ctapipe.io.camera import find_neighbor_pixels
 from astropy import units as u
+from cts_core.cameratestsetup import CTS
+from cts_core.camera import Camera
+
+# the CTS software directory of the camera test setup configurations
+# cts_path = '/data/software/CTS/'
+cts_path = '/home/alispach/Documents/PhD/ctasoft/CTS/'
 
 
 def generate_geometry(cts, available_board=None, all_camera= False):
@@ -60,3 +66,76 @@ def update_pixels_quality(bad_id, pix_good_id):
     """
     for pix in bad_id:
         pix_good_id[pix] = False
+
+
+def setup_pixels(options):
+    """
+    Set the camera test setup and the pixels of an analysis, as given by its options:
+        - 'angle_cts'   : the CTS of this angle, the pixels being the ones in front of an AC LED
+        - 'pixel_list'  : 'all' for the pixels of the full camera, the list of pixels otherwise
+        - 'n_pixels'    : the pixels 0 to n_pixels - 1 if no pixel_list or pixel_list is not 'all'
+        - 'n_clusters'  : 1 for the pixels of the patches of the cluster of the patch 300 (cluster_list)
+        - 'clusters'    : 'all' or None for the 432 clusters
+    options.cts is set in all cases but when the pixels are only given by n_pixels
+
+    :param options: configuration container        (yaml container)
+    :return:
+    """
+    if hasattr(options, 'angle_cts'):
+
+        options.cts = CTS(cts_path + 'config/cts_config_' + str(int(options.angle_cts)) + '.cfg',
+                          cts_path + 'config/camera_config.cfg', angle=options.angle_cts, connected=True)
+        options.pixel_list = generate_geometry(options.cts, available_board=None)[1]
+
+    elif not hasattr(options, 'pixel_list'):
+
+        if not hasattr(options, 'n_pixels'):
+
+            options.cts = CTS(cts_path + 'config/cts_config_' + str(0) + '.cfg',
+                              cts_path + 'config/camera_config.cfg', angle=0, connected=True)
+            options.pixel_list = generate_geometry(options.cts, available_board=None, all_camera=True)[1]
+
+        else:
+            # TODO add usage of digicam and cts geometry to define the list
+            options.pixel_list = np.arange(0, options.n_pixels, 1)
+
+    else:
+        options.cts = CTS(cts_path + 'config/cts_config_' + str(0) + '.cfg',
+                          cts_path + 'config/camera_config.cfg', angle=0, connected=True)
+
+        if options.pixel_list == 'all':
+
+            options.pixel_list = generate_geometry(options.cts, available_board=None, all_camera=True)[1]
+
+        elif hasattr(options, 'n_pixels'):
+
+            options.pixel_list = np.arange(0, options.n_pixels, 1)
+
+    if hasattr(options, 'n_clusters'):
+
+        if options.n_clusters != 1:
+            raise ValueError('Only n_clusters = 1 is supported, not %s' % options.n_clusters)
+
+        camera = Camera(options.cts_directory + 'config/camera_config_clusters.cfg')
+        patches_in_cluster = np.load(options.cts_directory + 'config/cluster.p')['patches_in_cluster']
+
+        patch_index = 300
+        patches_in_cluster = patches_in_cluster[patch_index]
+
+        options.pixel_list = []
+        options.cluster_list = [patch_index]
+
+        for patch in patches_in_cluster:
+
+            for pixel in camera.Patches[patch].pixels:
+
+                options.pixel_list.append(pixel.ID)
+
+        for pixel in camera.Patches[patch_index].pixels:
+            options.pixel_list.append(pixel.ID)
+
+    if hasattr(options, 'clusters'):
+
+        if options.clusters == 'all' or options.clusters is None:
+
+            options.clusters = [i for i in range(432)]
@@ -1,6 +1,12 @@
+import contextlib
+import io
+import itertools
 import logging
+import multiprocessing
 import os
+import struct
 import sys
+import zipfile
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,6 +14,7 @@ import scipy.optimize
 from numpy.linalg import inv
 from tqdm import tqdm
 from utils.logger import TqdmToLogger
+from utils import batch_fit
 
 
 class Histogram:
@@ -22,7 +29,8 @@ class Histogram:
                  bin_center_min: int = 0,
                  bin_center_max: int = 1,
                  bin_width: int = 1, xlabel: str = 'x', ylabel: str = 'y', label: str = 'hist',
-                 filename: str = '', fit_only : bool = False , auto_errors = True):
+                 filename: str = '', fit_only : bool = False , auto_errors = True, compact: bool = False,
+                 bin_window: tuple = None, index=None, mmap_mode: str = 'c'):
 
         """
         Initialise method
@@ -43,15 +51,30 @@ class Histogram:
         :param xlabel: the x axis label
         :param ylabel: the y axis label
         :param label: the base label for the histograms
+        :param compact: store the bin yields, underflow and overflow as uint32 counts
+        :param bin_window: (offset, length) restricting the stored bins of each histogram to the bins
+                           [offset, offset + length[ of the full binning, offset being an int or an array of
+                           shape data_shape. Values outside the window are counted in the underflow/overflow
+        :param index: with filename, load only the histograms [index], e.g. a level (int) or a subset of pixels
+                      (slice(None), pixel_list)
+        :param mmap_mode: with filename, the mode of the memory maps of the bin yields and errors stored without
+                          compression (see save), None to read them in memory. With 'c' (copy on write) they
+                          can be modified without changing the file
         """
         # Initialise the logger
         self.auto_errors = auto_errors
+        self.bin_offset = None
+        # Errors cache: the poisson errors are computed on access and invalidated whenever data is written,
+        # unless errors have been explicitly provided
+        self._errors = None
+        self._errors_outdated = True
+        self._errors_user = False
         self.logger = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
         if filename:
             if fit_only:
-                self.load_fit_results(filename)
+                self.load_fit_results(filename, index=index)
             else:
-                self.load(filename)
+                self.load(filename, index=index, mmap_mode=mmap_mode)
             return
 
         # Initialisation of the bin_centers
@@ -77,16 +100,22 @@ class Histogram:
         # Initialisation of data
         if data.shape[0] == 0:
             self.logger.debug('Initialise histogram')
-            self.data = np.zeros(data_shape + (self.bin_centers.shape[0],),dtype = np.int)
-            self.underflow = np.zeros(data_shape)
-            self.overflow = np.zeros(data_shape)
-            self.errors = np.zeros(data_shape + (self.bin_centers.shape[0],))
+            n_bins = self.bin_centers.shape[0]
+            if bin_window is not None:
+                # only the bins of the window are materialised, the window being kept within the binning
+                n_bins = min(int(bin_window[1]), self.bin_centers.shape[0])
+                self.bin_offset = np.zeros(data_shape, dtype=int)
+                self.bin_offset[...] = np.clip(bin_window[0], 0, self.bin_centers.shape[0] - n_bins)
+            count_dtype = np.uint32 if compact else np.int
+            self._data = np.zeros(data_shape + (n_bins,), dtype=count_dtype)
+            self.underflow = np.zeros(data_shape, dtype=np.uint32 if compact else float)
+            self.overflow = np.zeros(data_shape, dtype=np.uint32 if compact else float)
+            if not self.auto_errors: self.errors = np.zeros(data_shape + (self.bin_centers.shape[0],))
         else:
             self.logger.debug('Initialise histogram from existing data')
             self.data = data
             self.underflow = np.zeros(data_shape)
             self.overflow = np.zeros(data_shape)
-            if self.auto_errors: self._compute_errors()
 
         # Initialisation of fit results and labels
         self.fit_result = None
@@ -102,64 +131,203 @@ class Histogram:
         self.label = label
         return
 
-    def save(self, filename):
+    @property
+    def data(self):
+        """
+        The bin yields
+
+        For histograms with a bin window, the full array is materialised on access as a read-only copy (the
+        bin yields are modified by fill, fill_with_batch or by assigning data): use get_data to access a
+        limited set of histograms
+
+        :return: the data array (np.array)
+        """
+        if self.bin_offset is None:
+            return self._data
+        data = self.get_data(())
+        data.flags.writeable = False
+        return data
+
+    @data.setter
+    def data(self, data):
+        """
+        Set the bin yields. The data being given over the full binning, a histogram with a bin window moves back
+        to the full storage
+
+        :param data: the data array (np.array)
+        """
+        self._data = data
+        self.bin_offset = None
+        self._errors_outdated = True
+
+    @property
+    def data_shape(self):
+        """
+        :return: the shape of the Histogram table, data being of shape data_shape + bin_centers.shape (tuple)
+        """
+        return self._data.shape[:-1]
+
+    def get_data(self, index):
+        """
+        Get the bin yields over the full binning of the histograms data[index], only these histograms being
+        materialised for a histogram with a bin window
+
+        :param index: the index of the histograms   (tuple or int)
+        :return: the bin yields                     (np.array)
+        """
+        if self.bin_offset is None:
+            return self._data[index]
+
+        window = self._data[index]
+        offset = self.bin_offset[index]
+        data = np.zeros(window.shape[:-1] + self.bin_centers.shape, dtype=window.dtype)
+        hist_index = tuple(i[..., None] for i in np.indices(offset.shape))
+        data[hist_index + (offset[..., None] + np.arange(window.shape[-1]),)] = window
+        return data
+
+    def _get_errors(self, index, data=None):
+        """
+        Get the errors over the full binning of the histograms data[index], the poisson errors being computed
+        for these histograms only if they are not already available
+
+        :param index: the index of the histograms                          (tuple or int)
+        :param data: the bin yields of these histograms if already known   (np.array)
+        :return: the errors                                                (np.array)
+        """
+        if self._errors_user or not self.auto_errors or not self._errors_outdated:
+            return self.errors[index]
+
+        errors = np.sqrt(self.get_data(index) if data is None else data)
+        errors[errors == 0.] = 1.
+        return errors
+
+    @property
+    def errors(self):
+        """
+        The errors on the bin yields
+
+        If errors were explicitly set, they are returned as such. Otherwise (and if auto_errors is set) the poisson
+        errors are computed on first access and cached until the data is written again (assignment of data, fill
+        or fill_with_batch). In place modifications of data should be followed by a call to _compute_errors.
+
+        :return: the errors array (np.array)
+        """
+        if self._errors_outdated and self.auto_errors and not self._errors_user:
+            self._compute_errors()
+        return self._errors
+
+    @errors.setter
+    def errors(self, errors):
+        """
+        Override the errors with user provided ones. Setting them to None restores the poisson errors
+
+        :param errors: the errors array (np.array)
+        """
+        self._errors = errors
+        self._errors_user = errors is not None
+        self._errors_outdated = errors is None
+
+    def save(self, filename, compressed=None):
         """
         Save the histogram and its properties in a npz file
 
+        Without compression, the arrays are stored as such in the npz file so that the bin yields and errors can
+        be memory-mapped when loaded (see load)
+
+        Files named *.h5 or *.hdf5 are written in HDF5 (see utils.histogram_hdf5)
+
         :param filename: the full path of the saved histogram
+        :param compressed: compress the arrays, by default unless the file name ends with .hist
         :return:
         """
         if not os.path.isdir(os.path.dirname(filename)):
             self.logger.critical('%s does not exist' % os.path.dirname(filename))
             raise FileNotFoundError
+        if filename.endswith('.h5') or filename.endswith('.hdf5'):
+            from utils import histogram_hdf5
+            histogram_hdf5.save(self, filename)
+            self.logger.info('Saved histogram in %s' % filename)
+            return
+        # Compact histograms are saved as such, their poisson errors being recomputed when needed
+        extra_arrays = {}
+        errors = self._errors
+        if self.bin_offset is not None:
+            extra_arrays['bin_offset'] = self.bin_offset
+        if self.bin_offset is not None or self._data.dtype == np.uint32:
+            if not (self._errors_user or not self.auto_errors):
+                errors = np.zeros(0)
+        else:
+            errors = self.errors
+        if compressed is None:
+            compressed = not filename.endswith('.hist')
+        if compressed and not filename.endswith('.npz'):
+            filename = filename + '.npz'
+        save_function = np.savez_compressed if compressed else np.savez
         try:
-            np.savez_compressed(filename,
-                                data=self.data,
-                                bin_centers=self.bin_centers,
-                                bin_edges=self.bin_edges,
-                                bin_width=np.array([self.bin_width]),
-                                errors=self.errors,
-                                underflow=self.underflow,
-                                overflow=self.overflow,
-                                fit_result=self.fit_result,
-                                fit_function_name=np.array([self.fit_function_class,self.fit_function_name]),
-                                fit_slices = self.fit_slices,
-                                fit_chi2_ndof=self.fit_chi2_ndof,
-                                fit_axis=self.fit_axis,
-                                auto_errors=np.array([self.auto_errors]),
-                                xlabel=np.array([self.xlabel]),
-                                ylabel=np.array([self.ylabel]),
-                                label=np.array([self.label]),
-                                fit_result_label=self.fit_result_label)
+            # written aside then moved, the histograms memory-mapped from the previous file remaining valid
+            with open(filename + '.tmp', 'wb') as file:
+                save_function(file,
+                              data=self._data,
+                              bin_centers=self.bin_centers,
+                              bin_edges=self.bin_edges,
+                              bin_width=np.array([self.bin_width]),
+                              errors=errors,
+                              errors_user=np.array([self._errors_user]),
+                              underflow=self.underflow,
+                              overflow=self.overflow,
+                              fit_result=self.fit_result,
+                              fit_function_name=np.array([self.fit_function_class,self.fit_function_name]),
+                              fit_slices = self.fit_slices,
+                              fit_chi2_ndof=self.fit_chi2_ndof,
+                              fit_axis=self.fit_axis,
+                              auto_errors=np.array([self.auto_errors]),
+                              xlabel=np.array([self.xlabel]),
+                              ylabel=np.array([self.ylabel]),
+                              label=np.array([self.label]),
+                              fit_result_label=self.fit_result_label,
+                              **extra_arrays)
+            os.replace(filename + '.tmp', filename)
             self.logger.info('Saved histogram in %s' % filename)
         except Exception as inst:
             self.logger.critical('Could not save in %s' % filename, inst)
             raise Exception(inst)
 
-    def load(self, filename):
+    def load(self, filename, index=None, mmap_mode=None):
         """
-        Save the histogram and its properties in a npz file
+        Load the histogram and its properties from a npz file
 
         :param filename: the full path of the saved histogram
+        :param index: load only the histograms [index], e.g. a level (int) or a subset of pixels
+                      (slice(None), pixel_list)
+        :param mmap_mode: the mode of the memory maps of the bin yields and errors saved without compression, None
+                          to read them in memory
         :return:
         """
 
         if not os.path.isfile(filename):
             self.logger.critical('%s does not exist' % filename)
             raise FileNotFoundError
+        if filename.endswith('.h5') or filename.endswith('.hdf5'):
+            from utils import histogram_hdf5
+            histogram_hdf5.load(self, filename, index=index)
+            self.logger.info('Loaded histogram from %s' % filename)
+            return
 
         try:
-            file = np.load(filename)
-            self.data = file['data']
+            file = _HistogramFile(filename, mmap_mode=mmap_mode)
+            self.data = _select(file['data'], index)
             self.bin_centers = file['bin_centers']
             self.bin_edges = file['bin_edges']
             self.bin_width = file['bin_width'][0]
-            self.errors = file['errors']
+            self.bin_offset = _select(file['bin_offset'], index) if 'bin_offset' in file.keys() else None
+            self._errors = _select(file['errors'], index)
+            self._errors_user = file['errors_user'][0] if 'errors_user' in file.keys() else False
+            self._errors_outdated = self._errors.shape[0] == 0
             #self.auto_errors = file['auto_errors'][0]
-            self.underflow = file['underflow']
-            self.overflow = file['overflow']
-            self.fit_slices = file['fit_slices'] if 'fit_slices' in file.keys() else None
-            self.fit_result = file['fit_result']
+            self.underflow = _select(file['underflow'], index)
+            self.overflow = _select(file['overflow'], index)
+            self.fit_slices = _select(file['fit_slices'], index) if 'fit_slices' in file.keys() else None
+            self.fit_result = _select(file['fit_result'], index)
             if file['fit_function_name'].shape[0]<2 :
                 self.fit_function_name = ''
                 self.fit_function_class = ''
@@ -172,7 +340,7 @@ class Histogram:
                     self.fit_function = getattr(_fit_function,self.fit_function_name)
                 else:
                     self.fit_function = None
-            self.fit_chi2_ndof = file['fit_chi2_ndof']
+            self.fit_chi2_ndof = _select(file['fit_chi2_ndof'], index)
             self.fit_axis = file['fit_axis']
             self.xlabel = file['xlabel'][0]
             self.ylabel = file['ylabel'][0]
@@ -186,20 +354,26 @@ class Histogram:
 
         return
 
-    def load_fit_results(self, filename):
+    def load_fit_results(self, filename, index=None):
         """
-        Save the histogram and its properties in a npz file
+        Load the fit results of a histogram from a npz file, without reading its bin yields and errors
 
         :param filename: the full path of the saved histogram
+        :param index: load only the fit results of the histograms [index], see load
         :return:
         """
 
         if not os.path.isfile(filename):
             self.logger.critical('%s does not exist' % filename)
             raise FileNotFoundError
+        if filename.endswith('.h5') or filename.endswith('.hdf5'):
+            from utils import histogram_hdf5
+            histogram_hdf5.load_fit_results(self, filename, index=index)
+            self.logger.info('Loaded fit results only from %s' % filename)
+            return
         try:
             file = np.load(filename)
-            self.fit_result = file['fit_result']
+            self.fit_result = _select(file['fit_result'], index)
 
             if file['fit_function_name'].shape[0]<2 :
                 self.fit_function_name = ''
@@ -214,8 +388,8 @@ class Histogram:
                 else:
                     self.fit_function = None
 
-            self.fit_chi2_ndof = file['fit_chi2_ndof']
-            self.fit_slices = file['fit_slices'] if 'fit_slices' in file.keys() else None
+            self.fit_chi2_ndof = _select(file['fit_chi2_ndof'], index)
+            self.fit_slices = _select(file['fit_slices'], index) if 'fit_slices' in file.keys() else None
             self.fit_axis = file['fit_axis']
             self.fit_result_label = file['fit_result_label']
             self.logger.info('Loaded fit results only from %s' % filename)
@@ -239,27 +413,84 @@ class Histogram:
         # change the value array to an array of Histogram index to be modified
         hist_indices = ((value - self.bin_edges[0]) // self.bin_width).astype(int)
 
+        # get the histograms to be modified and their bin window offset
+        offset = None
+        if not fill_errors:
+            self._errors_outdated = True
+            if value[..., 0].shape == self._data[..., 0].shape or not indices:
+                data = self._data
+                offset = self.bin_offset
+            else:
+                data = self._data[indices]
+                offset = None if self.bin_offset is None else self.bin_offset[indices]
+        else:
+            # bring the poisson errors up to date before they stop being recomputed from the data
+            if not self._errors_user and self._errors_outdated:
+                self._compute_errors()
+            self._errors_user = True
+            if value[..., 0].shape == self.errors[..., 0].shape or not indices:
+                data = self.errors
+            else:
+                data = self.errors[indices]
+
+        in_window = None
+        if offset is not None:
+            hist_indices = hist_indices - offset
+            # values outside the bin window are counted in the underflow and the overflow, as in fill_with_batch
+            in_window = (hist_indices >= 0) & (hist_indices < data.shape[-1])
+            flow_indices = () if data is self._data else (indices if isinstance(indices, tuple) else (indices,))
+            for flow, outside in ((self.underflow, hist_indices < 0), (self.overflow, hist_indices >= data.shape[-1])):
+                if flow.ndim == len(flow_indices):
+                    flow[flow_indices] += outside
+                else:
+                    flow_view = flow[flow_indices]
+                    np.add(flow_view, outside, out=flow_view, casting='unsafe')
+
         # treat overflow and underflow
 
-        hist_indices[hist_indices > self.data.shape[-1] - 1] = self.data.shape[-1] - 1
+        hist_indices[hist_indices > data.shape[-1] - 1] = data.shape[-1] - 1
         hist_indices[hist_indices < 0] = 0
 
         # get the corresponding indices multiplet
         dim_indices = tuple([np.indices(value.shape)[i].reshape(np.prod(value.shape)) for i in
                              range(np.indices(value.shape).shape[0])], )
         dim_indices += (hist_indices.reshape(np.prod(value.shape)),)
+        if in_window is not None:
+            dim_indices = tuple(i[in_window.reshape(np.prod(value.shape))] for i in dim_indices)
 
-        if not fill_errors:
-            if value[..., 0].shape == self.data[..., 0].shape or not indices:
-                self.data[dim_indices] += 1
-            else:
-                self.data[indices][dim_indices] += 1
-        else:
-            if value[..., 0].shape == self.errors[..., 0].shape or not indices:
-                self.errors[dim_indices] += 1
-            else:
-                self.errors[indices][dim_indices] += 1
+        data[dim_indices] += 1
+
+
+    def _bin_batch(self, batch, offset=None):
+        """
+        Histogram a batch of values for all the histograms at once
+
+        The values of all the histograms are binned in a single pass: each value is converted to a global index
+        (histogram index * (number of bins + 2) + bin index) and the yields are obtained with a single np.bincount.
+        The two additional bins of each histogram hold the underflow (x < first edge) and the overflow
+        (x >= last edge), following the binning convention of find_bin.
 
+        :param batch: a np.array holding the values to histogram in its last dimension       (np.array)
+        :param offset: the bin window offset of each histogram if any, the window length
+                       being the one of the stored data                                      (np.array)
+        :return: the bin yields, the underflow and the overflow with shape batch.shape[:-1]  (tuple(np.array))
+        """
+        n_bins = self._data.shape[-1]
+        hist_shape = batch.shape[:-1]
+        n_hist = int(np.prod(hist_shape))
+
+        # Get the bin index shifted by one such that the underflow goes to 0 and the overflow to n_bins + 1
+        bin_index = (batch.reshape((n_hist, -1)) - self.bin_edges[0]) * (1. / self.bin_width) + 1.
+        if offset is not None:
+            bin_index -= np.reshape(offset, (n_hist, 1))
+        np.clip(bin_index, 0, n_bins + 1, out=bin_index)
+        bin_index = bin_index.astype(np.intp)
+        # Move to the global index
+        bin_index += (np.arange(n_hist, dtype=np.intp) * (n_bins + 2))[:, None]
+
+        tmp_hist = np.bincount(bin_index.ravel(), minlength=n_hist * (n_bins + 2)).reshape(hist_shape + (n_bins + 2,))
+
+        return tmp_hist[..., 1:-1], tmp_hist[..., 0], tmp_hist[..., -1]
 
     # noinspection PyTypeChecker
     def fill_with_batch(self, batch, indices=None): # TODO fill_with_batch should be fill that takes care of batch inside Histogram
@@ -269,53 +500,116 @@ class Histogram:
         :param indices: a tuple limiting the filled data to data[indices]
         :return:
         """
-        # noinspection PyUnusedLocal
-        data, underflow, overflow = None, None, None
         if not indices:
-            data = self.data
-            underflow = self.underflow
-            overflow = self.overflow
-        else:
-            data = self.data[indices]
-            underflow = self.underflow[indices]
-            overflow = self.overflow[indices]
-
-        # create the histograms out of the data
-        hist = lambda x: np.histogram(x, bins=self.bin_edges, density=False)[0]
+            indices = ()
+        offset = None if self.bin_offset is None else self.bin_offset[indices]
 
         if batch.dtype != 'object':
-            # Get the new Histogram
-            tmp_hist = np.apply_along_axis(hist, len(data.shape) - 1, batch)
-            # Get the overflow and underflow data
-            tmp_underflow = np.sum(~(batch > self.bin_edges[0]), axis=-1)
-            tmp_overflow = np.sum(~(batch < self.bin_edges[1]), axis=-1)
-            # Add it to the existing data
-            data = np.add(data, tmp_hist)
-            underflow = np.add(underflow, tmp_underflow)
-            overflow = np.add(overflow, tmp_overflow)
+            # Get the new Histogram, underflow and overflow and add it to the existing ones
+            tmp_hist, tmp_underflow, tmp_overflow = self._bin_batch(batch, offset=offset)
+            self._add_counts(indices, tmp_hist, tmp_underflow, tmp_overflow)
         else:
             for index in np.ndindex(batch.shape):
                 # Get the new Histogram
-                tmp_hist = hist(batch[index])
-                # Get the overflow and underflow data
-                tmp_underflow = np.sum(~(batch[index] > self.bin_edges[0]))
-                tmp_overflow = np.sum(~(batch[index] < self.bin_edges[1]))
+                tmp_hist, tmp_underflow, tmp_overflow = self._bin_batch(
+                    np.array(batch[index], dtype=float).reshape(1, -1), offset=None if offset is None else offset[index])
                 # Add it to the existing
-                data[index] = np.add(data[index], tmp_hist)
-                underflow[index] = np.add(underflow[index], tmp_underflow)
-                overflow[index] = np.add(overflow[index], tmp_overflow)
+                self._add_counts(indices + index, tmp_hist[0], tmp_underflow[0], tmp_overflow[0])
 
-        # Feed it back to the object
-        if not indices:
-            self.data = data
-            self.underflow = underflow
-            self.overflow = overflow
-        else:
-            self.data[indices] = data
-            self.underflow[indices] = underflow
-            self.overflow[indices] = overflow
-        # compute the poisson error on the data
-        if self.auto_errors : self._compute_errors()
+        # the poisson errors on the data are only recomputed when they are accessed
+        self._errors_outdated = True
+
+    def fill_with_index(self, hist_index, values):
+        """
+        Histogram values belonging to different histograms, e.g. the peaks found in all pixels, with a single
+        np.bincount
+
+        :param hist_index: the flat index (in data_shape) of the histogram of each value   (np.array)
+        :param values: the values                                                          (np.array)
+        :return:
+        """
+        hist_shape = self._data.shape[:-1]
+        n_hist = int(np.prod(hist_shape))
+        n_bins = self._data.shape[-1]
+        hist_index = np.asarray(hist_index, dtype=np.intp)
+
+        # global index, the underflow and the overflow going to the bins 0 and n_bins + 1 of each histogram
+        bin_index = (np.asarray(values, dtype=float) - self.bin_edges[0]) * (1. / self.bin_width) + 1.
+        if self.bin_offset is not None:
+            bin_index -= self.bin_offset.ravel()[hist_index]
+        np.clip(bin_index, 0, n_bins + 1, out=bin_index)
+        bin_index = bin_index.astype(np.intp) + hist_index * (n_bins + 2)
+
+        tmp_hist = np.bincount(bin_index, minlength=n_hist * (n_bins + 2)).reshape(hist_shape + (n_bins + 2,))
+        self._add_counts((), tmp_hist[..., 1:-1], tmp_hist[..., 0], tmp_hist[..., -1])
+        self._errors_outdated = True
+
+    def _add_counts(self, indices, counts, underflow, overflow):
+        """
+        Add counts to the histograms data[indices], whatever the storage type
+
+        :param indices: a tuple of the histograms to update   (tuple)
+        :param counts: the bin yields to add                  (np.array)
+        :param underflow: the underflow to add                (np.array)
+        :param overflow: the overflow to add                  (np.array)
+        :return:
+        """
+        for stored, new in ((self._data, counts), (self.underflow, underflow), (self.overflow, overflow)):
+            if stored.ndim == len(indices):
+                stored[indices] += new
+            else:
+                stored_view = stored[indices]
+                np.add(stored_view, new, out=stored_view, casting='unsafe')
+
+    def _empty_like(self):
+        """
+        An empty Histogram with the same binning, shape, storage and labels, e.g. to be filled separately and
+        merged back
+
+        :return: the empty Histogram     (Histogram)
+        """
+        hist = Histogram(bin_centers=self.bin_centers, data_shape=self._data.shape[:-1], xlabel=self.xlabel,
+                         ylabel=self.ylabel, label=self.label, auto_errors=self.auto_errors,
+                         compact=self._data.dtype == np.uint32,
+                         bin_window=None if self.bin_offset is None else (self.bin_offset, self._data.shape[-1]))
+        hist.bin_width, hist.bin_edges = self.bin_width, self.bin_edges
+        return hist
+
+    def merge(self, other):
+        """
+        Add the yields, underflow and overflow of another Histogram with the same binning and shape
+
+        The counts are added exactly: histograms with different bin windows move to the full storage first.
+        User provided errors are added in quadrature, the poisson errors are recomputed when accessed.
+
+        :param other: the Histogram to add        (Histogram)
+        :return: self                             (Histogram)
+        """
+        if not np.array_equal(self.bin_centers, other.bin_centers) or \
+                self._data.shape[:-1] != other._data.shape[:-1]:
+            self.logger.critical('Cannot merge histograms with different binning or shape')
+            raise ValueError('Cannot merge histograms with different binning or shape')
+
+        errors = None
+        if self._errors_user or other._errors_user:
+            errors = np.sqrt(self.errors ** 2 + other.errors ** 2)
+
+        if self.bin_offset is not None and (other.bin_offset is None or
+                                            self._data.shape[-1] != other._data.shape[-1] or
+                                            not np.array_equal(self.bin_offset, other.bin_offset)):
+            # the windows differ, move to the full binning
+            self.data = self.get_data(())
+        # both windows are identical (or there is none), else the other histogram is materialised
+        other_data = other._data if self.bin_offset is not None or other.bin_offset is None else other.data
+        self._add_counts((), other_data, other.underflow, other.overflow)
+
+        self._errors_outdated = True
+        if errors is not None:
+            self.errors = errors
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
 
     @staticmethod
     def _residual(function, p, x, y, y_err):
@@ -333,15 +627,16 @@ class Histogram:
 
     def _compute_errors(self):
         """
-        Compute poisson error of the sample
+        Compute poisson error of the sample (and drop user provided errors)
 
         :return:
         """
-        self.errors = np.sqrt(self.data)
-        self.errors[self.errors == 0.] = 1.
+        self._errors = np.sqrt(self.data)
+        self._errors[self._errors == 0.] = 1.
+        self._errors_user = False
+        self._errors_outdated = False
 
-    def _axis_fit(self, idx, func, p0, slice_list=None, bounds=None, fixed_param=None, force_quiet=None):
-        #TODO pout the full jacobian in option
+    def _axis_fit(self, idx, func, p0, slice_list=None, bounds=None, fixed_param=None, force_quiet=None, jac=None):
         """
         Perform a fit on this specific Histogram
 
@@ -351,6 +646,9 @@ class Histogram:
         :param slice_list:    the slice_list of data to fit             (list)
         :param bounds:   the boundary for the parameters                (tuple(list,list))
         :param fixed_param: the parameters to be fixed and their values (list(list,list))
+        :param jac:      the jacobian of func, same arguments as func and
+                         returning an array of shape (len(x), len(p)).
+                         If None, it is estimated by finite differences (function)
         :return: the fit result                                         (np.array)
         """
         # TODO inline comment of the function
@@ -358,9 +656,10 @@ class Histogram:
         reduced_p0 = p0
         reduced_bounds = bounds
         reduced_func = func
+        reduced_jac = jac
         # TODO optimize this part
         if type(fixed_param).__name__ != 'NoneType':
-            def reduced_func(p, x, *args, **kwargs):
+            def full_param(p):
                 p_new, j = [], 0
                 for param_i, param_val in enumerate(p0):
                     if not (param_i in fixed_param[0]):
@@ -370,7 +669,16 @@ class Histogram:
                         for value_i, value in enumerate(fixed_param[0]):
                             if value == param_i:
                                 p_new += [fixed_param[1][value_i]]
-                return func(p_new, x, *args, **kwargs)
+                return p_new
+
+            def reduced_func(p, x, *args, **kwargs):
+                return func(full_param(p), x, *args, **kwargs)
+
+            if jac is not None:
+                free_param = [i for i in range(len(p0)) if not (i in fixed_param[0])]
+
+                def reduced_jac(p, x, *args, **kwargs):
+                    return jac(full_param(p), x, *args, **kwargs)[:, free_param]
 
             reduced_p0 = []
             for i, param in enumerate(p0):
@@ -383,9 +691,12 @@ class Histogram:
                     reduced_bounds[0] += [bounds[0][i]]
                     reduced_bounds[1] += [bounds[1][i]]
             reduced_bounds = tuple(reduced_bounds)
+        # Get the histogram over the full binning
+        y = self.get_data(idx)
+        y_err = self._get_errors(idx, data=y)
         # noinspection PyUnusedLocal
         fit_result = None
-        if slice_list == [0, 0, 1] or self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]].shape == 0 \
+        if slice_list == [0, 0, 1] or y[slice_list[0]:slice_list[1]:slice_list[2]].shape == 0 \
                 or np.any(np.isnan(reduced_p0)) \
                 or np.any(np.isnan(reduced_bounds[0])) or np.any(np.isnan(reduced_bounds[1])) \
                 or np.any(np.isnan(p0)):
@@ -398,19 +709,22 @@ class Histogram:
             if not slice_list:
                 slice_list = [0, self.bin_centers.shape[0] - 1, 1]
             ndof = self.bin_centers[slice_list[0]:slice_list[1]:slice_list[2]]\
-                       [np.nonzero(self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]])].shape[0]\
+                       [np.nonzero(y[slice_list[0]:slice_list[1]:slice_list[2]])].shape[0]\
                    - len(reduced_p0)
             chi2 = np.nan
             try:
                 residual = lambda p, x, y, y_err: self._residual(reduced_func, p, x, y, y_err)
+                residual_jac = '2-point'
+                if reduced_jac is not None:
+                    residual_jac = lambda p, x, y, y_err: -reduced_jac(p, x) / y_err[:, None]
                 out = scipy.optimize.least_squares(residual, reduced_p0, args=(
                     self.bin_centers[slice_list[0]:slice_list[1]:slice_list[2]]\
-                        [np.nonzero(self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]])],
-                    self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]]\
-                        [np.nonzero(self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]])],
-                    self.errors[idx][slice_list[0]:slice_list[1]:slice_list[2]] \
-                        [np.nonzero(self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]])]),
-                                                   bounds=reduced_bounds)#, jac='3-point', method='trf', loss='arctan') # could improve with true jac
+                        [np.nonzero(y[slice_list[0]:slice_list[1]:slice_list[2]])],
+                    y[slice_list[0]:slice_list[1]:slice_list[2]]\
+                        [np.nonzero(y[slice_list[0]:slice_list[1]:slice_list[2]])],
+                    y_err[slice_list[0]:slice_list[1]:slice_list[2]] \
+                        [np.nonzero(y[slice_list[0]:slice_list[1]:slice_list[2]])]),
+                                                   bounds=reduced_bounds, jac=residual_jac)#, method='trf', loss='arctan')
                 # noinspection PyUnresolvedReferences
                 val = out.x
                 # noinspection PyUnresolvedReferences,PyUnresolvedReferences
@@ -418,8 +732,8 @@ class Histogram:
                 try:
                     # noinspection PyUnresolvedReferences,PyUnresolvedReferences
 
-                    weight_matrix = np.diag(1. / self.errors[idx][slice_list[0]:slice_list[1]:slice_list[2]] \
-                        [np.nonzero(self.data[idx][slice_list[0]:slice_list[1]:slice_list[2]])])
+                    weight_matrix = np.diag(1. / y_err[slice_list[0]:slice_list[1]:slice_list[2]] \
+                        [np.nonzero(y[slice_list[0]:slice_list[1]:slice_list[2]])])
                     weight_matrix = 1. #TODO changed to one since pull study showed previous config is fine
                     cov = np.sqrt(np.diag(inv(np.dot(np.dot(out.jac.T, weight_matrix), out.jac))))
                     fit_result = np.append(val.reshape(val.shape + (1,)), cov.reshape(cov.shape + (1,)), axis=1)
@@ -453,7 +767,8 @@ class Histogram:
     # noinspection PyDefaultArgument
     def fit(self, func, p0_func, slice_func, bound_func, labels_func=None, config=None, limited_indices=None,
             fixed_param=[],
-            force_quiet=False):
+            force_quiet=False, n_jobs=1, chunk_size=None, jac_func=None, batch_func=None, batch_jac_func=None,
+            warm_start=False):
         """
         An helper to fit Histogram
         :param labels_func:
@@ -465,13 +780,26 @@ class Histogram:
         :param fixed_param:
         :param force_quiet:
         :param func:
+        :param n_jobs: number of processes fitting the histograms (n_jobs < 1 uses all cpus). The results and
+                       the log messages are identical and in the same order as in the serial case
+        :param chunk_size: number of histograms sent at once to a process (default: about 4 chunks per process)
+        :param jac_func: the analytic jacobian of func (same arguments as func), if None it is estimated by
+                         finite differences
+        :param batch_func: func evaluated for a batch of histograms, batch_func(p, x) with p of shape
+                           (n_hist, n_params) returns (n_hist, n_bins). If given, the histograms are fitted
+                           together, chunk_size at a time (default: the last axis of data), by the vectorized
+                           Levenberg-Marquardt of utils.batch_fit instead of one least_squares per histogram
+        :param batch_jac_func: the jacobian of batch_func of shape (n_hist, n_bins, n_params), if None it is
+                               estimated by finite differences
+        :param warm_start: the first axis of data being the scan level, start the fit of data[level, ...] from
+                           the fit result of data[level - 1, ...] (for histograms without levels, from their
+                           current fit result) instead of p0_func. The fit is redone from p0_func if this result
+                           is not usable or if the warm started fit fails
         :return:
         """
 
         # todo COMMENTS and treat the labels
-        data_shape = list(self.data.shape)
-        data_shape.pop()
-        data_shape = tuple(data_shape)
+        data_shape = self._data.shape[:-1]
         self.fit_function_class = func.__module__
         self.fit_function_name  = func.__name__
         self.fit_function = func
@@ -490,13 +818,31 @@ class Histogram:
                 pbar = tqdm(total=len(limited_indices))
             tqdm_out = TqdmToLogger(self.logger, level=logging.INFO)
 
-        for indices in indices_list:
+        fit_args = (func, p0_func, slice_func, bound_func, config, fixed_param, force_quiet, jac_func, warm_start)
+        if batch_func is not None:
+            fit_results = self._fit_batch(list(indices_list), batch_func, batch_jac_func, p0_func, slice_func,
+                                          bound_func, config, fixed_param, chunk_size, warm_start)
+        elif n_jobs != 1 and warm_start and len(data_shape) > 1:
+            # one pool per level, forked once the previous level is stored in fit_result
+            indices_list = list(indices_list)
+            levels = sorted(set(indices[0] for indices in indices_list))
+            fit_results = itertools.chain.from_iterable(
+                self._fit_parallel([indices for indices in indices_list if indices[0] == level], fit_args, n_jobs,
+                                   chunk_size) for level in levels)
+        elif n_jobs != 1:
+            fit_results = self._fit_parallel(list(indices_list), fit_args, n_jobs, chunk_size)
+        else:
+            fit_results = ((indices, self._fit_index(indices, *fit_args)) for indices in indices_list)
+
+        for indices, (fit_res, chi2, ndof, _slice) in fit_results:
             if type(self.fit_result).__name__ != 'ndarray' or self.fit_result.shape == ():
+                # get the histogram over the full binning
+                y = self.get_data(indices)
                 if type(config).__name__ != 'ndarray':
                     self.fit_result = np.ones(
-                        data_shape + (len(p0_func(self.data[indices], self.bin_centers, config=None)), 2)) * np.nan
+                        data_shape + (len(p0_func(y, self.bin_centers, config=None)), 2)) * np.nan
                 else:
-                    self.fit_result = np.ones(data_shape + (len(p0_func(self.data[indices], self.bin_centers,
+                    self.fit_result = np.ones(data_shape + (len(p0_func(y, self.bin_centers,
                                                                         config=config[indices])), 2)) * np.nan
             if type(self.fit_chi2_ndof).__name__ != 'ndarray' or self.fit_chi2_ndof.shape == ():
                 self.fit_chi2_ndof = np.ones(data_shape + (2,)) * np.nan
@@ -506,43 +852,8 @@ class Histogram:
             if not force_quiet:
                 pbar.update(1)
             count += 1
-            # noinspection PyUnusedLocal
-            fit_res = None
-            # treat the fixed parameters
-            list_fixed_param = None
-            if len(fixed_param) > 0:
-                list_fixed_param = [[], []]
-                for p in fixed_param:
-                    list_fixed_param[0].append(p[0])
-                    if isinstance(p[1], tuple):
-                        list_fixed_param[1].append(config[indices][p[1]])
-                    else:
-                        list_fixed_param[1].append(p[1])
-
-            if type(config).__name__ != 'ndarray':
-                _slice = slice_func(self.data[indices], self.bin_centers,config=None)
-                self.fit_slices[indices][0]= _slice[0]
-                self.fit_slices[indices][1]= _slice[1]
-                fit_res, chi2, ndof = self._axis_fit(indices, func,
-                                                     p0_func(self.data[indices], self.bin_centers,
-                                                             config=None),
-                                                     slice_list= _slice ,
-                                                     bounds=bound_func(self.data[indices], self.bin_centers,
-                                                                       config=None),
-                                                     fixed_param=list_fixed_param,force_quiet=force_quiet)
-
-            else:
-                func_reduced = lambda _p, x: func(_p, x, config=config[indices])
-                _slice = slice_func(self.data[indices], self.bin_centers,config=config[indices])
-                self.fit_slices[indices][0]= _slice[0]
-                self.fit_slices[indices][1]= _slice[1]
-                fit_res, chi2, ndof = self._axis_fit(indices, func_reduced,
-                                                     p0_func(self.data[indices], self.bin_centers,
-                                                             config=config[indices]),
-                                                     slice_list=_slice,
-                                                     bounds=bound_func(self.data[indices], self.bin_centers,
-                                                                       config=config[indices]),
-                                                     fixed_param=list_fixed_param,force_quiet=force_quiet)
+            self.fit_slices[indices][0]= _slice[0]
+            self.fit_slices[indices][1]= _slice[1]
             # make sure sizes matches
             if self.fit_result[indices].shape[-2] < fit_res.shape[-2]:
                 num_column_to_add = fit_res.shape[-2] - self.fit_result[indices].shape[-2]
@@ -562,6 +873,245 @@ class Histogram:
             self.fit_chi2_ndof[indices][0] = chi2
             self.fit_chi2_ndof[indices][1] = ndof
 
+    def _fit_index(self, indices, func, p0_func, slice_func, bound_func, config, fixed_param, force_quiet,
+                   jac_func=None, warm_start=False):
+        """
+        Fit the histogram data[indices]
+
+        :param indices: the index of the histogram                    (tuple)
+        :param func, p0_func, slice_func, bound_func, config, fixed_param, force_quiet, jac_func, warm_start:
+                        see fit
+        :return: the fit result, the chi2, the ndof and the fit slice  (tuple)
+        """
+        # get the histogram over the full binning
+        y = self.get_data(indices)
+        # treat the fixed parameters
+        list_fixed_param = self._fixed_param(indices, fixed_param, config)
+
+        if type(config).__name__ != 'ndarray':
+            func_reduced = func
+            jac_reduced = jac_func
+            _config = None
+        else:
+            func_reduced = lambda _p, x: func(_p, x, config=config[indices])
+            jac_reduced = None
+            if jac_func is not None:
+                jac_reduced = lambda _p, x: jac_func(_p, x, config=config[indices])
+            _config = config[indices]
+        _slice = slice_func(y, self.bin_centers, config=_config)
+        p0 = p0_func(y, self.bin_centers, config=_config)
+        bounds = bound_func(y, self.bin_centers, config=_config)
+
+        if warm_start:
+            warm_p0 = self._warm_start_p0(indices, p0, bounds, list_fixed_param)
+            if warm_p0 is not None:
+                fit_res, chi2, ndof = self._axis_fit(indices, func_reduced, warm_p0, slice_list=_slice,
+                                                     bounds=bounds, fixed_param=list_fixed_param,
+                                                     force_quiet=force_quiet, jac=jac_reduced)
+                if not np.any(np.isnan(fit_res)):
+                    return fit_res, chi2, ndof, _slice
+                self.logger.debug('Warm started fit of hist %s failed, start from p0_func' % (indices,))
+
+        fit_res, chi2, ndof = self._axis_fit(indices, func_reduced, p0, slice_list=_slice, bounds=bounds,
+                                             fixed_param=list_fixed_param, force_quiet=force_quiet, jac=jac_reduced)
+        return fit_res, chi2, ndof, _slice
+
+    def _warm_start_p0(self, indices, p0, bounds, list_fixed_param=None):
+        """
+        The fit result of the previous level of data[indices] (of data[indices] itself for histograms
+        without levels) if it can be used as starting point
+
+        :param indices: the index of the histogram                    (tuple)
+        :param p0: the starting point given by p0_func                (list)
+        :param bounds: the boundary for the parameters                (tuple(list,list))
+        :param list_fixed_param: the fixed parameters, see _fixed_param (list(list,list))
+        :return: the starting point, None if there is no usable fit result (list)
+        """
+        if type(self.fit_result).__name__ != 'ndarray' or self.fit_result.shape == ():
+            return None
+        indices = indices if isinstance(indices, tuple) else (indices,)
+        if len(self._data.shape) > 2:
+            if indices[0] == 0:
+                return None
+            indices = (indices[0] - 1,) + indices[1:]
+        previous = self.fit_result[indices][..., 0]
+        if previous.shape[0] < len(p0):
+            return None
+        previous = previous[0:len(p0)]
+        # the fixed parameters are not used by the fit
+        free = np.ones(len(p0), dtype=bool)
+        if list_fixed_param is not None:
+            free[list_fixed_param[0]] = False
+        if np.any(~np.isfinite(previous[free])) \
+                or np.any(previous[free] < np.array(bounds[0], dtype=float)[free]) \
+                or np.any(previous[free] > np.array(bounds[1], dtype=float)[free]):
+            return None
+        return list(previous)
+
+    @staticmethod
+    def _fixed_param(indices, fixed_param, config):
+        """
+        The indices and values of the fixed parameters of the histogram data[indices]
+
+        :param indices, fixed_param, config: see fit
+        :return: the parameters indices and their values, None if no parameter is fixed (list(list,list))
+        """
+        list_fixed_param = None
+        if len(fixed_param) > 0:
+            list_fixed_param = [[], []]
+            for p in fixed_param:
+                list_fixed_param[0].append(p[0])
+                if isinstance(p[1], tuple):
+                    list_fixed_param[1].append(config[indices][p[1]])
+                else:
+                    list_fixed_param[1].append(p[1])
+        return list_fixed_param
+
+    def _fit_batch(self, indices_list, func, jac, p0_func, slice_func, bound_func, config, fixed_param,
+                   chunk_size=None, warm_start=False):
+        """
+        Fit the histograms of indices_list chunk by chunk with the batched Levenberg-Marquardt
+
+        The histograms of a chunk share the bins from the lowest to the highest fit slice, the bins outside
+        of the slice of a histogram and its empty bins get a 0 weight (as they are excluded in _axis_fit)
+
+        :param indices_list: the indices of the histograms to fit     (list)
+        :param func: the batched fit function                         (function)
+        :param jac: the batched jacobian, None for finite differences (function)
+        :param p0_func, slice_func, bound_func, config, fixed_param, warm_start: see fit
+        :param chunk_size: the number of histograms fitted together   (int)
+        :return: generator of (indices, (fit_res, chi2, ndof, slice)) in the order of indices_list
+        """
+        data_shape = self._data.shape[:-1]
+        if not chunk_size:
+            chunk_size = data_shape[-1] if len(data_shape) > 0 else 1
+
+        chunks = [indices_list[start:start + chunk_size] for start in range(0, len(indices_list), chunk_size)]
+        if warm_start and len(data_shape) > 1:
+            # chunks cut at the level boundaries, the fit results of a level being stored by fit before the
+            # chunks of the next level read them as starting point
+            chunks = []
+            for _, level_indices in itertools.groupby(indices_list, key=lambda indices: indices[0]):
+                level_indices = list(level_indices)
+                chunks += [level_indices[start:start + chunk_size] for start in range(0, len(level_indices),
+                                                                                      chunk_size)]
+
+        for chunk in chunks:
+            y = np.array([self.get_data(indices) for indices in chunk], dtype=float)
+            y_err = np.array([self._get_errors(indices, data=y[n]) for n, indices in enumerate(chunk)],
+                             dtype=float)
+            p0, warm_p0, lower, upper, free, slices, good = [], [], [], [], [], [], []
+            for n, indices in enumerate(chunk):
+                _config = config[indices] if type(config).__name__ == 'ndarray' else None
+                _slice = slice_func(y[n], self.bin_centers, config=_config)
+                _p0 = np.array(p0_func(y[n], self.bin_centers, config=_config), dtype=float)
+                _bounds = bound_func(y[n], self.bin_centers, config=_config)
+                _free = np.ones(_p0.shape, dtype=bool)
+                list_fixed_param = self._fixed_param(indices, fixed_param, config)
+                _warm_p0 = self._warm_start_p0(indices, _p0, _bounds, list_fixed_param) if warm_start else None
+                _warm_p0 = np.array(_p0 if _warm_p0 is None else _warm_p0, dtype=float)
+                if list_fixed_param is not None:
+                    _free[list_fixed_param[0]] = False
+                    _p0[list_fixed_param[0]] = list_fixed_param[1]
+                    _warm_p0[list_fixed_param[0]] = list_fixed_param[1]
+                _lower = np.where(_free, np.array(_bounds[0], dtype=float), -np.inf)
+                _upper = np.where(_free, np.array(_bounds[1], dtype=float), np.inf)
+                # same bad inputs as in _axis_fit
+                good.append(not (_slice == [0, 0, 1] or y[n][_slice[0]:_slice[1]:_slice[2]].shape[0] == 0
+                                 or np.any(np.isnan(_p0)) or np.any(np.isnan(_lower)) or np.any(np.isnan(_upper))))
+                p0.append(_p0)
+                warm_p0.append(_warm_p0)
+                lower.append(_lower)
+                upper.append(_upper)
+                free.append(_free)
+                slices.append(_slice)
+            p0, warm_p0, lower, upper, free, good = np.array(p0), np.array(warm_p0), np.array(lower), \
+                                                    np.array(upper), np.array(free), np.array(good)
+            warm = np.any(warm_p0 != p0, axis=-1)
+
+            # weights: 1 / error in the fit slice for the non empty bins
+            weight = np.zeros(y.shape)
+            for n, _slice in enumerate(slices):
+                if good[n]:
+                    weight[n, _slice[0]:_slice[1]:_slice[2]] = 1.
+            weight[y == 0] = 0.
+            weight = weight / y_err
+            ndof = (np.sum(weight > 0, axis=-1) - np.sum(free, axis=-1)).astype(float)
+
+            fit_res = np.ones(p0.shape + (2,)) * np.nan
+            chi2 = np.ones(len(chunk)) * np.nan
+            rows = good
+            for start_p0 in [warm_p0, p0] if np.any(warm) else [p0]:
+                if not np.any(rows):
+                    break
+                first = min(slices[n][0] for n in np.where(rows)[0])
+                last = max([slices[n][1] for n in np.where(rows)[0]] + [first + 2])
+                x = self.bin_centers[first:last]
+                val, chi2[rows], converged = batch_fit.levenberg_marquardt(
+                    func, jac, start_p0[rows], x, y[rows, first:last], weight[rows, first:last],
+                    bounds=(lower[rows], upper[rows]), free=free[rows])
+                fit_res[rows, :, 0] = val
+                fit_res[rows, :, 1] = batch_fit.parameter_errors(func, jac, val, x, weight[rows, first:last],
+                                                                 free=free[rows])
+                for n in np.where(rows)[0][~converged]:
+                    self.logger.debug('Batch fit of hist %s did not converge' % (chunk[n],))
+                # the failed warm started fits are redone from p0_func
+                rows = rows & warm & np.any(np.isnan(fit_res), axis=(-2, -1))
+            # the fixed parameters keep their value with a 0 error
+            fit_res[..., 0] = np.where(free, fit_res[..., 0], p0)
+            fit_res[..., 1] = np.where(free, fit_res[..., 1], 0.)
+
+            for n, indices in enumerate(chunk):
+                if not good[n]:
+                    self.logger.debug('Bad inputs')
+                    _slice = slices[n]
+                    ndof[n] = (_slice[1] - _slice[0]) / _slice[2] - np.sum(free[n])
+                yield indices, (fit_res[n], chi2[n], ndof[n], slices[n])
+
+    def _fit_parallel(self, indices_list, fit_args, n_jobs, chunk_size=None):
+        """
+        Fit the histograms of indices_list in a pool of forked processes
+
+        The processes are forked once the Histogram and the fit functions have been made available as a module
+        global: data, errors and bin_centers are shared with the workers (copy on write) and the fit functions
+        (possibly lambdas) never need to be pickled. The log messages and prints of each chunk are collected in
+        the workers and re-emitted here in the index order.
+
+        :param indices_list: the indices of the histograms to fit     (list)
+        :param fit_args: the arguments of _fit_index                  (tuple)
+        :param n_jobs: the number of processes (< 1 for all cpus)     (int)
+        :param chunk_size: the number of histograms per task          (int)
+        :return: generator of (indices, (fit_res, chi2, ndof, slice)) in the order of indices_list
+        """
+        global _fit_context
+
+        if n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        if not chunk_size:
+            chunk_size = max(1, int(np.ceil(len(indices_list) / (4. * n_jobs))))
+        chunks = [indices_list[i:i + chunk_size] for i in range(0, len(indices_list), chunk_size)]
+
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            self.logger.warning('Parallel fit needs the fork start method, fit in a single process')
+            for indices in indices_list:
+                yield indices, self._fit_index(indices, *fit_args)
+            return
+
+        _fit_context = (self, fit_args)
+        try:
+            with context.Pool(processes=min(n_jobs, len(chunks))) as pool:
+                for chunk_results, records, printed in pool.imap(_fit_chunk, chunks):
+                    for record in records:
+                        self.logger.handle(record)
+                    if printed:
+                        print(printed, end='')
+                    for indices_and_result in chunk_results:
+                        yield indices_and_result
+        finally:
+            _fit_context = None
+
     def find_bin(self, x):
         """
         Function to retrieve the bin number
@@ -571,3 +1121,126 @@ class Histogram:
         """
         return (x - self.bin_edges[0]) // self.bin_width
 
+
+# Histogram and fit arguments inherited by the processes forked in Histogram._fit_parallel
+_fit_context = None
+
+
+def _select(array, index):
+    """
+    The histograms [index] of an array of shape data_shape + (...), the empty and 0-d arrays (e.g. no fit result)
+    being returned as such
+
+    :param array: the array                     (np.array)
+    :param index: the index, None for all       (tuple or int)
+    :return: the selected array                 (np.array)
+    """
+    if index is None or array.ndim == 0 or array.shape[0] == 0:
+        return array
+    return array[index]
+
+
+class _HistogramFile:
+    """
+    The arrays of a npz file, read on access, the bin yields and errors stored without compression being
+    memory-mapped
+    """
+
+    # the arrays large enough to be memory-mapped
+    mapped_keys = ('data', 'errors')
+
+    def __init__(self, filename, mmap_mode=None):
+        """
+        :param filename: the npz file                                      (str)
+        :param mmap_mode: the mode of the memory maps (see np.memmap), None to read all the arrays
+                                                                            (str)
+        """
+        self.filename = filename
+        self.mmap_mode = mmap_mode
+        self.file = np.load(filename)
+        # (offset, shape, fortran_order, dtype) of the arrays to map
+        self.mapped = {}
+        if mmap_mode is not None:
+            with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as raw:
+                for member in archive.infolist():
+                    key = member.filename[:-len('.npy')]
+                    if key in self.mapped_keys and member.compress_type == zipfile.ZIP_STORED:
+                        header = self._array_header(raw, member)
+                        if header is not None:
+                            self.mapped[key] = header
+
+    @staticmethod
+    def _array_header(raw, member):
+        # position and description of the array of a zip member stored without compression, None if it can not
+        # be memory-mapped
+        raw.seek(member.header_offset)
+        local_header = raw.read(30)
+        if local_header[0:4] != b'PK\x03\x04':
+            return None
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        raw.seek(member.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(raw)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+        else:
+            return None
+        if dtype.hasobject or np.prod(shape) == 0:
+            return None
+        return raw.tell(), shape, fortran_order, dtype
+
+    def keys(self):
+        return self.file.keys()
+
+    def __getitem__(self, key):
+        if key not in self.mapped:
+            return self.file[key]
+        offset, shape, fortran_order, dtype = self.mapped[key]
+        # a plain array of the mapped memory, the file being read on access
+        return np.asarray(np.memmap(self.filename, dtype=dtype, mode=self.mmap_mode, offset=offset, shape=shape,
+                                    order='F' if fortran_order else 'C'))
+
+    def close(self):
+        self.file.close()
+
+
+class _RecordBuffer(logging.Handler):
+    """
+    A logging handler keeping the records, to be re-emitted in the parent process
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # format the message now, its arguments may not be picklable
+        try:
+            record.msg = record.getMessage()
+        except Exception:
+            record.msg = str(record.msg)
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def _fit_chunk(chunk):
+    """
+    Fit a chunk of histograms in a forked process
+
+    :param chunk: the indices of the histograms to fit                         (list)
+    :return: the list of (indices, fit results), the log records and the printed output
+    """
+    hist, fit_args = _fit_context
+    buffer = _RecordBuffer()
+    hist.logger.addHandler(buffer)
+    hist.logger.propagate = False
+    printed = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(printed):
+            chunk_results = [(indices, hist._fit_index(indices, *fit_args)) for indices in chunk]
+    finally:
+        hist.logger.removeHandler(buffer)
+        hist.logger.propagate = True
+    return chunk_results, buffer.records, printed.getvalue()
@@ -0,0 +1,267 @@
+import logging
+import os
+import sys
+
+import h5py
+import numpy as np
+
+# HDF5 storage of the Histogram (files named *.h5 or *.hdf5, see Histogram.save and Histogram.load). The bin
+# yields of histograms with levels, data_shape (n_levels, ...), are stored in compressed chunks of one level and
+# can be written as soon as a level is filled: a scan interrupted by a crash keeps its completed levels and is
+# resumed from them, and a single level is read without decompressing the others. The file records the
+# fingerprint of the filling (options, input files) it was written with, a file of another filling being
+# filled again instead of resumed
+
+__all__ = ["HistogramLevelFile", "is_hdf5", "save", "load", "load_fit_results"]
+
+
+def is_hdf5(filename):
+    """
+    :param filename: the name of a histogram file                     (str)
+    :return: True if the histogram is stored in HDF5                  (bool)
+    """
+    return filename.endswith('.h5') or filename.endswith('.hdf5')
+
+
+def _read(dataset, index):
+    # the histograms [index] of a dataset of shape data_shape + (...), h5py reading only the selected chunks for
+    # the indices it supports (integers, slices, increasing lists)
+    if index is None or dataset.ndim == 0 or dataset.shape[0] == 0:
+        return dataset[()]
+    try:
+        return dataset[index]
+    except (TypeError, ValueError, IndexError):
+        return dataset[()][index]
+
+
+class HistogramLevelFile:
+    """
+    HDF5 file of a Histogram, written level by level
+    """
+
+    def __init__(self, filename, hist, compression='gzip', fingerprint=None):
+        """
+        Open the file of the histogram, which is created if it does not exist. An existing file must hold a
+        histogram of the same shape and binning, its completed levels being read back with read_levels. With a
+        fingerprint, an existing file written with another fingerprint (or without) is created again
+
+        :param filename: the full path of the file                        (str)
+        :param hist: the histogram stored in the file                     (Histogram)
+        :param compression: the compression of the bin yields (see h5py.Group.create_dataset)
+                                                                          (str)
+        :param fingerprint: the digest of what the histogram is filled from, e.g. the options and the input
+                            files (see utils.stage_cache.options_digest)  (str)
+        """
+        self.filename = filename
+        self.compression = compression
+        self.fingerprint = fingerprint
+        self.logger = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+        if os.path.isfile(filename):
+            with h5py.File(filename, 'r') as file:
+                same_filling = fingerprint is None or \
+                    ('fingerprint' in file.attrs and file.attrs['fingerprint'] == fingerprint)
+                if same_filling:
+                    self._check(file, hist)
+            if not same_filling:
+                self.logger.warning('%s was filled from other options or input files, it is filled again'
+                                    % filename)
+                os.remove(filename)
+                self._create(filename, hist)
+        else:
+            self._create(filename, hist)
+
+    @classmethod
+    def create(cls, filename, hist, compression='gzip', fingerprint=None):
+        """
+        Create the file of the histogram, replacing the existing one
+
+        :param filename, hist, compression, fingerprint: see __init__
+        :return: the file                                                 (HistogramLevelFile)
+        """
+        if os.path.isfile(filename):
+            os.remove(filename)
+        return cls(filename, hist, compression=compression, fingerprint=fingerprint)
+
+    @staticmethod
+    def _level_shape(shape):
+        # the chunk of one level of a dataset of shape (n_levels, ...), the whole dataset without levels
+        return (1,) + tuple(shape[1:]) if len(shape) > 1 else None
+
+    def _create(self, filename, hist):
+        # written aside then moved, an interrupted creation leaving no file
+        with h5py.File(filename + '.tmp', 'w') as file:
+            data_chunks = (1,) + hist._data.shape[1:] if hist._data.ndim > 2 else True
+            file.create_dataset('data', shape=hist._data.shape, dtype=hist._data.dtype, chunks=data_chunks,
+                                compression=self.compression, shuffle=True)
+            for name in ('underflow', 'overflow'):
+                array = getattr(hist, name)
+                file.create_dataset(name, shape=array.shape, dtype=array.dtype,
+                                    chunks=self._level_shape(array.shape) if hist._data.ndim > 2 else None)
+            if hist.bin_offset is not None:
+                file.create_dataset('bin_offset', data=hist.bin_offset)
+            if hist._errors_user or not hist.auto_errors:
+                file.create_dataset('errors', shape=hist._errors.shape, dtype=hist._errors.dtype,
+                                    chunks=(1,) + hist._errors.shape[1:] if hist._errors.ndim > 2 else True,
+                                    compression=self.compression)
+            file.create_dataset('bin_centers', data=hist.bin_centers)
+            file.create_dataset('bin_edges', data=hist.bin_edges)
+            file.create_dataset('levels_done', data=np.zeros(hist._data.shape[0] if hist._data.ndim > 2 else 1,
+                                                             dtype=bool))
+            file.attrs['bin_width'] = hist.bin_width
+            if self.fingerprint is not None:
+                file.attrs['fingerprint'] = self.fingerprint
+            file.attrs['auto_errors'] = hist.auto_errors
+            file.attrs['errors_user'] = hist._errors_user
+            for name in ('xlabel', 'ylabel', 'label'):
+                file.attrs[name] = str(getattr(hist, name))
+        os.replace(filename + '.tmp', filename)
+
+    def _check(self, file, hist):
+        same = file['data'].shape == hist._data.shape and file['data'].dtype == hist._data.dtype and \
+            np.array_equal(file['bin_centers'][()], hist.bin_centers) and \
+            ('bin_offset' in file) == (hist.bin_offset is not None) and \
+            (hist.bin_offset is None or np.array_equal(file['bin_offset'][()], hist.bin_offset))
+        if not same:
+            self.logger.critical('%s holds a histogram of another shape or binning' % self.filename)
+            raise ValueError('%s holds a histogram of another shape or binning' % self.filename)
+
+    def completed_levels(self):
+        """
+        :return: the levels written                                       (list(int))
+        """
+        with h5py.File(self.filename, 'r') as file:
+            return [int(level) for level in np.where(file['levels_done'][()])[0]]
+
+    def write_level(self, hist, level):
+        """
+        Write a completed level of the histogram, the file being closed afterwards
+
+        :param hist: the histogram, data_shape (n_levels, ...)            (Histogram)
+        :param level: the level                                           (int)
+        :return:
+        """
+        with h5py.File(self.filename, 'r+') as file:
+            file['data'][level] = hist._data[level]
+            file['underflow'][level] = hist.underflow[level]
+            file['overflow'][level] = hist.overflow[level]
+            if 'errors' in file:
+                file['errors'][level] = hist._errors[level]
+            file['levels_done'][level] = True
+        self.logger.debug('Level %d of %s written in %s' % (level, hist.label, self.filename))
+
+    def read_levels(self, hist, levels=None):
+        """
+        Read completed levels into the histogram
+
+        :param hist: the histogram, data_shape (n_levels, ...)            (Histogram)
+        :param levels: the levels, by default the completed ones          (list(int))
+        :return: the levels read                                          (list(int))
+        """
+        if levels is None:
+            levels = self.completed_levels()
+        with h5py.File(self.filename, 'r') as file:
+            for level in levels:
+                hist._data[level] = file['data'][level]
+                hist.underflow[level] = file['underflow'][level]
+                hist.overflow[level] = file['overflow'][level]
+                if 'errors' in file:
+                    hist._errors[level] = file['errors'][level]
+        hist._errors_outdated = True
+        if len(levels) > 0:
+            self.logger.info('%d completed levels of %s read from %s' % (len(levels), hist.label, self.filename))
+        return levels
+
+    def write(self, hist):
+        """
+        Write the whole histogram and its fit results, all the levels being completed
+
+        :param hist: the histogram                                        (Histogram)
+        :return:
+        """
+        with h5py.File(self.filename, 'r+') as file:
+            file['data'][...] = hist._data
+            file['underflow'][...] = hist.underflow
+            file['overflow'][...] = hist.overflow
+            if 'errors' in file:
+                file['errors'][...] = hist._errors
+            file['levels_done'][...] = True
+            file.attrs['fit_function_class'] = str(hist.fit_function_class)
+            file.attrs['fit_function_name'] = str(hist.fit_function_name)
+            for name in ('fit_result', 'fit_chi2_ndof', 'fit_slices', 'fit_axis', 'fit_result_label'):
+                if name in file:
+                    del file[name]
+                value = getattr(hist, name)
+                if value is None:
+                    continue
+                value = np.asarray(value)
+                if value.dtype.kind == 'U':
+                    value = value.astype(h5py.string_dtype())
+                file.create_dataset(name, data=value)
+
+
+def save(hist, filename):
+    """
+    Save the histogram in a new HDF5 file
+
+    :param hist: the histogram                                        (Histogram)
+    :param filename: the full path of the file                        (str)
+    :return:
+    """
+    # written aside then moved, the previous file remaining complete until then
+    HistogramLevelFile.create(filename + '.part', hist).write(hist)
+    os.replace(filename + '.part', filename)
+
+
+def _load_fit_results(hist, file, index):
+    hist.fit_function_class = file.attrs['fit_function_class'] if 'fit_function_class' in file.attrs else ''
+    hist.fit_function_name = file.attrs['fit_function_name'] if 'fit_function_name' in file.attrs else ''
+    hist.fit_function = None
+    if hist.fit_function_name != '':
+        _fit_function = __import__(hist.fit_function_class, locals=None, globals=None, fromlist=[None], level=0)
+        hist.fit_function = getattr(_fit_function, hist.fit_function_name)
+    hist.fit_result = _read(file['fit_result'], index) if 'fit_result' in file else None
+    hist.fit_chi2_ndof = _read(file['fit_chi2_ndof'], index) if 'fit_chi2_ndof' in file else None
+    hist.fit_slices = _read(file['fit_slices'], index) if 'fit_slices' in file else None
+    hist.fit_axis = file['fit_axis'][()] if 'fit_axis' in file else None
+    hist.fit_result_label = file['fit_result_label'].asstr()[()] if 'fit_result_label' in file else None
+    if hist.fit_result_label is not None:
+        hist.fit_result_label = np.array(hist.fit_result_label, dtype=str)
+
+
+def load(hist, filename, index=None):
+    """
+    Load a histogram from a HDF5 file
+
+    :param hist: the histogram to set                                 (Histogram)
+    :param filename: the full path of the file                        (str)
+    :param index: load only the histograms [index], e.g. a level (int)
+    :return:
+    """
+    with h5py.File(filename, 'r') as file:
+        hist.data = _read(file['data'], index)
+        hist.bin_centers = file['bin_centers'][()]
+        hist.bin_edges = file['bin_edges'][()]
+        hist.bin_width = file.attrs['bin_width']
+        hist.bin_offset = _read(file['bin_offset'], index) if 'bin_offset' in file else None
+        hist._errors = _read(file['errors'], index) if 'errors' in file else np.zeros(0)
+        hist._errors_user = bool(file.attrs['errors_user'])
+        hist._errors_outdated = hist._errors.shape[0] == 0
+        hist.underflow = _read(file['underflow'], index)
+        hist.overflow = _read(file['overflow'], index)
+        hist.xlabel = file.attrs['xlabel']
+        hist.ylabel = file.attrs['ylabel']
+        hist.label = file.attrs['label']
+        _load_fit_results(hist, file, index)
+
+
+def load_fit_results(hist, filename, index=None):
+    """
+    Load the fit results of a histogram from a HDF5 file
+
+    :param hist: the histogram to set                                 (Histogram)
+    :param filename: the full path of the file                        (str)
+    :param index: load only the fit results of the histograms [index] (tuple or int)
+    :return:
+    """
+    with h5py.File(filename, 'r') as file:
+        _load_fit_results(hist, file, index)
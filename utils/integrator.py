@@ -0,0 +1,55 @@
+import numpy as np
+
+# Sliding window sums of traces computed for a whole block of events from a single
+# cumulative sum along the sample axis, instead of one np.convolve per pixel and event
+
+__all__ = ["window_sum", "max_run_sum"]
+
+
+def window_sum(data, window_width, out=None, dtype=None, mode='valid'):
+    """
+    The sums of window_width consecutive samples, i.e. np.convolve(trace, np.ones(window_width), mode) for
+    every trace of data
+
+    :param data: the traces, the samples being along the last axis    (np.array)
+    :param window_width: the number of samples summed                 (int)
+    :param out: the array to write the sums in (reused between blocks, it can be data in 'same' mode), shape
+                data.shape[:-1] + (n_samples - window_width + 1,) ('valid') or data.shape ('same')
+                                                                      (np.array)
+    :param dtype: the type of the sums if out is not given, by default the type of the cumulative sum of data
+                                                                      (np.dtype)
+    :param mode: 'valid' for the windows inside the traces, 'same' for the windows centred on each sample, the
+                 traces being padded with zeros at their edges        (str)
+    :return: the sums                                                 (np.array)
+    """
+    if mode == 'same':
+        padding = [(0, 0)] * (data.ndim - 1) + [(window_width // 2, (window_width - 1) // 2)]
+        data = np.pad(data, padding, mode='constant')
+    elif mode != 'valid':
+        raise ValueError('Unknown mode %s' % mode)
+    cumulative = np.cumsum(data, axis=-1)
+    if out is None:
+        out = np.empty(data.shape[:-1] + (data.shape[-1] - window_width + 1,),
+                       dtype=cumulative.dtype if dtype is None else dtype)
+    out[..., 0] = cumulative[..., window_width - 1]
+    np.subtract(cumulative[..., window_width:], cumulative[..., 0:-window_width], out=out[..., 1:],
+                casting='unsafe')
+    return out
+
+
+def max_run_sum(data):
+    """
+    The largest sum of a run of consecutive positive samples (0 if there is none), e.g. the charge of a
+    saturated pulse, for every trace of data
+
+    The runs are labelled by cumulative sums: the sum of the run ending at a sample is the cumulative sum of
+    the positive samples minus its value at the last non positive sample before it
+
+    :param data: the traces, the samples being along the last axis    (np.array)
+    :return: the largest run sum of each trace, shape data.shape[:-1] (np.array)
+    """
+    positive = data > 0
+    cumulative = np.cumsum(np.where(positive, data, 0), axis=-1)
+    run_start = np.where(positive, 0, cumulative)
+    np.maximum.accumulate(run_start, axis=-1, out=run_start)
+    return np.max(cumulative - run_start, axis=-1, initial=0)
@@ -0,0 +1,92 @@
+import copy
+import logging
+import multiprocessing
+import sys
+
+import numpy as np
+
+# Parallel ingestion of options.file_list: the files are split in contiguous chunks, each chunk
+# is read in a forked process filling its own partial Histogram and the partials are merged
+# back exactly (yields, underflow and overflow) with Histogram.merge
+
+__all__ = ["fill_parallel", "split_files"]
+
+# filler, Histogram and arguments inherited by the processes forked in fill_parallel
+_fill_context = None
+
+
+def split_files(file_list, n_chunks):
+    """
+    Split a list of files in contiguous chunks of similar length
+
+    :param file_list: the files                                       (list)
+    :param n_chunks: the number of chunks                             (int)
+    :return: the non empty chunks                                     (list(list))
+    """
+    n_chunks = max(1, min(n_chunks, len(file_list)))
+    bounds = np.linspace(0, len(file_list), n_chunks + 1).astype(int)
+    return [list(file_list[bounds[i]:bounds[i + 1]]) for i in range(n_chunks) if bounds[i + 1] > bounds[i]]
+
+
+def fill_parallel(run, hist, options, n_jobs, *args, accumulate=(), **kwargs):
+    """
+    Fill a Histogram with run(hist, options, *args, **kwargs) over options.file_list in n_jobs processes
+
+    Every process calls run on its chunk of files (options.file_list being replaced and options.n_jobs_fill
+    set to 1) with an empty copy of hist, the partial histograms are then added to hist. Filler state which
+    is not in the histogram but depends on the position in the whole input (e.g. the first camera event
+    number defining the scan levels) has to be given through options.
+
+    :param run: the filler, e.g. mpe_hist.run                         (function)
+    :param hist: the Histogram to fill                                (Histogram)
+    :param options: the filler options                                (Namespace)
+    :param n_jobs: the number of processes (< 1 for all cpus)         (int)
+    :param accumulate: the names of the np.array keyword arguments filled in place by run, to be summed over
+                       the processes                                  (tuple(str))
+    :return:
+    """
+    global _fill_context
+    log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    chunks = split_files(options.file_list, n_jobs)
+
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        log.warning('Parallel filling needs the fork start method, fill in a single process')
+        context = None
+    if context is None or len(chunks) < 2:
+        run(hist, options, *args, **kwargs)
+        return
+
+    log.info('Filling %s from %d files in %d processes' % (hist.label, len(options.file_list), len(chunks)))
+    _fill_context = (run, hist, options, args, kwargs, accumulate)
+    try:
+        with context.Pool(processes=len(chunks)) as pool:
+            for partial, arrays in pool.imap(_fill_chunk, chunks):
+                hist.merge(partial)
+                for name in accumulate:
+                    kwargs[name] += arrays[name]
+    finally:
+        _fill_context = None
+
+
+def _fill_chunk(file_list):
+    """
+    Fill an empty copy of the Histogram from a chunk of files in a forked process
+
+    :param file_list: the files of the chunk                          (list)
+    :return: the partial Histogram and the accumulated arrays         (Histogram, dict)
+    """
+    run, hist, options, args, kwargs, accumulate = _fill_context
+    options = copy.copy(options)
+    options.file_list = file_list
+    options.n_jobs_fill = 1
+    kwargs = dict(kwargs)
+    for name in accumulate:
+        kwargs[name] = np.zeros_like(kwargs[name])
+    partial = hist._empty_like()
+    run(partial, options, *args, **kwargs)
+    return partial, {name: kwargs[name] for name in accumulate}
@@ -3,6 +3,7 @@ from scipy.special import factorial
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.stats
+from utils import pdf_kernels
 
 def poisson(k, mu):
     return mu ** k * np.exp(-mu) / math.factorial(k)
@@ -19,45 +20,41 @@ def gaussian(p, x, amplitude=1.):
 
     return amplitude / np.sqrt(2 * sigma ** 2 * math.pi) * np.exp(-(x - mean) ** 2 / (2 * sigma ** 2))
 
-def generalized_poisson(k, mu, mu_xt, amplitude=1):
-    if mu_xt < 0 or mu < 0 or k < 0:
-
-        if isinstance(k, int):
-            return 0
-        else:
-            return np.zeros(len(k))
-
-    else:
+def gaussian_derivatives(p, x):
+    """
+    Gaussian of gaussian(p, x) and its partial derivatives
+    :param p: [sigma, mean, amplitude]
+    :param x: x
+    :return: G(x), dG/dsigma, dG/dmean, dG/damplitude
+    """
+    sigma = p[0]
+    mean = p[1]
+    amplitude = p[2]
 
-        if k==0:
-           log_k = np.log(1)
-        else:
-           log_k = np.sum([np.log(i) for i in range(1, k+1)])
-        #return amplitude * mu * (mu + k * mu_xt) ** (k - 1) * np.exp(-mu - k * mu_xt) / factorial(k)
-        return np.exp(np.log(amplitude) + np.log(mu) + np.log(mu + k * mu_xt)*(k - 1) + (-mu - k * mu_xt) - log_k)
+    normalised = 1. / np.sqrt(2 * sigma ** 2 * math.pi) * np.exp(-(x - mean) ** 2 / (2 * sigma ** 2))
+    value = amplitude * normalised
 
-def gaussian_sum(param, x):
+    return value, value * ((x - mean) ** 2 / sigma ** 3 - 1. / sigma), value * (x - mean) / sigma ** 2, normalised
 
-    temp = np.zeros(x.shape)
-    bin_width = x[1] - x[0]
 
-    baseline = param[0]
-    gain = param[1]
-    sigma_e = param[2]
-    sigma_1 = param[3]
-    #offset = param[4]
-    amplitudes = param[4:len(param)+1]
+def generalized_poisson_derivatives(k, mu, mu_xt):
+    """
+    Generalized poisson of generalized_poisson(k, mu, mu_xt) and its partial derivatives
+    :param k: number of photo-electrons
+    :param mu: mean number of primary photo-electrons
+    :param mu_xt: crosstalk parameter
+    :return: P(k), dP/dmu, dP/dmu_xt
+    """
+    return pdf_kernels.generalized_poisson_derivatives(k, mu, mu_xt)
 
-    n_peaks = len(amplitudes)
 
-    for i in range(n_peaks):
-        sigma = np.sqrt(sigma_e**2 + i*sigma_1**2 + bin_width**2/12.)
-        #temp += gaussian(x, sigma, baseline + i*gain + (offset if i==0 else 0), amplitude=amplitudes[i])
+def generalized_poisson(k, mu, mu_xt, amplitude=1):
+    # log(k!) comes from the cached table of pdf_kernels, k can be an array
+    return amplitude * pdf_kernels.generalized_poisson(k, mu, mu_xt)
 
-        param = [sigma, baseline + i*gain, amplitudes[i]]
-        temp += gaussian(param, x, amplitude=amplitudes[i])
+def gaussian_sum(param, x):
 
-    return temp
+    return pdf_kernels.gaussian_sum(param, x)
 
 def gaussian_2(param, x):
 
@@ -113,36 +110,20 @@ def mpe_gaussian_distribution(p, x):
     return temp
 
 
-def mpe_distribution_general(p, x, config=None):
+def mpe_distribution_general(p, x, config=None, tolerance=pdf_kernels.TOLERANCE):
     mu, mu_xt, gain, offset, sigma_e, sigma_1, amplitude = p
 
-    # print(p)
-
-    temp = np.zeros(x.shape)
-    x = x - offset
     n_peak = 40
-    for n in range(0, n_peak, 1):
-        sigma_n = np.sqrt(sigma_e ** 2 + n * sigma_1 ** 2)
+    return pdf_kernels.mpe_distribution(x, mu, mu_xt, gain, offset, sigma_e, sigma_1, amplitude,
+                                        np.arange(0, n_peak, 1), tolerance=tolerance)
 
-        temp += generalized_poisson(n, mu, mu_xt) * gaussian(x, sigma_n, n * gain)
 
-    return temp * amplitude
-
-
-def mpe_distribution_general_sh(p, x, config=None):
+def mpe_distribution_general_sh(p, x, config=None, tolerance=pdf_kernels.TOLERANCE):
     mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset = p
 
-    # print(p)
-
-    temp = np.zeros(x.shape)
-    x = x - baseline
     n_peak = 15
-    for n in range(0, n_peak, 1):
-        sigma_n = np.sqrt(sigma_e ** 2 + n * sigma_1 ** 2)  # * gain
-
-        temp += generalized_poisson(n, mu, mu_xt) * gaussian(x, sigma_n, n * gain + (offset if n != 0 else 0))
-
-    return temp * amplitude
+    return pdf_kernels.mpe_distribution(x, mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude,
+                                        np.arange(0, n_peak, 1), offset=offset, tolerance=tolerance)
 
 
 def multi_gaussian_with0( p, x):
@@ -0,0 +1,188 @@
+import numpy as np
+from scipy.special import gammaln
+
+# Vectorized kernels for the multi photo-electron spectra: the peak sums are evaluated
+# as a single (n_peaks, n_bins) broadcast, with log(k!) read from a cached table
+
+__all__ = ["log_factorial", "generalized_poisson", "generalized_poisson_derivatives", "truncate_peaks",
+           "gaussian_peaks", "gaussian_sum", "mpe_distribution", "mpe_distribution_derivatives"]
+
+# Default Poisson tail mass allowed to be dropped when truncating the peak sum
+TOLERANCE = 1e-10
+
+# Cached log(k!) for k = 0, ..., len(_log_factorial) - 1, extended on demand
+_log_factorial = gammaln(np.arange(1, 129, dtype=float))
+
+
+def log_factorial(k):
+    """
+    log(k!) read from the cached gammaln table
+
+    :param k: the integers                                            (int or np.array)
+    :return: log(k!)                                                  (float or np.array)
+    """
+    global _log_factorial
+    k = np.asarray(k, dtype=int)
+    k_max = np.max(k) if k.size > 0 else 0
+    if k_max >= _log_factorial.shape[0]:
+        n = max(k_max + 1, 2 * _log_factorial.shape[0])
+        _log_factorial = gammaln(np.arange(1, n + 1, dtype=float))
+    return _log_factorial[k]
+
+
+def generalized_poisson(k, mu, mu_xt):
+    """
+    Generalized poisson probabilities P(k) = mu (mu + k mu_xt)^(k-1) exp(-mu - k mu_xt) / k!
+
+    :param k: number of photo-electrons                               (int or np.array)
+    :param mu: mean number of primary photo-electrons                 (float)
+    :param mu_xt: crosstalk parameter                                 (float)
+    :return: P(k), 0 for unphysical parameters                        (float or np.array)
+    """
+    k = np.asarray(k, dtype=int)
+    if mu_xt < 0 or mu < 0:
+        return np.zeros(k.shape)[()]
+    if mu == 0:
+        return (k == 0).astype(float)[()]
+    k_valid = np.maximum(k, 0)
+    log_p = np.log(mu) + np.log(mu + k_valid * mu_xt) * (k_valid - 1) - mu - k_valid * mu_xt - log_factorial(k_valid)
+    return np.where(k < 0, 0., np.exp(log_p))[()]
+
+
+def generalized_poisson_derivatives(k, mu, mu_xt):
+    """
+    Generalized poisson probabilities and their partial derivatives
+
+    :param k: number of photo-electrons                               (int or np.array)
+    :param mu: mean number of primary photo-electrons                 (float)
+    :param mu_xt: crosstalk parameter                                 (float)
+    :return: P(k), dP/dmu, dP/dmu_xt                                  (tuple)
+    """
+    value = generalized_poisson(k, mu, mu_xt)
+    k = np.asarray(k, dtype=int)
+    if mu_xt < 0 or mu <= 0:
+        return value, np.zeros(k.shape)[()], np.zeros(k.shape)[()]
+    d_mu = value * (1. / mu + (k - 1) / (mu + k * mu_xt) - 1.)
+    d_mu_xt = value * (k * (k - 1) / (mu + k * mu_xt) - k)
+    return value, d_mu, d_mu_xt
+
+
+def truncate_peaks(k, mu, mu_xt, tolerance=TOLERANCE):
+    """
+    Remove from k the peaks lying in the Poisson tails
+
+    The lowest and highest peaks are dropped as long as the probability mass they
+    carry on each side stays below tolerance / 2
+
+    :param k: the candidate number of photo-electrons, increasing     (np.array)
+    :param mu: mean number of primary photo-electrons                 (float)
+    :param mu_xt: crosstalk parameter                                 (float)
+    :param tolerance: the total tail mass that can be dropped         (float)
+    :return: the kept peaks and their probabilities                   (np.array, np.array)
+    """
+    k = np.asarray(k, dtype=int)
+    probability = generalized_poisson(k, mu, mu_xt)
+    if tolerance is None or tolerance <= 0 or k.shape[0] == 0:
+        return k, probability
+    cumulative = np.cumsum(probability)
+    keep = np.where((cumulative > tolerance / 2.) & (cumulative[-1] - cumulative + probability > tolerance / 2.))[0]
+    if keep.shape[0] == 0:
+        return k[0:0], probability[0:0]
+    return k[keep[0]:keep[-1] + 1], probability[keep[0]:keep[-1] + 1]
+
+
+def gaussian_peaks(x, mean, sigma):
+    """
+    Normalised gaussians evaluated for all peaks at once
+
+    :param x: the bin centers                                         (np.array)
+    :param mean: the mean of each peak, any shape                     (np.array)
+    :param sigma: the width of each peak, same shape as mean          (np.array)
+    :return: the gaussians, shape mean.shape + (n_bins,)              (np.array)
+    """
+    mean = np.asarray(mean, dtype=float)[..., None]
+    sigma = np.asarray(sigma, dtype=float)[..., None]
+    return np.exp(-(x - mean) ** 2 / (2 * sigma ** 2)) / (np.sqrt(2 * np.pi) * sigma)
+
+
+def gaussian_sum(param, x):
+    """
+    Sum of equally spaced gaussian peaks with free amplitudes
+
+    :param param: [baseline, gain, sigma_e, sigma_1, amplitudes...]   (list)
+    :param x: the bin centers                                         (np.array)
+    :return: the sum of the peaks                                     (np.array)
+    """
+    baseline, gain, sigma_e, sigma_1 = param[0:4]
+    amplitudes = np.asarray(param[4:], dtype=float)
+    bin_width = x[1] - x[0]
+    k = np.arange(amplitudes.shape[0])
+    sigma = np.sqrt(sigma_e ** 2 + k * sigma_1 ** 2 + bin_width ** 2 / 12.)
+    return np.dot(amplitudes, gaussian_peaks(x, baseline + k * gain, sigma))
+
+
+def _peak_shapes(x, k, gain, baseline, sigma_e, sigma_1, offset, smearing):
+    sigma = np.sqrt(sigma_e ** 2 + k * sigma_1 ** 2 + smearing)
+    mean = baseline + k * gain + np.where(k != 0, offset, 0.)
+    return gaussian_peaks(x, mean, sigma), mean, sigma
+
+
+def mpe_distribution(x, mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, k, offset=0., smearing=0.,
+                     tolerance=TOLERANCE):
+    """
+    Multi photo-electron spectrum: generalized poisson weighted sum of gaussian peaks
+
+    :param x: the bin centers                                         (np.array)
+    :param mu, mu_xt: the generalized poisson parameters              (float)
+    :param gain: the distance between two peaks                       (float)
+    :param baseline: the position of the 0 p.e. peak                  (float)
+    :param sigma_e, sigma_1: the electronic and gain smearing         (float)
+    :param amplitude: the normalisation                               (float)
+    :param k: the candidate number of photo-electrons                 (np.array)
+    :param offset: shift of the peaks with k > 0                      (float)
+    :param smearing: variance added to all the peaks (1/12 for the bin width)
+                                                                      (float)
+    :param tolerance: the Poisson tail mass that can be dropped from k (float)
+    :return: the spectrum                                             (np.array)
+    """
+    k, probability = truncate_peaks(k, mu, mu_xt, tolerance=tolerance)
+    if k.shape[0] == 0:
+        return np.zeros(np.shape(x))
+    peaks = _peak_shapes(x, k, gain, baseline, sigma_e, sigma_1, offset, smearing)[0]
+    return amplitude * np.dot(probability, peaks)
+
+
+def mpe_distribution_derivatives(x, mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, k, offset=0.,
+                                 smearing=0., tolerance=TOLERANCE):
+    """
+    Partial derivatives of mpe_distribution (the truncated peaks being taken as constant)
+
+    :param x, mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, k, offset, smearing, tolerance:
+                   see mpe_distribution
+    :return: the derivatives with respect to
+             [mu, mu_xt, gain, baseline, sigma_e, sigma_1, amplitude, offset], shape (8, n_bins)
+                                                                      (np.array)
+    """
+    jac = np.zeros((8,) + np.shape(x))
+    k = np.asarray(k, dtype=int)
+    k, probability = truncate_peaks(k, mu, mu_xt, tolerance=tolerance)
+    if k.shape[0] == 0:
+        return jac
+    _, d_mu, d_mu_xt = generalized_poisson_derivatives(k, mu, mu_xt)
+    peaks, mean, sigma = _peak_shapes(x, k, gain, baseline, sigma_e, sigma_1, offset, smearing)
+    residual = x[None, :] - mean[:, None]
+    # derivatives of the weighted peaks with respect to their mean and sigma
+    weighted = probability[:, None] * peaks
+    d_mean = weighted * residual / sigma[:, None] ** 2
+    d_sigma = weighted * (residual ** 2 / sigma[:, None] ** 3 - 1. / sigma[:, None])
+
+    jac[0] = np.dot(d_mu, peaks)
+    jac[1] = np.dot(d_mu_xt, peaks)
+    jac[2] = np.dot(k, d_mean)
+    jac[3] = np.sum(d_mean, axis=0)
+    jac[4] = np.dot(sigma_e / sigma, d_sigma)
+    jac[5] = np.dot(k * sigma_1 / sigma, d_sigma)
+    jac[6] = np.sum(weighted, axis=0)
+    jac[7] = np.sum(d_mean[k != 0], axis=0)
+    jac[[0, 1, 2, 3, 4, 5, 7]] *= amplitude
+    return jac
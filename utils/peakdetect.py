@@ -14,7 +14,9 @@ __all__ = [
     "peakdetect_spline",
     "peakdetect_zero_crossing",
     "zero_crossings",
-    "zero_crossings_sine_fit"
+    "zero_crossings_sine_fit",
+    "spe_peaks",
+    "spe_peaks_in_event_list"
 ]
 
 def cleaning_peaks( datain ,baseline,sigma):
@@ -34,14 +36,101 @@ def cleaning_peaks( datain ,baseline,sigma):
         new_peaks +=[data[p - 1 + np.argmax(data[p - 1:p + 1:1])]+baseline] #[[p - 1 + np.argmax(data[p - 1:p + 1:1]), data[p - 1 + np.argmax(data[p - 1:p + 1:1])]]]
     return new_peaks
 
+def spe_peaks(data, baseline, sigma, selection='peakdetect'):
+    """
+    Find the single photo-electron peaks of a batch of traces at once
+
+    The samples below baseline + 2 sigma are set to the baseline. The peaks are selected by:
+        - 'peakdetect'    : the maxima of peakdetect(lookahead=2) in the samples [3, 47], the first
+                            extremum of each trace being dropped, as cleaning_peaks does. The scan runs
+                            over the samples for all the traces together
+        - 'local_maximum' : a sample not lower than the two previous ones and higher than the two next
+                            ones, 3 samples away from the trace edges. The first peak of a trace is kept,
+                            giving a few percent more peaks with the same amplitude distribution
+    and their largest 3 samples sum around the peak is at least 3 * 2.5 sigma
+
+    :param data: the traces, shape (n_pixels, n_events, n_samples)    (np.array)
+    :param baseline: the baseline of each pixel                       (np.array)
+    :param sigma: the electronic noise of each pixel                  (np.array)
+    :param selection: the peak selection, 'peakdetect' or 'local_maximum' (str)
+    :return: the peaks, with fields 'pixel' (the index in data) and 'amplitude'
+                                                                      (np.recarray)
+    """
+    baseline = np.asarray(baseline, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)[:, None, None]
+    data = np.asarray(data, dtype=float) - baseline[:, None, None]
+    data[data < 2 * sigma] = 0.
+
+    if selection == 'peakdetect':
+        is_peak = _peakdetect_maxima(data)
+        is_peak[..., 0:3] = False
+        is_peak[..., 48:] = False
+    elif selection == 'local_maximum':
+        # local maxima, the sample at index j of centre being the sample j + 2 of the trace
+        centre = data[..., 2:-2]
+        is_peak = np.zeros(data.shape, dtype=bool)
+        is_peak[..., 2:-2] = (centre > 0.) & (centre >= data[..., 1:-3]) & (centre >= data[..., 0:-4]) & \
+                             (centre > data[..., 3:-1]) & (centre > data[..., 4:])
+        is_peak[..., 0:3] = False
+    else:
+        raise ValueError('Unknown peak selection %s' % selection)
+
+    # largest sum of 3 consecutive samples including the peak
+    sum_3 = data[..., 0:-2] + data[..., 1:-1] + data[..., 2:]
+    is_peak[..., 2:-2] &= np.maximum(np.maximum(sum_3[..., 0:-2], sum_3[..., 1:-1]), sum_3[..., 2:]) \
+                          >= 3 * (2.5 * sigma)
+    is_peak[..., -2:] = False
+
+    pixel = np.nonzero(is_peak)[0]
+    amplitude = np.maximum(data[..., 0:-1], data[..., 1:])[is_peak[..., 1:]] + baseline[pixel]
+    return np.rec.fromarrays((pixel, amplitude), names=('pixel', 'amplitude'))
+
+
+def _peakdetect_maxima(data):
+    """
+    The maxima found by peakdetect(lookahead=2) in each trace, without its first extremum
+
+    :param data: the traces, shape (..., n_samples)                   (np.array)
+    :return: True at the maxima positions, shape of data              (np.array(dtype=bool))
+    """
+    traces = data.reshape(-1, data.shape[-1])
+    n_traces, lookahead = traces.shape[0], 2
+    is_max = np.zeros(traces.shape, dtype=bool)
+    mx, mn = np.full(n_traces, -np.inf), np.full(n_traces, np.inf)
+    mx_pos = np.zeros(n_traces, dtype=int)
+    first_found = np.zeros(n_traces, dtype=bool)
+    for index in range(traces.shape[1] - lookahead):
+        y = traces[:, index]
+        higher = y > mx
+        mx[higher] = y[higher]
+        mx_pos[higher] = index
+        mn = np.minimum(mn, y)
+
+        ahead = traces[:, index:index + lookahead]
+        found_max = (y < mx) & (mx != np.inf) & (ahead.max(axis=-1) < mx)
+        found_min = ~found_max & (y > mn) & (mn != -np.inf) & (ahead.min(axis=-1) > mn)
+        # the first extremum of a trace is a false hit
+        keep = found_max & first_found
+        is_max[np.nonzero(keep)[0], mx_pos[keep]] = True
+        first_found |= found_max | found_min
+        # search the minima after a maximum and the maxima after a minimum
+        mx[found_max], mn[found_max] = np.inf, np.inf
+        mx[found_min], mn[found_min] = -np.inf, -np.inf
+    return is_max.reshape(data.shape)
+
+
 def spe_peaks_in_event_list( data, baseline,sigma ):
-    peaks = []
-    for pix in np.ndindex(data.shape[0]):
-        #print("Progress {:2.1%}".format(pix[0] / data.shape[0]), end="\r")
-        peaks.append([])
-        for evt in np.ndindex(data.shape[1]):
-            peaks[-1]+=cleaning_peaks(data[pix][evt],baseline[pix], sigma[pix])
-    return np.array(peaks,dtype=object)
+    """
+    The single photo-electron peaks of each pixel, see spe_peaks
+
+    :return: the list of peak amplitudes of each pixel                (np.array(dtype=object))
+    """
+    peaks = spe_peaks(data, baseline, sigma)
+    split = np.searchsorted(peaks.pixel, np.arange(1, data.shape[0]))
+    result = np.empty(data.shape[0], dtype=object)
+    for pix, amplitudes in enumerate(np.split(peaks.amplitude, split)):
+        result[pix] = list(amplitudes)
+    return result
 
 
 
@@ -0,0 +1,189 @@
+import numpy as np
+import scipy.interpolate
+
+from pulse_template.pulse_template import PulseTemplate
+from utils.batch_fit import levenberg_marquardt
+
+# Pulse arrival time and amplitude of a whole block of traces at once: the template is tabulated
+# on a fine time grid, a linear least squares fit of amplitude * template(t - t_0) + baseline is
+# done for every t_0 of a coarse grid with one matrix product (template cross-correlation with
+# the baseline projected out), the best t_0 is refined by a parabola through the neighbouring
+# grid points and optionally by a batched Levenberg-Marquardt fit of the three parameters
+
+__all__ = ["PulseTimingEstimator"]
+
+
+class PulseTimingEstimator:
+    """
+    Estimate [t_0, amplitude, baseline] of the model amplitude * template(t - t_0) + baseline, the parameters
+    of data_treatement.timing.compute_time, for traces of shape (..., n_samples)
+    """
+
+    def __init__(self, template_time, template_amplitude, sample_period=4., time_step=None, table_step=0.1):
+        """
+        :param template_time: the times of the template samples [ns]     (np.array)
+        :param template_amplitude: the template, normalised to a maximum of 1
+                                                                          (np.array)
+        :param sample_period: the time between two samples of the traces [ns]
+                                                                          (float)
+        :param time_step: the step of the t_0 grid of the cross-correlation [ns], by default sample_period
+                                                                          (float)
+        :param table_step: the time step of the template table [ns]       (float)
+        """
+        self.sample_period = sample_period
+        self.time_step = sample_period if time_step is None else time_step
+        self.table_time = np.arange(template_time[0], template_time[-1] + table_step, table_step)
+        self.table_value = np.interp(self.table_time, template_time, template_amplitude)
+        self.table_derivative = np.gradient(self.table_value, table_step)
+        self.table_step = table_step
+        # the tables padded by the upper edge and by a 0 at index -1 for the times outside the table
+        self._value = np.concatenate((self.table_value, self.table_value[-1:], [0.]))
+        self._derivative = np.concatenate((self.table_derivative, self.table_derivative[-1:], [0.]))
+
+    @classmethod
+    def from_function(cls, function, t_min, t_max, table_step=0.1, **kwargs):
+        """
+        :param function: the template, function of the time [ns]          (function)
+        :param t_min, t_max: the time range of the template [ns]           (float)
+        :param table_step: see __init__                                   (float)
+        :return: the estimator                                            (PulseTimingEstimator)
+        """
+        template_time = np.arange(t_min, t_max + table_step, table_step)
+        return cls(template_time, function(template_time), table_step=table_step, **kwargs)
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        The estimator of the template used by data_treatement.timing.compute_time
+
+        :param options: a dictionary containing at least the following keys:
+            - 'mc'                   : MC template (utils/pulse_SST-1M_AfterPreampLowGain.dat) or the data
+                                       template (pulse_template/pulse_shape.npz)          (bool)
+            - 'timing_time_step'     : (optional) the step of the t_0 grid [ns]           (float)
+        :return: the estimator                                                            (PulseTimingEstimator)
+        """
+        time_step = options.timing_time_step if hasattr(options, 'timing_time_step') else None
+        if options.mc:
+            time_steps, amplitudes = np.loadtxt('utils/pulse_SST-1M_AfterPreampLowGain.dat', unpack=True,
+                                                skiprows=1)
+            function = scipy.interpolate.interp1d(time_steps, amplitudes / min(amplitudes), kind='cubic',
+                                                  bounds_error=False, fill_value=0., assume_sorted=True)
+            return cls.from_function(function, time_steps[0], time_steps[-1], time_step=time_step)
+
+        template = PulseTemplate(filename='pulse_template/pulse_shape.npz')
+        # same template for all the pixels as in compute_time
+        return cls.from_function(lambda t: template.evaluate(t + 210, [482], kind='cubic')[0],
+                                 template.table_time[0] - 210, template.table_time[-1] - 210, time_step=time_step)
+
+    def template(self, time):
+        """
+        :param time: the times [ns]                                        (np.array)
+        :return: the template and its derivative at time, 0 outside the table
+                                                                          (np.array, np.array)
+        """
+        # linear interpolation on the uniform table, the last entry being repeated for the upper edge
+        position = (np.asarray(time, dtype=float) - self.table_time[0]) / self.table_step
+        inside = (position >= 0) & (position <= self.table_time.shape[0] - 1)
+        index = np.clip(position, 0, self.table_time.shape[0] - 1).astype(int)
+        fraction = np.where(inside, position - index, 0.)
+        index = np.where(inside, index, -1)
+        return (self._value[index] + fraction * (self._value[index + 1] - self._value[index]),
+                self._derivative[index] + fraction * (self._derivative[index + 1] - self._derivative[index]))
+
+    def model(self, parameters, time):
+        """
+        :param parameters: [t_0, amplitude, baseline], shape (n, 3)        (np.array)
+        :param time: the sample times, shape (n_samples, )                 (np.array)
+        :return: the traces, shape (n, n_samples)                          (np.array)
+        """
+        value, _ = self.template(time - parameters[:, 0:1])
+        return parameters[:, 1:2] * value + parameters[:, 2:3]
+
+    def jacobian(self, parameters, time):
+        """
+        :param parameters, time: see model
+        :return: the derivatives of the model, shape (n, n_samples, 3)    (np.array)
+        """
+        value, derivative = self.template(time - parameters[:, 0:1])
+        return np.stack((-parameters[:, 1:2] * derivative, value, np.ones(value.shape)), axis=-1)
+
+    @staticmethod
+    def _linear_fit(data, value):
+        # amplitude and baseline of the least squares fit of data by amplitude * value + baseline
+        n_samples = data.shape[-1]
+        sum_value = np.sum(value, axis=-1)
+        covariance = np.sum(data * value, axis=-1) - sum_value * np.sum(data, axis=-1) / n_samples
+        variance = np.sum(value * value, axis=-1) - sum_value ** 2 / n_samples
+        amplitude = np.where(variance > 0, covariance / np.where(variance > 0, variance, 1.), 0.)
+        baseline = (np.sum(data, axis=-1) - amplitude * sum_value) / n_samples
+        return amplitude, baseline
+
+    def correlate(self, data):
+        """
+        Template cross-correlation with parabolic sub-sample refinement
+
+        :param data: the traces, shape (..., n_samples)                   (np.array)
+        :return: [t_0, amplitude, baseline], shape data.shape[:-1] + (3, )
+                                                                          (np.array)
+        """
+        traces = np.asarray(data, dtype=float).reshape(-1, data.shape[-1])
+        time = np.arange(traces.shape[-1]) * self.sample_period
+        t_0_grid = np.arange(0., time[-1] + self.sample_period, self.time_step)
+
+        # linear fit for every t_0 of the grid, score = the chi2 decrease of a positive pulse
+        value, _ = self.template(time[None, :] - t_0_grid[:, None])
+        sum_value = np.sum(value, axis=-1)
+        variance = np.sum(value * value, axis=-1) - sum_value ** 2 / time.shape[0]
+        covariance = np.dot(traces, value.T) - np.sum(traces, axis=-1)[:, None] * sum_value / time.shape[0]
+        score = np.where((covariance > 0) & (variance > 0), covariance ** 2 / np.where(variance > 0, variance, 1.),
+                         0.)
+
+        best = np.argmax(score, axis=-1)
+        centre = np.clip(best, 1, max(t_0_grid.shape[0] - 2, 1))
+        rows = np.arange(traces.shape[0])
+        if t_0_grid.shape[0] > 2:
+            left, middle, right = score[rows, centre - 1], score[rows, centre], score[rows, centre + 1]
+            curvature = left - 2. * middle + right
+            shift = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, -1.), 0.)
+            t_0 = t_0_grid[centre] + np.clip(shift, -1., 1.) * self.time_step
+        else:
+            t_0 = t_0_grid[best]
+        t_0 = np.clip(t_0, 0., time[-1] + self.sample_period)
+
+        value, _ = self.template(time[None, :] - t_0[:, None])
+        amplitude, baseline = self._linear_fit(traces, value)
+        parameters = np.stack((t_0, amplitude, baseline), axis=-1)
+        return parameters.reshape(data.shape[:-1] + (3,))
+
+    def fit(self, data, errors=None, refine=True, max_iter=20, tolerance=1e-6):
+        """
+        The cross-correlation estimate, refined by a batched Levenberg-Marquardt fit within the bounds of
+        spectra_fit.fit_pulse_shape.bounds_func
+
+        :param data: the traces, shape (..., n_samples)                   (np.array)
+        :param errors: the errors of the samples, shape (n_samples, ), 1 / sqrt(12) by default
+                                                                          (np.array)
+        :param refine: refine the cross-correlation estimate by the fit   (bool)
+        :param max_iter: the maximum number of iterations of the fit      (int)
+        :param tolerance: the relative chi2 decrease and parameter step under which a fit has converged
+                                                                          (float)
+        :return: [t_0, amplitude, baseline], shape data.shape[:-1] + (3, )
+                                                                          (np.array)
+        """
+        parameters = self.correlate(data)
+        if not refine:
+            return parameters
+
+        traces = np.asarray(data, dtype=float).reshape(-1, data.shape[-1])
+        time = np.arange(traces.shape[-1]) * self.sample_period
+        if errors is None:
+            errors = np.ones(traces.shape[-1]) / np.sqrt(12)
+        weight = np.broadcast_to(1. / errors, traces.shape)
+
+        lower = np.stack((np.zeros(traces.shape[0]), np.zeros(traces.shape[0]), np.min(traces, axis=-1)), axis=-1)
+        upper = np.stack((np.full(traces.shape[0], traces.shape[-1] * self.sample_period),
+                          np.max(traces, axis=-1), np.max(traces, axis=-1)), axis=-1)
+        p0 = np.clip(parameters.reshape(-1, 3), lower, upper)
+        p, _, _ = levenberg_marquardt(self.model, self.jacobian, p0, time, traces, weight, bounds=(lower, upper),
+                                      max_iter=max_iter, ftol=tolerance, xtol=tolerance)
+        return p.reshape(parameters.shape)
@@ -0,0 +1,298 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
+
+# Content addressed cache of the products written by the analysis stages (create_histo,
+# perform_analysis) in options.output_directory. A stage is identified by the digest of
+# its module, of the sources of the loaded modules of the repository, of the options, of
+# the size and modification time of the input files and of the content of the products
+# of the other stages it may read (the existing options.*_filename files). A stage found
+# in the cache is not run, its products being restored in the output directory. The index
+# of the cache is updated under a file lock, the stages of a graph being possibly run by
+# concurrent processes
+
+__all__ = ["StageCache", "run_stage", "file_digest", "code_version", "options_digest"]
+
+# options which do not change the products of a stage
+_STEERING_KEYS = {'create_histo', 'perform_analysis', 'display_results', 'save', 'verbose', 'log_file_basename',
+                  'yaml_config', 'stage_cache', 'stage_cache_directory'}
+
+# digest of the sources of the repository modules, computed once
+_code_version = None
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_digest(filename, chunk_size=1 << 22):
+    """
+    :param filename: the full path of the file                        (str)
+    :param chunk_size: the number of bytes read at once                (int)
+    :return: the sha1 of the content of the file                      (str)
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version():
+    """
+    :return: the digest of the sources of the loaded modules of the repository     (str)
+    """
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        digest = hashlib.sha1()
+        sources = set()
+        for module in list(sys.modules.values()):
+            filename = getattr(module, '__file__', None)
+            if filename is not None and filename.endswith('.py') and \
+                    os.path.abspath(filename).startswith(root + os.sep):
+                sources.add(os.path.abspath(filename))
+        for filename in sorted(sources):
+            digest.update(os.path.relpath(filename, root).encode())
+            digest.update(file_digest(filename).encode())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def _canonical(value):
+    # json compatible version of an option value, None for the values which can not be serialised
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return None
+
+
+def options_digest(options, ignored=()):
+    """
+    :param options: the options of the analysis
+    :param ignored: the options not changing the products, on top of the steering ones  (list(str))
+    :return: the digest of the options and of the size and modification time of the input files
+                                                                                        (str)
+    """
+    values = {key: _canonical(value) for key, value in vars(options).items()
+              if key not in _STEERING_KEYS and key not in ignored and not key.startswith('_')}
+    description = {'options': values, 'input_files': StageCache._input_files(options)}
+    return _sha1(json.dumps(description, sort_keys=True).encode())
+
+
+class StageCache:
+    """
+    Cache of the products of the analysis stages, stored in directory/<key>/
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: the directory of the cache                      (str)
+        """
+        self.directory = directory
+        self._index_filename = os.path.join(directory, 'index.json')
+        self._lock_filename = os.path.join(directory, 'index.lock')
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        The cache configured by the options, None if the stages are not cached
+
+        :param options: a dictionary containing at least the following keys:
+            - 'output_directory'      : the directory of the products of the stages          (str)
+            - 'stage_cache'           : (optional) cache the stages (default False)          (bool)
+            - 'stage_cache_directory' : (optional) the directory of the cache, by default
+                                        output_directory + 'stage_cache/'                    (str)
+        :return: the cache                                                                   (StageCache)
+        """
+        if not (hasattr(options, 'stage_cache') and options.stage_cache):
+            return None
+        directory = options.stage_cache_directory if hasattr(options, 'stage_cache_directory') else \
+            os.path.join(options.output_directory, 'stage_cache')
+        return cls(directory)
+
+    def _load_index(self):
+        if not os.path.isfile(self._index_filename):
+            return {'outputs': {}, 'provenance': {}}
+        with open(self._index_filename) as file:
+            return json.load(file)
+
+    def _save_index(self, index):
+        with open(self._index_filename + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(self._index_filename + '.tmp', self._index_filename)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # exclusive access to the index, shared by the processes running stages concurrently
+        with open(self._lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _input_files(options):
+        # size and modification time of the input files of the stage
+        if not (hasattr(options, 'directory') and hasattr(options, 'file_basename') and
+                hasattr(options, 'file_list')):
+            return []
+        files = []
+        for file in options.file_list:
+            url = options.directory + options.file_basename % file
+            stat = os.stat(url) if os.path.isfile(url) else None
+            files.append([url, None if stat is None else stat.st_size, None if stat is None else stat.st_mtime_ns])
+        return files
+
+    @staticmethod
+    def _products(options):
+        # the existing products named by the options, {option: filename}
+        products = {}
+        for key, value in sorted(vars(options).items()):
+            if key.endswith('_filename') and isinstance(value, str):
+                filename = os.path.join(options.output_directory, value)
+                if os.path.isfile(filename):
+                    products[key] = filename
+        return products
+
+    def stage_key(self, options, stage):
+        """
+        :param options: the options of the analysis
+        :param stage: the stage, e.g. 'create_histo'                       (str)
+        :return: the digest of the stage without the products it may read (str)
+        """
+        values = {key: _canonical(value) for key, value in vars(options).items()
+                  if key not in _STEERING_KEYS and not key.startswith('_')}
+        description = {'stage': stage, 'code': code_version(), 'options': values,
+                       'input_files': self._input_files(options)}
+        return _sha1(json.dumps(description, sort_keys=True).encode())
+
+    @staticmethod
+    def _snapshot(directory):
+        if not os.path.isdir(directory):
+            return {}
+        return {name: (os.stat(os.path.join(directory, name)).st_mtime_ns,
+                       os.stat(os.path.join(directory, name)).st_size)
+                for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name))}
+
+    def run(self, function, options, stage, overwrites_outputs=None, outputs=None):
+        """
+        Run a stage unless it is in the cache, in which case its products are restored
+
+        :param function: the stage, called as function(options)                          (function)
+        :param options: the options of the analysis
+        :param stage: the name of the stage                                                (str)
+        :param overwrites_outputs: True if the stage writes its products without reading them (create_histo),
+                                   False if it updates them (perform_analysis), by default True for
+                                   'create_histo'                                          (bool)
+        :param outputs: the names of the products of the stage in output_directory, by default the files
+                        written in output_directory while the stage runs. Needed when other stages write in
+                        output_directory at the same time                                  (list(str))
+        :return: True if the stage has been run, False if it has been restored from the cache
+                                                                                           (bool)
+        """
+        log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+        if overwrites_outputs is None:
+            overwrites_outputs = stage == 'create_histo'
+        declared = None if outputs is None else set(outputs)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._locked():
+            index = self._load_index()
+        stage_id = '%s.%s' % (options.analysis_module if hasattr(options, 'analysis_module') else '', stage)
+        base_key = self.stage_key(options, stage_id)
+        provenance = index['provenance'].setdefault(stage_id, {})
+
+        # the products read by the stage: the products it overwrites are not inputs, the products it updates
+        # are identified by the content they had before their last update by this stage
+        products = self._products(options)
+        digests = {}
+        for key, filename in products.items():
+            name = os.path.basename(filename)
+            if overwrites_outputs and name in index['outputs'].get(base_key, []):
+                continue
+            digest = file_digest(filename)
+            digests[key] = digest if overwrites_outputs else provenance.get(digest, digest)
+        key = _sha1(json.dumps({'stage': base_key, 'products': digests}, sort_keys=True).encode())
+
+        entry_directory = os.path.join(self.directory, key)
+        entry_filename = os.path.join(entry_directory, 'entry.json')
+        if os.path.isfile(entry_filename):
+            with open(entry_filename) as file:
+                outputs = json.load(file)['outputs']
+            if all(os.path.isfile(os.path.join(entry_directory, name)) for name in outputs):
+                for name, digest in outputs.items():
+                    target = os.path.join(options.output_directory, name)
+                    if not os.path.isfile(target) or file_digest(target) != digest:
+                        shutil.copy2(os.path.join(entry_directory, name), target)
+                log.info('-|> %s up to date (cache %s), %d products restored' % (stage_id, key[0:12], len(outputs)))
+                return False
+
+        before = self._snapshot(options.output_directory)
+        function(options)
+        after = self._snapshot(options.output_directory)
+        names = sorted(name for name, stat in after.items() if before.get(name) != stat and
+                       (declared is None or name in declared))
+
+        outputs = {}
+        new_provenance = {}
+        for name in names:
+            filename = os.path.join(options.output_directory, name)
+            outputs[name] = file_digest(filename)
+            if not overwrites_outputs and name in before:
+                # the updated product is identified by its content before the update
+                for product_key, product in products.items():
+                    if os.path.basename(product) == name and product_key in digests:
+                        new_provenance[outputs[name]] = digests[product_key]
+
+        if overwrites_outputs:
+            digests = {product_key: digest for product_key, digest in digests.items()
+                       if os.path.basename(products[product_key]) not in names}
+            key = _sha1(json.dumps({'stage': base_key, 'products': digests}, sort_keys=True).encode())
+            entry_directory = os.path.join(self.directory, key)
+
+        os.makedirs(entry_directory, exist_ok=True)
+        for name in names:
+            shutil.copy2(os.path.join(options.output_directory, name), os.path.join(entry_directory, name))
+        with open(os.path.join(entry_directory, 'entry.json'), 'w') as file:
+            json.dump({'stage': stage_id, 'outputs': outputs}, file)
+        # the index read again, the other stages having possibly updated it meanwhile
+        with self._locked():
+            index = self._load_index()
+            if overwrites_outputs:
+                index['outputs'][base_key] = names
+            index['provenance'].setdefault(stage_id, {}).update(new_provenance)
+            self._save_index(index)
+        log.info('-|> %s cached (cache %s), %d products' % (stage_id, key[0:12], len(outputs)))
+        return True
+
+
+def run_stage(function, options, stage, cache=None, outputs=None):
+    """
+    Run a stage of an analysis module through the cache if there is one
+
+    :param function: the stage, e.g. analysis_module.create_histo     (function)
+    :param options: the options of the analysis
+    :param stage: the name of the stage                               (str)
+    :param cache: the cache, None to always run the stage             (StageCache)
+    :param outputs: the products of the stage, see StageCache.run     (list(str))
+    :return:
+    """
+    if cache is None:
+        function(options)
+    else:
+        cache.run(function, options, stage, outputs=outputs)
@@ -0,0 +1,317 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from yaml import load
+
+from utils.calibration_store import store_fit_results
+from utils.geometry import setup_pixels
+from utils.stage_cache import StageCache, run_stage
+
+# Calibration chain as a graph of analysis stages: each stage runs steps (create_histo,
+# perform_analysis, save) of an analysis module with its YAML configuration, and declares
+# the products it reads and writes in the output directory. A stage depends on the stages
+# writing the products it reads, the stages whose dependencies are done run concurrently in
+# forked processes, and the completed stages are recorded in a state file so that a chain
+# interrupted by a crash resumes after the last completed stages
+
+__all__ = ["Stage", "StageGraph", "load_options"]
+
+# graph and state inherited by the processes forked in StageGraph.run
+_graph_context = None
+
+
+def load_options(config, overrides=None, pixels=True):
+    """
+    The options of an analysis from its YAML configuration, as built by script_analysis
+
+    :param config: the YAML configuration file                         (str)
+    :param overrides: the options replacing the ones of the file        (dict)
+    :param pixels: set the camera test setup and the pixels, see utils.geometry.setup_pixels
+                                                                        (bool)
+    :return: the options                                               (argparse.Namespace)
+    """
+    options = {'verbose': True, 'log_file_basename': None, 'create_histo': False, 'perform_analysis': False,
+               'display_results': False, 'save': False}
+    with open(config) as f:
+        options.update(load(f))
+    if overrides is not None:
+        options.update(overrides)
+    options = argparse.Namespace(**options)
+    if pixels:
+        setup_pixels(options)
+    return options
+
+
+class Stage:
+    """
+    A node of the calibration chain
+    """
+
+    def __init__(self, name, config, steps=('create_histo', 'perform_analysis'), inputs=None, outputs=None,
+                 requires=(), overrides=None):
+        """
+        :param name: the name of the stage                                 (str)
+        :param config: the YAML configuration of the analysis                (str)
+        :param steps: the functions of the analysis module to call, in order (list(str))
+        :param inputs: the products read, by default the values of the options *_filename but histo_filename
+                                                                            (list(str))
+        :param outputs: the products written, by default the option histo_filename
+                                                                            (list(str))
+        :param requires: the stages to run before, on top of the ones writing the inputs
+                                                                            (list(str))
+        :param overrides: the options replacing the ones of the configuration
+                                                                            (dict)
+        """
+        self.name = name
+        self.config = config
+        self.steps = list(steps)
+        self.requires = list(requires)
+        self.overrides = {} if overrides is None else dict(overrides)
+
+        # the products only, without the camera test setup
+        options = load_options(self.config, self.overrides, pixels=False)
+        filenames = {key: value for key, value in vars(options).items()
+                     if key.endswith('_filename') and isinstance(value, str)}
+        self.outputs = list(outputs) if outputs is not None else \
+            ([filenames['histo_filename']] if 'histo_filename' in filenames else [])
+        self.inputs = list(inputs) if inputs is not None else \
+            sorted(set(value for key, value in filenames.items() if key != 'histo_filename') - set(self.outputs))
+
+    def options(self):
+        """
+        :return: the options of the stage                                  (argparse.Namespace)
+        """
+        return load_options(self.config, self.overrides)
+
+    def fingerprint(self):
+        """
+        :return: the digest of the definition and of the configuration of the stage
+                                                                            (str)
+        """
+        with open(self.config, 'rb') as f:
+            config = hashlib.sha1(f.read()).hexdigest()
+        description = {'config': config, 'steps': self.steps, 'inputs': self.inputs, 'outputs': self.outputs,
+                       'requires': self.requires, 'overrides': repr(sorted(self.overrides.items()))}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def run(self):
+        """
+        Run the steps of the analysis module, through the stage cache if the configuration enables it (the
+        products cached being the declared outputs), the fit results of perform_analysis being stored in the
+        calibration database if there is one
+
+        :return:
+        """
+        log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+        options = self.options()
+        analysis_module = __import__('analysis.%s' % options.analysis_module, locals=None, globals=None,
+                                     fromlist=[None], level=0)
+        stage_cache = StageCache.from_options(options)
+        for step in self.steps:
+            log.info('-|> %s : %s.%s' % (self.name, options.analysis_module, step))
+            if step in ('create_histo', 'perform_analysis'):
+                # the declared outputs only, the stages run concurrently writing in the same output directory
+                run_stage(getattr(analysis_module, step), options, step, stage_cache, outputs=self.outputs)
+                if step == 'perform_analysis':
+                    store_fit_results(options)
+            else:
+                getattr(analysis_module, step)(options)
+
+
+class StageGraph:
+    """
+    The stages of a calibration chain and their dependencies
+    """
+
+    def __init__(self, stages, state_file=None):
+        """
+        :param stages: the stages                                          (list(Stage))
+        :param state_file: the json file recording the completed stages, None not to record them
+                                                                            (str)
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError('Two stages have the same name')
+        self.state_file = state_file
+        self.dependencies = self._dependencies()
+        self.order = self._topological_order()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        The graph of a chain configuration, a YAML file with:
+            - 'stages'     : {name: {'config': ..., 'steps': ..., 'inputs': ..., 'outputs': ..., 'requires': ...,
+                             'overrides': ...}}, see Stage
+            - 'overrides'  : (optional) the options replacing the ones of the configuration of all the stages,
+                             e.g. the common output_directory
+            - 'state_file' : (optional) the file recording the completed stages
+
+        :param config: the chain configuration file                        (str)
+        :return: the graph                                                 (StageGraph)
+        """
+        with open(config) as f:
+            chain = load(f)
+        common = chain.get('overrides') or {}
+        stages = []
+        for name, definition in chain['stages'].items():
+            definition = dict(definition)
+            definition['overrides'] = dict(common, **(definition.get('overrides') or {}))
+            stages.append(Stage(name, **definition))
+        return cls(stages, state_file=chain.get('state_file'))
+
+    def _dependencies(self):
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                producers.setdefault(output, []).append(stage.name)
+        dependencies = {}
+        for stage in self.stages.values():
+            required = set(stage.requires)
+            for name in required:
+                if name not in self.stages:
+                    raise ValueError('Stage %s requires the unknown stage %s' % (stage.name, name))
+            for product in stage.inputs:
+                required.update(producer for producer in producers.get(product, []) if producer != stage.name)
+            dependencies[stage.name] = required
+        return dependencies
+
+    def _topological_order(self):
+        order, done = [], set()
+        remaining = dict(self.dependencies)
+        while remaining:
+            ready = sorted(name for name, required in remaining.items() if required <= done)
+            if not ready:
+                raise ValueError('The stages %s have cyclic dependencies, declare their inputs explicitly'
+                                 % ', '.join(sorted(remaining)))
+            order.extend(ready)
+            done.update(ready)
+            for name in ready:
+                del remaining[name]
+        return order
+
+    def _load_state(self):
+        if self.state_file is None or not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        if self.state_file is None:
+            return
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def completed(self):
+        """
+        :return: the stages completed with their current definition and configuration
+                                                                            (set(str))
+        """
+        state = self._load_state()
+        return set(name for name, fingerprint in state.items()
+                   if name in self.stages and self.stages[name].fingerprint() == fingerprint)
+
+    def run(self, n_jobs=1, restart=False):
+        """
+        Run the stages not completed yet, the stages whose dependencies are done being run concurrently
+
+        A stage is run again when a stage it depends on is run. The stages depending on a failed stage are not
+        run.
+
+        :param n_jobs: the number of processes, < 1 for all cpus, 1 to run the stages in this process
+                                                                            (int)
+        :param restart: forget the completed stages                         (bool)
+        :return: the stages run                                            (list(str))
+        """
+        global _graph_context
+        log = logging.getLogger(sys.modules['__main__'].__name__ + '.' + __name__)
+        state = {} if restart else {name: fingerprint for name, fingerprint in self._load_state().items()
+                                    if name in self.stages}
+        done = set() if restart else self.completed()
+        # the stages to run: the ones not completed and the ones depending on them
+        pending = set()
+        for name in self.order:
+            if name not in done or self.dependencies[name] & pending:
+                pending.add(name)
+                state.pop(name, None)
+        for name in sorted(set(self.stages) - pending):
+            log.info('-|> %s already completed' % name)
+        self._save_state(state)
+
+        if n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        context = None
+        if n_jobs != 1:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                log.warning('Concurrent stages need the fork start method, run them in a single process')
+
+        run, failed = [], []
+        if context is None:
+            for name in self.order:
+                if name not in pending:
+                    continue
+                if self.dependencies[name] & set(failed):
+                    failed.append(name)
+                    continue
+                try:
+                    self.stages[name].run()
+                except Exception:
+                    log.exception('-|> %s failed' % name)
+                    failed.append(name)
+                    continue
+                run.append(name)
+                state[name] = self.stages[name].fingerprint()
+                self._save_state(state)
+        else:
+            _graph_context = self
+            try:
+                with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor:
+                    futures = {}
+                    while pending or futures:
+                        finished = set(run) | (set(self.stages) - pending - set(failed) - set(futures.values()))
+                        for name in [name for name in self.order if name in pending]:
+                            if self.dependencies[name] & set(failed):
+                                pending.discard(name)
+                                failed.append(name)
+                            elif self.dependencies[name] <= finished:
+                                pending.discard(name)
+                                futures[executor.submit(_run_stage, name)] = name
+                        if not futures:
+                            break
+                        completed, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            name = futures.pop(future)
+                            try:
+                                future.result()
+                            except Exception:
+                                log.exception('-|> %s failed' % name)
+                                failed.append(name)
+                                continue
+                            run.append(name)
+                            state[name] = self.stages[name].fingerprint()
+                            self._save_state(state)
+            finally:
+                _graph_context = None
+
+        if failed:
+            raise RuntimeError('The stages %s failed or depend on a failed stage' % ', '.join(failed))
+        return run
+
+
+def _run_stage(name):
+    """
+    Run a stage in a forked process
+
+    :param name: the name of the stage                                 (str)
+    :return: the name of the stage                                     (str)
+    """
+    _graph_context.stages[name].run()
+    return name
@@ -0,0 +1,153 @@
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse
+
+# Trigger emulation as sparse linear algebra: the pixel -> patch and patch -> cluster 7
+# incidence matrices are built once from the camera (and cached on disk keyed by the
+# camera configuration), the patch and cluster traces of a block of events being then
+# two sparse products and a vectorised compression / clipping
+
+__all__ = ["TriggerOperator"]
+
+# operators already built, {id(camera): (camera, operator)}
+_operators = {}
+
+
+class TriggerOperator:
+    """
+    Compute the patch and cluster 7 traces of the camera trigger from the pixel traces
+    """
+
+    def __init__(self, pixel_to_patch, patch_to_cluster):
+        """
+        :param pixel_to_patch: 1 for the pixels of each patch, shape (n_patches, n_pixels)
+                                                                          (scipy.sparse.csr_matrix)
+        :param patch_to_cluster: 1 for the patches of each cluster 7, shape (n_clusters, n_patches)
+                                                                          (scipy.sparse.csr_matrix)
+        """
+        self.pixel_to_patch = pixel_to_patch
+        self.patch_to_cluster = patch_to_cluster
+
+    @classmethod
+    def build(cls, camera):
+        """
+        Build the incidence matrices from the camera description
+
+        :param camera: the camera, with Pixels, Patches and Clusters_7     (cts_core.camera.Camera)
+        :return: the operator                                             (TriggerOperator)
+        """
+        patch_index = [(patch.ID, pixel.ID) for patch in camera.Patches for pixel in patch.pixels]
+        cluster_index = [(cluster.ID, patch.ID) for cluster in camera.Clusters_7 for patch in cluster.patches]
+        pixel_to_patch = cls._incidence(patch_index, (len(camera.Patches), len(camera.Pixels)))
+        patch_to_cluster = cls._incidence(cluster_index, (len(camera.Clusters_7), len(camera.Patches)))
+        return cls(pixel_to_patch, patch_to_cluster)
+
+    @staticmethod
+    def _incidence(index, shape):
+        rows, columns = np.array(index, dtype=int).reshape(-1, 2).T
+        matrix = scipy.sparse.csr_matrix((np.ones(rows.shape[0]), (rows, columns)), shape=shape)
+        # an element listed twice counts once
+        matrix.data[:] = 1.
+        return matrix
+
+    @classmethod
+    def from_camera(cls, camera, config_file=None, cache_directory=None):
+        """
+        The operator of a camera, built once per camera object and, if a cache directory is given, stored on
+        disk under the digest of the camera configuration file
+
+        :param camera: the camera                                         (cts_core.camera.Camera)
+        :param config_file: the camera configuration file                 (str)
+        :param cache_directory: the directory of the cached operators     (str)
+        :return: the operator                                             (TriggerOperator)
+        """
+        cached = _operators.get(id(camera))
+        if cached is not None and cached[0] is camera:
+            return cached[1]
+
+        filename = None
+        if config_file is not None and cache_directory is not None and os.path.isfile(config_file):
+            with open(config_file, 'rb') as file:
+                key = hashlib.sha1(file.read()).hexdigest()[0:16]
+            filename = os.path.join(cache_directory, 'trigger_operator_%s.npz' % key)
+
+        if filename is not None and os.path.isfile(filename):
+            operator = cls.load(filename)
+        else:
+            operator = cls.build(camera)
+            if filename is not None and os.path.isdir(cache_directory):
+                operator.save(filename)
+        _operators[id(camera)] = (camera, operator)
+        return operator
+
+    def save(self, filename):
+        """
+        Save the incidence matrices in a npz file
+
+        :param filename: the full path of the file                        (str)
+        :return:
+        """
+        arrays = {}
+        for name in ('pixel_to_patch', 'patch_to_cluster'):
+            matrix = getattr(self, name)
+            arrays.update({name + '_indices': matrix.indices, name + '_indptr': matrix.indptr,
+                           name + '_shape': np.array(matrix.shape)})
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the incidence matrices saved by save
+
+        :param filename: the full path of the file                        (str)
+        :return: the operator                                             (TriggerOperator)
+        """
+        file = np.load(filename)
+        matrices = []
+        for name in ('pixel_to_patch', 'patch_to_cluster'):
+            indices = file[name + '_indices']
+            matrices.append(scipy.sparse.csr_matrix((np.ones(indices.shape[0]), indices, file[name + '_indptr']),
+                                                    shape=tuple(file[name + '_shape'])))
+        file.close()
+        return cls(*matrices)
+
+    @staticmethod
+    def _apply(matrix, traces):
+        # matrix product along the axis -2 of traces of shape (..., n, n_samples)
+        moved = np.moveaxis(traces, -2, 0)
+        result = matrix.dot(moved.reshape(moved.shape[0], -1))
+        return np.moveaxis(result.reshape((matrix.shape[0],) + moved.shape[1:]), 0, -2)
+
+    def patch_trace(self, data, compression_factor, clipping):
+        """
+        The patch traces: sum of the pixel traces, divided by the compression factor, clipped to [0, clipping]
+        and truncated to integers
+
+        :param data: the baseline subtracted pixel traces, shape (..., n_pixels, n_samples)
+                                                                          (np.array)
+        :param compression_factor: the division factor of the patch sums  (float)
+        :param clipping: the maximum patch value                          (float)
+        :return: the patch traces, shape (..., n_patches, n_samples)     (np.array)
+        """
+        patch_trace = self._apply(self.pixel_to_patch, data) / compression_factor
+        return np.floor(np.clip(patch_trace, 0., clipping))
+
+    def cluster_trace(self, patch_trace):
+        """
+        The cluster 7 traces: sum of the patch traces
+
+        :param patch_trace: the patch traces, shape (..., n_patches, n_samples)
+                                                                          (np.array)
+        :return: the cluster traces, shape (..., n_clusters, n_samples)  (np.array)
+        """
+        return self._apply(self.patch_to_cluster, patch_trace)
+
+    def compute(self, data, compression_factor, clipping):
+        """
+        :param data, compression_factor, clipping: see patch_trace
+        :return: the cluster and the patch traces                         (tuple(np.array))
+        """
+        patch_trace = self.patch_trace(data, compression_factor, clipping)
+        return self.cluster_trace(patch_trace), patch_trace